@@ -1,44 +1,112 @@
+"""Benchmarks of Slonik against other Postgres drivers.
+
+    python bench.py [-b BENCH] [-d DRIVER] [-n ITERATIONS] [--json FILE]
+    python bench.py --compare BASELINE.json CURRENT.json [--threshold 10]
+
+Every scenario runs warmup iterations first, then reports percentiles of the
+timed iterations, the throughput, the peak of the memory allocated by Python
+during one extra run (with tracemalloc) and the peak RSS of the process so
+far. Compare mode fails when a scenario got slower than the threshold.
+"""
+import argparse
+import json
+import multiprocessing
+import platform
+import resource
 import statistics
+import sys
+import threading
 import time
+import tracemalloc
+
+
+def percentile(values, p):
+    """Percentile p (0 to 100) of sorted values, interpolated linearly."""
+    pos = (len(values) - 1) * p / 100
+    low = int(pos)
+    high = min(low + 1, len(values) - 1)
+    return values[low] + (values[high] - values[low]) * (pos - low)
+
+
+def max_rss() -> int:
+    """Peak RSS of the process in KiB (ru_maxrss is in bytes on macOS)."""
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss // 1024 if sys.platform == 'darwin' else rss
 
 
 class Bench:
     name = None
     driver = None
     queries = []
+    # what operations() counts
+    unit = 'rows'
 
-    def __call__(self):
+    def __call__(self, options):
+        """Run every query, returning their statistics."""
         try:
             self.setup()
         except ImportError:
             print(f'Driver {self.driver} not installed, skipping…')
-            return
+            return []
 
-        for query in self.queries:
-            self.time(query)
-
-        self.close()
+        try:
+            return [self.time(query, options) for query in self.queries]
+        finally:
+            self.close()
 
-    def time(self, query, iterations=10):
-        times = [None] * iterations
+    def time(self, query, options):
+        for _ in range(options.warmup):
+            self.run(query)
 
-        print(query)
-        for i in range(iterations):
+        times = [None] * options.iterations
+        for i in range(options.iterations):
             start = time.perf_counter()
             self.run(query)
             times[i] = time.perf_counter() - start
 
-        median = statistics.median(times)
-        mean = statistics.mean(times)
-        max_ = max(times)
-        min_ = min(times)
-        print(
-            f"Mean: {mean:.4f} - "
-            f"Median: {median:.4f} - "
-            f"Max: {max_:.4f} - "
-            f"Min: {min_:.4f}"
-        )
-        print('---')
+        alloc_peak = None
+        if options.alloc:
+            # Separate run, tracemalloc slowing allocations down
+            tracemalloc.start()
+            try:
+                self.run(query)
+                _, alloc_peak = tracemalloc.get_traced_memory()
+            finally:
+                tracemalloc.stop()
+            alloc_peak //= 1024
+
+        return self.report(query, times, alloc_peak)
+
+    def report(self, query, times, alloc_peak=None, rss=None):
+        times = sorted(times)
+        p50 = percentile(times, 50)
+        operations = self.operations(query)
+        stats = {
+            'bench': self.name,
+            'driver': self.driver,
+            'query': self.describe(query),
+            'iterations': len(times),
+            'mean': statistics.mean(times),
+            'stdev': statistics.stdev(times) if len(times) > 1 else 0.,
+            'min': times[0],
+            'p50': p50,
+            'p95': percentile(times, 95),
+            'p99': percentile(times, 99),
+            'max': times[-1],
+            'ops': operations / p50 if operations and p50 else None,
+            'unit': self.unit,
+            'alloc_peak_kib': alloc_peak,
+            'max_rss_kib': max_rss() if rss is None else rss,
+        }
+        print_stats(stats)
+        return stats
+
+    def describe(self, query):
+        return query
+
+    def operations(self, query):
+        """Number of operations (rows…) of a run, to report throughput."""
+        return None
 
     def setup(self):
         raise NotImplementedError()
@@ -50,6 +118,25 @@ class Bench:
         raise NotImplementedError()
 
 
+def print_stats(stats):
+    print(stats['query'])
+    print(
+        f"p50: {stats['p50'] * 1000:.3f}ms - "
+        f"p95: {stats['p95'] * 1000:.3f}ms - "
+        f"p99: {stats['p99'] * 1000:.3f}ms - "
+        f"Mean: {stats['mean'] * 1000:.3f}ms "
+        f"(± {stats['stdev'] * 1000:.3f}ms, {stats['iterations']} runs)"
+    )
+    details = []
+    if stats['ops'] is not None:
+        details.append(f"Throughput: {stats['ops']:.0f} {stats['unit']}/s")
+    if stats['alloc_peak_kib'] is not None:
+        details.append(f"Allocated peak: {stats['alloc_peak_kib']} KiB")
+    details.append(f"Peak RSS: {stats['max_rss_kib']} KiB")
+    print(' - '.join(details))
+    print('---')
+
+
 class SlonikMixin:
     driver = 'slonik'
     conn = None
@@ -66,6 +153,25 @@ class SlonikMixin:
         self.conn.close()
 
 
+class SlonikAsyncMixin:
+    driver = 'slonik (async)'
+    conn = None
+    loop = None
+
+    def setup(self):
+        import asyncio
+        import slonik
+
+        self.loop = asyncio.get_event_loop()
+        self.conn = slonik.AsyncConnection.from_env()
+
+        # warmup the connection
+        self.loop.run_until_complete(self.conn.get_one('SELECT 1'))
+
+    def close(self):
+        self.loop.run_until_complete(self.conn.close())
+
+
 class PsycopgMixin:
     driver = 'psycopg2'
     conn = None
@@ -104,6 +210,68 @@ class AsyncpgMixin:
         self.loop.run_until_complete(self.conn.close())
 
 
+# --- Connection latency ---
+
+
+class ConnectBench(Bench):
+    name = 'connect'
+    queries = ['connect, SELECT 1, close']
+
+    def setup(self):
+        self.connect()
+
+    def close(self):
+        pass
+
+
+class SlonikConnectBench(ConnectBench):
+    driver = 'slonik'
+
+    def connect(self):
+        import slonik
+
+        return slonik.Connection.from_env()
+
+    def run(self, query):
+        with self.connect() as conn:
+            conn.get_one('SELECT 1')
+
+
+class PsycopgConnectBench(ConnectBench):
+    driver = 'psycopg2'
+
+    def connect(self):
+        import psycopg2
+
+        return psycopg2.connect
+
+    def run(self, query):
+        conn = self.connect()(host=None)
+        with conn.cursor() as cur:
+            cur.execute('SELECT 1')
+            cur.fetchone()
+        conn.close()
+
+
+class AsyncpgConnectBench(ConnectBench):
+    driver = 'asyncpg'
+
+    def connect(self):
+        import asyncio
+        import asyncpg
+
+        self.loop = asyncio.get_event_loop()
+        return asyncpg.connect
+
+    def run(self, query):
+        async def connect():
+            conn = await self.connect()()
+            await conn.fetch('SELECT 1')
+            await conn.close()
+
+        self.loop.run_until_complete(connect())
+
+
 # --- One row, several columns ---
 
 
@@ -122,6 +290,12 @@ class SlonikColumnsBench(SlonikMixin, ColumnsBench):
         self.conn.get_one(query)
 
 
+class SlonikAsyncColumnsBench(SlonikAsyncMixin, ColumnsBench):
+
+    def run(self, query):
+        self.loop.run_until_complete(self.conn.get_one(query))
+
+
 class PsycopgColumnsBench(PsycopgMixin, ColumnsBench):
 
     def run(self, query):
@@ -143,8 +317,13 @@ class ScrollingBench(Bench):
         'SELECT generate_series(1, 100)',
         'SELECT generate_series(1, 1000)',
         'SELECT generate_series(1, 10000)',
+        'SELECT generate_series(1, 100000)',
+        'SELECT generate_series(1, 1000000)',
     ]
 
+    def operations(self, query):
+        return int(query.rsplit(' ', 1)[1].rstrip(')'))
+
 
 class SlonikScrollingBench(SlonikMixin, ScrollingBench):
 
@@ -153,6 +332,16 @@ class SlonikScrollingBench(SlonikMixin, ScrollingBench):
             pass
 
 
+class SlonikAsyncScrollingBench(SlonikAsyncMixin, ScrollingBench):
+
+    def run(self, query):
+        async def scroll():
+            async for result in self.conn.query(query):
+                pass
+
+        self.loop.run_until_complete(scroll())
+
+
 class PsycopgScrollingBench(PsycopgMixin, ScrollingBench):
 
     def run(self, query):
@@ -168,22 +357,946 @@ class AsyncpgScrollingBench(AsyncpgMixin, ScrollingBench):
         self.loop.run_until_complete(self.conn.fetch(query))
 
 
-# ------
+# --- First row of large results ---
 
 
-if __name__ == '__main__':
-    benches = [
-        ColumnsBench,
-        ScrollingBench,
+class FirstRowBench(Bench):
+    name = 'first row'
+    queries = [
+        'SELECT generate_series(1, 10)',
+        'SELECT generate_series(1, 100000)',
+    ]
+    unit = 'queries'
+
+    def operations(self, query):
+        return 1
+
+
+class SlonikFirstRowBench(SlonikMixin, FirstRowBench):
+
+    def run(self, query):
+        self.conn.get_one(query)
+
+
+class SlonikStreamFirstRowBench(SlonikMixin, FirstRowBench):
+    driver = 'slonik (stream)'
+
+    def run(self, query):
+        self.conn.get_one(query, stream=True)
+
+
+class SlonikTimeoutFirstRowBench(SlonikMixin, FirstRowBench):
+    driver = 'slonik (timeout)'
+
+    def run(self, query):
+        self.conn.get_one(query, timeout=60)
+
+
+class PsycopgFirstRowBench(PsycopgMixin, FirstRowBench):
+
+    def run(self, query):
+        self.cur.execute(query)
+        self.cur.fetchone()
+
+
+# --- Wide rows ---
+
+
+class WideRowsBench(Bench):
+    name = 'wide rows'
+    # 1000 rows of 50 columns of mixed types
+    queries = [
+        'SELECT ' + ', '.join(
+            ['i', 'i::text', 'i::float8', 'i % 2 = 0', "'2000-01-01'::date + i"]
+            * 10
+        ) + ' FROM generate_series(1, 1000) AS i',
+    ]
+
+    def describe(self, query):
+        return '1000 rows of 50 columns (int, text, float, bool, date)'
+
+    def operations(self, query):
+        return 1000
+
+
+class SlonikWideRowsBench(SlonikMixin, WideRowsBench):
+
+    def run(self, query):
+        for result in self.conn.query(query):
+            pass
+
+
+class PsycopgWideRowsBench(PsycopgMixin, WideRowsBench):
+
+    def run(self, query):
+        self.cur.execute(query)
+        for result in self.cur:
+            pass
+
+
+class AsyncpgWideRowsBench(AsyncpgMixin, WideRowsBench):
+
+    def run(self, query):
+        self.loop.run_until_complete(self.conn.fetch(query))
+
+
+# --- Many parameters ---
+
+
+class ManyParamsBench(Bench):
+    name = 'many parameters'
+    # statements of 100 parameters, run 100 times
+    queries = ['int', 'text']
+    nparams = 100
+    repeat = 100
+    unit = 'statements'
+
+    def describe(self, type_):
+        return f'SELECT {self.nparams} {type_} parameters - {self.repeat} times'
+
+    def operations(self, type_):
+        return self.repeat
+
+    def params(self, type_):
+        return [i if type_ == 'int' else f'value {i}'
+                for i in range(self.nparams)]
+
+
+class SlonikManyParamsBench(SlonikMixin, ManyParamsBench):
+
+    def run(self, type_):
+        sql = 'SELECT ' + ', '.join(
+            f'${i + 1}::{type_}' for i in range(self.nparams)
+        )
+        params = self.params(type_)
+        for _ in range(self.repeat):
+            self.conn.get_one(sql, *params)
+
+
+class PsycopgManyParamsBench(PsycopgMixin, ManyParamsBench):
+
+    def run(self, type_):
+        sql = 'SELECT ' + ', '.join(f'%s::{type_}' for _ in range(self.nparams))
+        params = self.params(type_)
+        for _ in range(self.repeat):
+            self.cur.execute(sql, params)
+            self.cur.fetchone()
+
+
+class AsyncpgManyParamsBench(AsyncpgMixin, ManyParamsBench):
+
+    def run(self, type_):
+        sql = 'SELECT ' + ', '.join(
+            f'${i + 1}::{type_}' for i in range(self.nparams)
+        )
+        params = self.params(type_)
+
+        async def select():
+            for _ in range(self.repeat):
+                await self.conn.fetchrow(sql, *params)
+
+        self.loop.run_until_complete(select())
+
+
+# --- Row factories ---
+
+
+class RowFactoryBench(Bench):
+    name = 'row factories'
+    queries = [
+        "SELECT i AS id, 'name ' || i AS name, i / 3.0 AS ratio "
+        "FROM generate_series(1, 10000) AS i",
+    ]
+
+    def operations(self, query):
+        return 10000
+
+
+class SlonikTupleRowBench(SlonikMixin, RowFactoryBench):
+    driver = 'slonik (tuple_row)'
+
+    def run(self, query):
+        for row in self.conn.query(query):
+            pass
+
+
+class SlonikDictRowBench(SlonikMixin, RowFactoryBench):
+    driver = 'slonik (dict_row)'
+
+    def run(self, query):
+        import slonik
+
+        for row in self.conn.query(query, row_factory=slonik.dict_row):
+            pass
+
+
+class SlonikNamedTupleRowBench(SlonikMixin, RowFactoryBench):
+    driver = 'slonik (namedtuple_row)'
+
+    def run(self, query):
+        import slonik
+
+        for row in self.conn.query(query, row_factory=slonik.namedtuple_row):
+            pass
+
+
+class PsycopgDictRowBench(PsycopgMixin, RowFactoryBench):
+    driver = 'psycopg2 (RealDictCursor)'
+
+    def run(self, query):
+        from psycopg2.extras import RealDictCursor
+
+        with self.conn.cursor(cursor_factory=RealDictCursor) as cur:
+            cur.execute(query)
+            for row in cur:
+                pass
+
+
+# --- Decoding per type ---
+
+
+class TypesBench(Bench):
+    name = 'types'
+    # 10000 rows of each type
+    queries = [
+        f"SELECT {value} FROM generate_series(1, 10000) AS i"
+        for value in [
+            'i',
+            'i::int8',
+            'i::float8',
+            'i % 2 = 0',
+            'i::text',
+            'i::numeric / 7',
+            "'2000-01-01'::date + i",
+            "'2000-01-01'::timestamp + i * interval '1 minute'",
+            "'2000-01-01'::timestamptz + i * interval '1 minute'",
+            'md5(i::text)::uuid',
+            "json_build_object('i', i)::jsonb",
+            'ARRAY[i, i + 1, i + 2]',
+        ]
+    ]
+
+    def operations(self, query):
+        return 10000
+
+
+class SlonikTypesBench(SlonikMixin, TypesBench):
+
+    def run(self, query):
+        for result in self.conn.query(query):
+            pass
+
+
+class PsycopgTypesBench(PsycopgMixin, TypesBench):
+
+    def run(self, query):
+        self.cur.execute(query)
+        for result in self.cur:
+            pass
+
+
+class AsyncpgTypesBench(AsyncpgMixin, TypesBench):
+
+    def run(self, query):
+        self.loop.run_until_complete(self.conn.fetch(query))
+
+
+# --- Array parameters ---
+
+
+class ArrayParamBench(Bench):
+    name = 'array parameters'
+    # number of ids looked up with = ANY($1)
+    queries = [100, 1000, 10000]
+    sql = (
+        'SELECT count(*) FROM generate_series(1, 100000) AS i '
+        'WHERE i = ANY({})'
+    )
+
+    def describe(self, count):
+        return f'WHERE id = ANY(list of {count} ids)'
+
+    def operations(self, count):
+        return count
+
+
+class SlonikArrayParamBench(SlonikMixin, ArrayParamBench):
+
+    def run(self, count):
+        self.conn.get_value(self.sql.format('$1'), list(range(count)))
+
+
+class PsycopgArrayParamBench(PsycopgMixin, ArrayParamBench):
+
+    def run(self, count):
+        self.cur.execute(self.sql.format('%s'), (list(range(count)),))
+        self.cur.fetchone()
+
+
+# --- Large values ---
+
+
+class LargeValuesBench(Bench):
+    name = 'large values'
+    # 1000 rows of 40 KB values
+    queries = [
+        "SELECT repeat('x', 40000) FROM generate_series(1, 1000)",
+        "SELECT convert_to(repeat('x', 40000), 'UTF8') "
+        "FROM generate_series(1, 1000)",
+        "SELECT json_build_object('data', repeat('x', 40000))::jsonb "
+        "FROM generate_series(1, 1000)",
+    ]
+
+    def operations(self, query):
+        return 1000
+
+
+class SlonikLargeValuesBench(SlonikMixin, LargeValuesBench):
+
+    def run(self, query):
+        for result in self.conn.query(query):
+            pass
+
+
+class SlonikZeroCopyLargeValuesBench(SlonikMixin, LargeValuesBench):
+    driver = 'slonik (zero copy)'
+
+    def run(self, query):
+        with self.conn.query_result(query, zero_copy=True) as result:
+            for row in result:
+                pass
+
+
+class PsycopgLargeValuesBench(PsycopgMixin, LargeValuesBench):
+
+    def run(self, query):
+        self.cur.execute(query)
+        for result in self.cur:
+            pass
+
+
+# --- Parameterless statements ---
+
+
+class SimpleQueryBench(Bench):
+    name = 'simple query'
+    queries = ["SET application_name = 'bench'", 'SELECT 1']
+    unit = 'statements'
+    # statements run by each run
+    repeat = 1000
+
+    def describe(self, sql):
+        return f'{sql} - {self.repeat} times'
+
+    def operations(self, sql):
+        return self.repeat
+
+
+class SlonikSimpleQueryBench(SlonikMixin, SimpleQueryBench):
+    driver = 'slonik (simple query protocol)'
+
+    def run(self, sql):
+        for _ in range(self.repeat):
+            self.conn.execute_script(sql)
+
+
+class SlonikExtendedQueryBench(SlonikMixin, SimpleQueryBench):
+    driver = 'slonik (extended query protocol)'
+
+    def run(self, sql):
+        for _ in range(self.repeat):
+            self.conn.execute(sql)
+
+
+class PsycopgSimpleQueryBench(PsycopgMixin, SimpleQueryBench):
+
+    def run(self, sql):
+        for _ in range(self.repeat):
+            self.cur.execute(sql)
+
+
+# --- Notifications ---
+
+
+class NotifyBench(Bench):
+    name = 'notify'
+    queries = [
+        "SELECT pg_notify('bench', i::text) FROM generate_series(1, 1000) i",
     ]
+    unit = 'notifications'
+    count = 1000
+
+    def operations(self, sql):
+        return self.count
+
+
+class SlonikNotifyBench(SlonikMixin, NotifyBench):
+
+    def setup(self):
+        super().setup()
+        self.conn.listen('bench')
+
+    def run(self, sql):
+        self.conn.execute(sql)
+        received = 0
+        while received < self.count:
+            received += len(self.conn.notifies(timeout=1))
+
+
+class PsycopgNotifyBench(PsycopgMixin, NotifyBench):
+
+    def setup(self):
+        super().setup()
+        self.conn.rollback()
+        self.conn.autocommit = True
+        self.cur.execute('LISTEN bench')
+
+    def run(self, sql):
+        import select
+
+        self.cur.execute(sql)
+        received = 0
+        while received < self.count:
+            self.conn.poll()
+            received += len(self.conn.notifies)
+            self.conn.notifies.clear()
+            if received < self.count:
+                select.select([self.conn], [], [], 1)
+
+
+# --- Result cache ---
+
+
+class CacheBench(Bench):
+    name = 'cache'
+    queries = ["SELECT $1::int, 'reference data'::text"]
+    unit = 'queries'
+    repeat = 1000
+
+    def describe(self, sql):
+        return f'{sql} - {self.repeat} times'
+
+    def operations(self, sql):
+        return self.repeat
+
+    def setup(self):
+        import slonik
+
+        self.conn = slonik.Connection.from_env(cache=slonik.QueryCache())
+        self.conn.get_one('SELECT 1')
+
+    def close(self):
+        self.conn.close()
+
+
+class SlonikCacheBench(CacheBench):
+    driver = 'slonik'
+
+    def run(self, sql):
+        for _ in range(self.repeat):
+            self.conn.get_one(sql, 42)
+
+
+class SlonikCachedBench(CacheBench):
+    driver = 'slonik (cached)'
+
+    def run(self, sql):
+        for _ in range(self.repeat):
+            self.conn.get_one(sql, 42, cache_ttl=60)
+
+
+# --- Instrumentation overhead ---
+
+
+class InstrumentationBench(Bench):
+    name = 'instrumentation'
+    queries = ['SELECT 1', 'SELECT generate_series(1, 10000)']
+    instrument = False
+
+    def setup(self):
+        import slonik
+
+        self.conn = slonik.Connection.from_env(instrument=self.instrument)
+        self.conn.get_one('SELECT 1')
+
+    def run(self, query):
+        for result in self.conn.query(query):
+            pass
+
+    def close(self):
+        self.conn.close()
+
+
+class SlonikInstrumentationBench(InstrumentationBench):
+    driver = 'slonik'
+
+
+class SlonikInstrumentedBench(InstrumentationBench):
+    driver = 'slonik (instrumented)'
+    instrument = True
+
+
+# --- Python-side overhead of native calls ---
+
+
+class CallOverheadBench(Bench):
+    name = 'call overhead'
+    # native functions without I/O, one returning a plain value and one an
+    # FFIResult
+    queries = ['transaction_depth', 'transaction_begin + transaction_rollback']
+    unit = 'calls'
+    repeat = 100000
+
+    def describe(self, funcs):
+        return f'{funcs} - {self.repeat} times'
+
+    def operations(self, funcs):
+        return self.repeat * len(funcs.split(' + '))
+
+    def setup(self):
+        import slonik
+
+        self.conn = slonik.Connection.from_env()
+        self.conn.get_one('SELECT 1')
+
+    def close(self):
+        self.conn.close()
+
+
+class SlonikCallOverheadBench(CallOverheadBench):
+    driver = 'slonik (RustObject methods)'
+
+    def run(self, func):
+        conn = self.conn._conn
+        if func == 'transaction_depth':
+            for _ in range(self.repeat):
+                conn.transaction_depth()
+        else:
+            for _ in range(self.repeat):
+                conn.transaction_begin((-1, -1, -1))
+                conn.transaction_rollback()
+
+
+class RawCallOverheadBench(CallOverheadBench):
+    driver = 'cffi (no wrapper, baseline)'
+
+    def run(self, func):
+        from slonik._native import lib
+
+        ptr = self.conn._conn._objptr
+        if func == 'transaction_depth':
+            for _ in range(self.repeat):
+                lib.transaction_depth(ptr)
+        else:
+            for _ in range(self.repeat):
+                lib.transaction_begin(ptr, (-1, -1, -1))
+                lib.transaction_rollback(ptr)
+
+
+# --- Bulk inserts ---
+
+
+class ExecuteManyBench(Bench):
+    name = 'executemany'
+    # number of inserted rows
+    queries = [100, 1000, 10000]
+
+    def describe(self, nrows):
+        return f'INSERT {nrows} rows (int, text, float)'
+
+    def operations(self, nrows):
+        return nrows
+
+    def rows(self, nrows):
+        return [(i, f'name {i}', i / 3) for i in range(nrows)]
+
+
+class SlonikExecuteManyBench(SlonikMixin, ExecuteManyBench):
+
+    def setup(self):
+        super().setup()
+        self.conn.execute(
+            'CREATE TEMPORARY TABLE bench_many(id int, name text, value float)'
+        )
+
+    def run(self, nrows):
+        self.conn.executemany(
+            'INSERT INTO bench_many(id, name, value) VALUES ($1, $2, $3)',
+            self.rows(nrows),
+        )
+
+
+class PsycopgExecuteManyBench(PsycopgMixin, ExecuteManyBench):
+    driver = 'psycopg2 (execute_values)'
+
+    def setup(self):
+        super().setup()
+        self.cur.execute(
+            'CREATE TEMPORARY TABLE bench_many(id int, name text, value float)'
+        )
+
+    def run(self, nrows):
+        from psycopg2.extras import execute_values
+
+        execute_values(
+            self.cur, 'INSERT INTO bench_many(id, name, value) VALUES %s',
+            self.rows(nrows), page_size=1000,
+        )
+
+
+# --- Thread scaling ---
+
+
+class ThreadsBench(Bench):
+    name = 'threads'
+    queries = [
+        (threads, query)
+        for query in ['SELECT pg_sleep(0.01)', 'SELECT 1']
+        for threads in [1, 2, 4, 8, 16]
+    ]
+    # queries run by every thread, each thread having its own connection
+    repeat = 20
+
+    def describe(self, query):
+        threads, sql = query
+        total = threads * self.repeat
+        return f'{sql} - {threads} threads, {total} queries'
+
+    def setup(self):
+        threads = max(threads for threads, _ in self.queries)
+        self.conns = [self.connect() for _ in range(threads)]
+
+    def run(self, query):
+        threads, sql = query
+        workers = [
+            threading.Thread(target=self.work, args=(conn, sql))
+            for conn in self.conns[:threads]
+        ]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+
+    def close(self):
+        for conn in self.conns:
+            conn.close()
+
+
+class SlonikThreadsBench(ThreadsBench):
+    driver = 'slonik'
+
+    def connect(self):
+        import slonik
+
+        return slonik.Connection.from_env()
+
+    def work(self, conn, sql):
+        for _ in range(self.repeat):
+            conn.get_one(sql)
+
+
+class PsycopgThreadsBench(ThreadsBench):
+    driver = 'psycopg2'
+
+    def connect(self):
+        import psycopg2
+
+        return psycopg2.connect(host=None)
+
+    def work(self, conn, sql):
+        with conn.cursor() as cur:
+            for _ in range(self.repeat):
+                cur.execute(sql)
+                cur.fetchone()
+
+
+# --- Pool contention ---
+
+
+class PoolBench(Bench):
+    name = 'pool'
+    # number of threads sharing the pool
+    queries = [1, 4, 16, 64]
+    max_size = 4
+    checkouts = 100
+
+    def describe(self, threads):
+        return (
+            f'{threads} threads, {self.checkouts} checkouts each, '
+            f'{self.max_size} connections'
+        )
+
+    def run(self, threads):
+        workers = [threading.Thread(target=self.work) for _ in range(threads)]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+
+
+class SlonikPoolBench(PoolBench):
+    driver = 'slonik'
+
+    def setup(self):
+        import slonik
+
+        self.pool = slonik.Pool.from_env(
+            min_size=self.max_size, max_size=self.max_size,
+        )
+
+    def work(self):
+        for _ in range(self.checkouts):
+            with self.pool.connection() as conn:
+                conn.get_one('SELECT 1')
+
+    def close(self):
+        self.pool.close()
+
+
+class PsycopgPoolBench(PoolBench):
+    driver = 'psycopg2'
+
+    def setup(self):
+        from psycopg2.pool import ThreadedConnectionPool
+
+        self.pool = ThreadedConnectionPool(
+            self.max_size, self.max_size, host=None,
+        )
+        self.semaphore = threading.BoundedSemaphore(self.max_size)
+
+    def work(self):
+        for _ in range(self.checkouts):
+            # ThreadedConnectionPool raises instead of waiting when exhausted
+            with self.semaphore:
+                conn = self.pool.getconn()
+                try:
+                    with conn.cursor() as cur:
+                        cur.execute('SELECT 1')
+                        cur.fetchone()
+                finally:
+                    self.pool.putconn(conn)
+
+    def close(self):
+        self.pool.closeall()
+
+
+# --- Peak memory while scrolling big results ---
+
+
+class MemoryBench(Bench):
+    name = 'memory'
+    queries = [
+        'SELECT generate_series(1, 100000)',
+        'SELECT generate_series(1, 1000000)',
+    ]
+
+    def __call__(self, options):
+        results = []
+        for query in self.queries:
+            stats = self.time(query, options)
+            if stats is None:
+                print(f'Driver {self.driver} not installed, skipping…')
+                break
+            results.append(stats)
+        return results
+
+    def time(self, query, options):
+        # ru_maxrss is a high-water mark, so every query runs once in a fresh
+        # process that reports its peak RSS
+        context = multiprocessing.get_context('fork')
+        queue = context.Queue()
+        process = context.Process(target=self.measure, args=(query, queue))
+        process.start()
+        result = queue.get()
+        process.join()
+
+        if result is None:
+            return None
+        elapsed, rss = result
+        return self.report(query, [elapsed], rss=rss)
+
+    def measure(self, query, queue):
+        try:
+            self.setup()
+        except ImportError:
+            queue.put(None)
+            return
+
+        start = time.perf_counter()
+        self.run(query)
+        elapsed = time.perf_counter() - start
+        rss = max_rss()
+
+        self.close()
+        queue.put((elapsed, rss))
+
+
+class SlonikMemoryBench(SlonikMixin, MemoryBench):
+
+    def run(self, query):
+        for result in self.conn.query(query):
+            pass
+
+
+class SlonikStreamMemoryBench(SlonikMixin, MemoryBench):
+    driver = 'slonik (stream)'
+
+    def run(self, query):
+        for result in self.conn.stream(query, batch_rows=1000):
+            pass
+
+
+class PsycopgMemoryBench(PsycopgMixin, MemoryBench):
+    driver = 'psycopg2 (named cursor)'
+
+    def run(self, query):
+        with self.conn.cursor(name='bench') as cur:
+            cur.itersize = 1000
+            cur.execute(query)
+            for result in cur:
+                pass
+
+
+# ------
+
+
+BENCHES = [
+    ConnectBench,
+    ColumnsBench,
+    ScrollingBench,
+    FirstRowBench,
+    WideRowsBench,
+    RowFactoryBench,
+    TypesBench,
+    LargeValuesBench,
+    ArrayParamBench,
+    ManyParamsBench,
+    SimpleQueryBench,
+    NotifyBench,
+    CacheBench,
+    InstrumentationBench,
+    CallOverheadBench,
+    ExecuteManyBench,
+    ThreadsBench,
+    PoolBench,
+    MemoryBench,
+]
+
+
+def run(options):
+    results = []
+    for bench in BENCHES:
+        if options.bench and bench.name not in options.bench:
+            continue
 
-    for bench in benches:
         print("-" * 80)
         print(f"Running benchmark {bench.name}")
 
         for cls in bench.__subclasses__():
+            if options.driver and not any(
+                driver in cls.driver for driver in options.driver
+            ):
+                continue
             print()
             print(f"With {cls.driver}")
             print()
             instance = cls()
-            instance()
+            results.extend(instance(options))
+
+    if options.json:
+        with open(options.json, 'w') as f:
+            json.dump({
+                'python': platform.python_version(),
+                'platform': platform.platform(),
+                'date': time.strftime('%Y-%m-%dT%H:%M:%S'),
+                'iterations': options.iterations,
+                'warmup': options.warmup,
+                'results': results,
+            }, f, indent=2)
+
+
+def compare(options):
+    """Compare the scenarios of two JSON runs, returning whether none got
+    slower than the threshold, nor can't be compared: missing from the
+    current run, or timed at 0 in the baseline."""
+    def load(path):
+        with open(path) as f:
+            return {
+                (stats['bench'], stats['driver'], stats['query']): stats
+                for stats in json.load(f)['results']
+            }
+
+    baseline, current = map(load, options.compare)
+    metric = options.metric
+    ok = True
+    for key, stats in current.items():
+        if key not in baseline:
+            continue
+        before, after = baseline[key][metric], stats[metric]
+        bench, driver, query = key
+        if not before:
+            # No change can be computed from it, the baseline is broken
+            ok = False
+            print(
+                f"{'ZERO':6} {'':8} {before * 1000:9.3f}ms -> "
+                f"{after * 1000:9.3f}ms  {bench} / {driver} / {query}"
+            )
+            continue
+        change = (after - before) / before * 100
+        slower = change > options.threshold
+        ok = ok and not slower
+        print(
+            f"{'SLOWER' if slower else 'ok':6} {change:+7.1f}% "
+            f"{before * 1000:9.3f}ms -> {after * 1000:9.3f}ms  "
+            f"{bench} / {driver} / {query}"
+        )
+
+    # A scenario that stopped running (e.g. failing) is no improvement
+    for key in sorted(baseline.keys() - current.keys()):
+        ok = False
+        bench, driver, query = key
+        print(
+            f"{'MISSING':6} {'':7} {baseline[key][metric] * 1000:9.3f}ms -> "
+            f"{'':9}    {bench} / {driver} / {query}"
+        )
+    return ok
+
+
+def parse_args(args=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument(
+        '-b', '--bench', action='append',
+        help='run this benchmark only (repeatable): '
+        + ', '.join(bench.name for bench in BENCHES),
+    )
+    parser.add_argument(
+        '-d', '--driver', action='append',
+        help='run the drivers whose name contains this only (repeatable)',
+    )
+    parser.add_argument('-n', '--iterations', type=int, default=20)
+    parser.add_argument('-w', '--warmup', type=int, default=2)
+    parser.add_argument(
+        '--no-alloc', dest='alloc', action='store_false',
+        help="don't measure allocations with tracemalloc",
+    )
+    parser.add_argument('--json', help='write the results to this file')
+    parser.add_argument(
+        '--compare', nargs=2, metavar=('BASELINE', 'CURRENT'),
+        help='compare two JSON results instead of running benchmarks',
+    )
+    parser.add_argument(
+        '--threshold', type=float, default=10.,
+        help='slowdown percentage failing the comparison (default: 10)',
+    )
+    parser.add_argument(
+        '--metric', default='p50', choices=['p50', 'p95', 'p99', 'mean'],
+        help='timing compared (default: p50)',
+    )
+    return parser.parse_args(args)
+
+
+if __name__ == '__main__':
+    options = parse_args()
+    if options.compare:
+        sys.exit(0 if compare(options) else 1)
+    run(options)
@@ -23,4 +23,10 @@ impl Buffer {
     pub unsafe fn to_str(&self) -> &str {
         str::from_utf8_unchecked(slice::from_raw_parts(self.bytes as *const _, self.size))
     }
+    pub unsafe fn as_bytes(&self) -> &[u8] {
+        if self.bytes.is_null() {
+            return &[];
+        }
+        slice::from_raw_parts(self.bytes, self.size)
+    }
 }
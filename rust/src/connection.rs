@@ -1,12 +1,34 @@
 extern crate postgres;
 
+use std::cell::{Cell, RefCell};
+use std::collections::{BTreeMap, HashMap};
+use std::io::{self, Read, Write};
+use std::net::TcpStream;
 use std::os::raw::c_char;
+use std::os::unix::net::UnixStream;
+use std::rc::Rc;
 use std::slice;
 use std::str;
+use std::time::Duration;
 
-pub use postgres::{Connection, TlsMode};
+use fallible_iterator::FallibleIterator;
+pub use postgres::{CancelData, Connection, TlsMode};
+use postgres::error::FEATURE_NOT_SUPPORTED;
+use postgres::notification::Notification;
+use postgres::params::{Host, IntoConnectParams};
+use postgres::stmt::Statement;
+use buffer::*;
+use error::*;
 use result::*;
 use opaque::*;
+use sql::*;
+use transaction::*;
+
+
+pub const DEFAULT_STATEMENT_CACHE_SIZE: usize = 100;
+
+// Longest wait for the server to process a CancelRequest
+const CANCEL_TIMEOUT: Duration = Duration::from_secs(10);
 
 
 #[no_mangle]
@@ -16,15 +38,361 @@ pub struct _Connection;
 pub struct _Query;
 
 
+/// LRU cache of prepared statements, keyed by their SQL.
+pub struct StatementCache {
+    pub capacity: usize,
+    pub hits: u64,
+    pub misses: u64,
+    tick: u64,
+    statements: HashMap<String, (Rc<Statement<'static>>, u64)>,
+    // Queries by tick of their last use, least recently used first
+    order: BTreeMap<u64, String>,
+}
+
+impl StatementCache {
+    pub fn new(capacity: usize) -> Self {
+        Self{
+            capacity, hits: 0, misses: 0, tick: 0,
+            statements: HashMap::new(), order: BTreeMap::new(),
+        }
+    }
+
+    pub fn len(&self) -> usize {
+        self.statements.len()
+    }
+
+    pub fn get(&mut self, query: &str) -> Option<Rc<Statement<'static>>> {
+        self.tick += 1;
+        match self.statements.get_mut(query) {
+            Some(entry) => {
+                self.hits += 1;
+                let query = self.order.remove(&entry.1).unwrap();
+                self.order.insert(self.tick, query);
+                entry.1 = self.tick;
+                Some(entry.0.clone())
+            }
+            None => {
+                self.misses += 1;
+                None
+            }
+        }
+    }
+
+    pub fn insert(&mut self, query: &str, stmt: Rc<Statement<'static>>) {
+        if self.capacity == 0 {
+            return;
+        }
+        self.remove(query);
+        self.resize(self.capacity - 1);
+        self.tick += 1;
+        self.statements.insert(query.to_string(), (stmt, self.tick));
+        self.order.insert(self.tick, query.to_string());
+    }
+
+    /// Evict the statement of `query`, returning whether it was cached.
+    pub fn remove(&mut self, query: &str) -> bool {
+        match self.statements.remove(query) {
+            Some((_, tick)) => {
+                self.order.remove(&tick);
+                true
+            }
+            None => false,
+        }
+    }
+
+    /// Evict the least recently used statements until at most `size` are
+    /// left. Dropping the last reference to a statement deallocates it on the
+    /// server.
+    pub fn resize(&mut self, size: usize) {
+        while self.statements.len() > size {
+            let oldest = *self.order.keys().next().unwrap();
+            let query = self.order.remove(&oldest).unwrap();
+            self.statements.remove(&query);
+        }
+    }
+}
+
+
+pub struct Conn {
+    // Dropped before the connection they borrow, open transactions being
+    // rolled back first
+    pub transactions: RefCell<Transactions>,
+    pub statements: RefCell<StatementCache>,
+    // Number of open streams, which hold the innermost transaction
+    pub streams: Cell<usize>,
+    // Whether a transaction block was opened by a statement such as BEGIN
+    pub untracked: Cell<bool>,
+    // Notifications handed out by the last call to notifies
+    pub received: RefCell<Vec<Notification>>,
+    pub conn: Box<Connection>,
+}
+
+impl Conn {
+    pub fn new(conn: Connection) -> Self {
+        let statements = StatementCache::new(DEFAULT_STATEMENT_CACHE_SIZE);
+        Self{
+            transactions: RefCell::new(Transactions::new()),
+            statements: RefCell::new(statements),
+            streams: Cell::new(0),
+            untracked: Cell::new(false),
+            received: RefCell::new(vec![]),
+            conn: Box::new(conn),
+        }
+    }
+
+    /// Prepare `query`, or get it from the statement cache.
+    pub fn prepare(&self, query: &str) -> Result<Rc<Statement<'static>>, postgres::Error> {
+        let mut statements = self.statements.borrow_mut();
+        if let Some(stmt) = statements.get(query) {
+            return Ok(stmt);
+        }
+
+        // The connection is boxed and outlives its statement cache
+        let conn = unsafe { &*(self.conn.as_ref() as *const Connection) };
+        let stmt = Rc::new(conn.prepare(query)?);
+        statements.insert(query, stmt.clone());
+        Ok(stmt)
+    }
+
+    /// Evict the cached statement of `query` if `error` says its result type
+    /// changed, e.g. after ALTER TABLE: it would fail with
+    /// feature_not_supported until prepared again. Returns whether it was.
+    pub fn evict_stale(&self, query: &str, error: &postgres::Error) -> bool {
+        if error.code() != Some(&FEATURE_NOT_SUPPORTED) {
+            return false;
+        }
+        self.statements.borrow_mut().remove(query)
+    }
+
+    /// Run `run` with the prepared statement of `query`, prepared again and
+    /// run once more if the cached one went stale. Within transactions the
+    /// failure aborted, the statement is only evicted.
+    pub fn with_statement<T, F>(&self, query: &str, run: F) -> Result<T, Error>
+        where F: Fn(&Statement<'static>) -> Result<T, postgres::Error>
+    {
+        let stmt = self.prepare(query)?;
+        let error = match run(&stmt) {
+            Ok(value) => return Ok(value),
+            Err(error) => error,
+        };
+        drop(stmt);
+        let retry = self.transactions.borrow().depth() == 0 && self.conn.is_active();
+        if self.evict_stale(query, &error) && retry {
+            let stmt = self.prepare(query)?;
+            return Ok(run(&stmt)?);
+        }
+        Err(error.into())
+    }
+
+    /// Follow the transaction blocks opened or ended by the statements of
+    /// `query` (e.g. BEGIN, COMMIT), which rust-postgres doesn't know about,
+    /// once run, `ok` telling whether they all succeeded.
+    pub fn track_transaction(&self, query: &str, ok: bool) {
+        if self.transactions.borrow().depth() > 0 {
+            return;
+        }
+        let mut untracked = self.untracked.get();
+        for statement in statements(query) {
+            match transaction_control(statement) {
+                Some(opens) if ok => untracked = opens,
+                // Those before the failing one may have opened a block
+                Some(true) => untracked = true,
+                _ => {}
+            }
+        }
+        self.untracked.set(untracked);
+    }
+
+    /// Receive up to `size` notifications, waiting for the first one for at
+    /// most `timeout` (forever if None) when none is pending.
+    pub fn receive(&self, received: &mut Vec<Notification>, timeout: Option<Duration>, size: usize) -> Result<(), Error> {
+        if size == 0 {
+            return Ok(());
+        }
+
+        let notifications = self.conn.notifications();
+        let first = match notifications.iter().next()? {
+            Some(notification) => Some(notification),
+            None => match timeout {
+                Some(timeout) if timeout == Duration::from_millis(0) => None,
+                Some(timeout) => notifications.timeout_iter(timeout).next()?,
+                None => notifications.blocking_iter().next()?,
+            },
+        };
+        match first {
+            Some(notification) => received.push(notification),
+            None => return Ok(()),
+        }
+
+        // Then those which came along, without blocking
+        let mut pending = notifications.iter();
+        while received.len() < size {
+            match pending.next()? {
+                Some(notification) => received.push(notification),
+                None => break,
+            }
+        }
+        Ok(())
+    }
+}
+
+impl std::ops::Deref for Conn {
+    type Target = Connection;
+    fn deref(&self) -> &Connection {
+        &self.conn
+    }
+}
+
+
+#[no_mangle]
+#[repr(C)]
+#[derive(Copy, Clone, Debug)]
+pub struct StatementCacheStats {
+    pub capacity: usize,
+    pub size: usize,
+    pub hits: u64,
+    pub misses: u64,
+}
+
+
+/// A notification, its strings pointing into the connection until the next
+/// call to notifies.
+#[no_mangle]
+#[repr(C)]
+#[derive(Copy, Clone, Debug)]
+pub struct NotificationItem {
+    pub process_id: i32,
+    pub channel: Buffer,
+    pub payload: Buffer,
+}
+
+
+/// What a CancelRequest needs to cancel the statement running on a
+/// connection.
+#[no_mangle]
+#[repr(C)]
+#[derive(Copy, Clone, Debug)]
+pub struct CancelKey {
+    pub process_id: i32,
+    pub secret_key: i32,
+}
+
+
 #[no_mangle]
 pub unsafe extern "C" fn connect(dsn: *const c_char, len: usize) -> FFIResult<_Connection> {
     let dsn_str = str::from_utf8_unchecked(slice::from_raw_parts(dsn as *const _, len));
-    FFIResult::from_result(Connection::connect(dsn_str, TlsMode::None))
+    FFIResult::from_result(Connection::connect(dsn_str, TlsMode::None).map(Conn::new))
 }
 
 
+/// Close the connection, unless streams still borrow it.
 #[no_mangle]
-pub unsafe extern "C" fn close(conn: *mut _Connection) {
-    let conn = OpaquePtr::<Connection>::from_opaque(conn);
+pub unsafe extern "C" fn close(conn: *mut _Connection) -> FFIResult<u8> {
+    let conn = OpaquePtr::<Conn>::from_opaque(conn);
+    if conn.streams.get() > 0 {
+        return FFIResult::from_error(Error::new("cannot close a connection while a stream is open"));
+    }
     conn.free();
+    FFIResult::ok()
+}
+
+
+#[no_mangle]
+pub unsafe extern "C" fn cancel_key(conn: *mut _Connection) -> CancelKey {
+    let conn = OpaquePtr::<Conn>::from_opaque(conn);
+    let data = conn.cancel_data();
+    CancelKey{process_id: data.process_id, secret_key: data.secret_key}
+}
+
+
+/// Send a CancelRequest for `data` to the server of `dsn`, then wait for the
+/// server to close the socket, as libpq does: the backend has been signaled
+/// by then, so the request can't land on a statement sent afterwards.
+/// postgres::cancel_query returns as soon as the request is written.
+pub fn cancel_query(dsn: &str, data: &CancelData) -> io::Result<()> {
+    let params = dsn.into_connect_params()
+        .map_err(|error| io::Error::new(io::ErrorKind::InvalidInput, error))?;
+    let port = params.port();
+    match *params.host() {
+        Host::Tcp(ref host) => {
+            let socket = TcpStream::connect((host.as_str(), port))?;
+            socket.set_read_timeout(Some(CANCEL_TIMEOUT))?;
+            send_cancel(socket, data)
+        }
+        Host::Unix(ref dir) => {
+            let socket = UnixStream::connect(dir.join(format!(".s.PGSQL.{}", port)))?;
+            socket.set_read_timeout(Some(CANCEL_TIMEOUT))?;
+            send_cancel(socket, data)
+        }
+    }
+}
+
+fn send_cancel<S: Read + Write>(mut socket: S, data: &CancelData) -> io::Result<()> {
+    // Length, cancel request code, then the key of the backend
+    let mut request = Vec::with_capacity(16);
+    for value in &[16, 80877102, data.process_id, data.secret_key] {
+        request.extend_from_slice(&value.to_be_bytes());
+    }
+    socket.write_all(&request)?;
+    // The server answers nothing, only closing the socket
+    socket.read_to_end(&mut vec![])?;
+    Ok(())
+}
+
+
+/// Send a CancelRequest for the connection of `key` on a new socket to the
+/// server of `dsn`, returning once the server processed it. This doesn't
+/// touch the connection itself, so it can be called from any thread while a
+/// statement blocks it.
+#[no_mangle]
+pub unsafe extern "C" fn cancel(dsn: *const c_char, len: usize, key: CancelKey) -> FFIResult<u8> {
+    let dsn_str = str::from_utf8_unchecked(slice::from_raw_parts(dsn as *const _, len));
+    let data = CancelData{process_id: key.process_id, secret_key: key.secret_key};
+    FFIResult::from_status(cancel_query(dsn_str, &data))
+}
+
+
+#[no_mangle]
+pub unsafe extern "C" fn statement_cache_resize(conn: *mut _Connection, capacity: usize) {
+    let conn = OpaquePtr::<Conn>::from_opaque(conn);
+    let mut statements = conn.statements.borrow_mut();
+    statements.capacity = capacity;
+    statements.resize(capacity);
+}
+
+
+#[no_mangle]
+pub unsafe extern "C" fn statement_cache_stats(conn: *mut _Connection) -> StatementCacheStats {
+    let conn = OpaquePtr::<Conn>::from_opaque(conn);
+    let statements = conn.statements.borrow();
+    StatementCacheStats{
+        capacity: statements.capacity,
+        size: statements.len(),
+        hits: statements.hits,
+        misses: statements.misses,
+    }
+}
+
+
+/// Fill `items` with up to `size` notifications, waiting up to `timeout_ms`
+/// milliseconds (forever if negative) for the first one, and set `count` to
+/// the number of items filled.
+#[no_mangle]
+pub unsafe extern "C" fn notifies(conn: *mut _Connection, timeout_ms: i64, items: *mut NotificationItem, size: usize, count: *mut usize) -> FFIResult<u8> {
+    let conn = OpaquePtr::<Conn>::from_opaque(conn);
+    let timeout = if timeout_ms < 0 { None } else { Some(Duration::from_millis(timeout_ms as u64)) };
+    let mut received = conn.received.borrow_mut();
+    received.clear();
+    let result = conn.receive(&mut received, timeout, size);
+
+    let items = slice::from_raw_parts_mut(items, size);
+    for (item, notification) in items.iter_mut().zip(received.iter()) {
+        *item = NotificationItem{
+            process_id: notification.process_id,
+            channel: Buffer::from_str(&notification.channel),
+            payload: Buffer::from_str(&notification.payload),
+        };
+    }
+    *count = received.len();
+    FFIResult::from_status(result)
 }
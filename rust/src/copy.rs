@@ -0,0 +1,87 @@
+use std::io;
+use std::io::{Read, Write};
+use std::os::raw::c_void;
+
+use error::*;
+use opaque::*;
+use result::*;
+use query::*;
+
+
+/// Fill the buffer with the next data to copy in, returning how many bytes
+/// were written (0 at the end of the data) or -1 on error.
+pub type ReadCallback = extern "C" fn(ctx: *mut c_void, buf: *mut u8, size: usize) -> isize;
+
+/// Consume a chunk of copied out data, returning -1 on error.
+pub type WriteCallback = extern "C" fn(ctx: *mut c_void, buf: *const u8, size: usize) -> isize;
+
+
+pub struct CallbackReader {
+    read: ReadCallback,
+    ctx: *mut c_void,
+}
+
+impl Read for CallbackReader {
+    fn read(&mut self, buf: &mut [u8]) -> io::Result<usize> {
+        match (self.read)(self.ctx, buf.as_mut_ptr(), buf.len()) {
+            size if size < 0 => Err(io::Error::new(io::ErrorKind::Other, "COPY data source failed")),
+            size => Ok(size as usize),
+        }
+    }
+}
+
+
+pub struct CallbackWriter {
+    write: WriteCallback,
+    ctx: *mut c_void,
+}
+
+impl Write for CallbackWriter {
+    fn write(&mut self, buf: &[u8]) -> io::Result<usize> {
+        match (self.write)(self.ctx, buf.as_ptr(), buf.len()) {
+            size if size < 0 => Err(io::Error::new(io::ErrorKind::Other, "COPY data sink failed")),
+            _ => Ok(buf.len()),
+        }
+    }
+
+    fn flush(&mut self) -> io::Result<()> {
+        Ok(())
+    }
+}
+
+
+impl<'a> Query<'a> {
+    pub fn copy_in<R: Read>(&self, reader: &mut R) -> Result<u64, Error> {
+        self.conn.start_transaction()?;
+        let params = self.sql_params();
+        let stmt = self.conn.prepare(&self.query)?;
+        Ok(stmt.copy_in(params.as_slice(), reader)?)
+    }
+
+    pub fn copy_out<W: Write>(&self, writer: &mut W) -> Result<u64, Error> {
+        self.conn.start_transaction()?;
+        let params = self.sql_params();
+        let stmt = self.conn.prepare(&self.query)?;
+        Ok(stmt.copy_out(params.as_slice(), writer)?)
+    }
+}
+
+
+/// Run a `COPY ... FROM STDIN` query, pulling its data from `read`.
+#[no_mangle]
+pub unsafe extern "C" fn query_copy_in(query: *mut _Query, read: ReadCallback, ctx: *mut c_void) -> FFIResult<u8> {
+    let query = OpaquePtr::<Query>::from_opaque(query);
+    let result = query.copy_in(&mut CallbackReader{read, ctx}).map(|_| ());
+    query.free();
+    FFIResult::from_status(result)
+}
+
+
+/// Run a `COPY ... TO STDOUT` query, pushing its data to `write`.
+#[no_mangle]
+pub unsafe extern "C" fn query_copy_out(query: *mut _Query, write: WriteCallback, ctx: *mut c_void) -> FFIResult<u8> {
+    let query = OpaquePtr::<Query>::from_opaque(query);
+    let result = query.copy_out(&mut CallbackWriter{write, ctx}).map(|_| ());
+    query.free();
+    FFIResult::from_status(result)
+}
@@ -1,11 +1,36 @@
 use opaque::*;
 use buffer::*;
 
+#[derive(Debug)]
 pub struct Error {
     pub code: u8,
     pub msg: String,
 }
 
+impl Error {
+    pub fn new(msg: &str) -> Self {
+        Self { code: 1, msg: msg.to_string() }
+    }
+}
+
+impl std::fmt::Display for Error {
+    fn fmt(&self, f: &mut std::fmt::Formatter) -> std::fmt::Result {
+        write!(f, "{}", self.msg)
+    }
+}
+
+impl std::error::Error for Error {
+    fn description(&self) -> &str {
+        &self.msg
+    }
+}
+
+impl From<postgres::Error> for Error {
+    fn from(error: postgres::Error) -> Self {
+        Self { code: 1, msg: format!("{}", error) }
+    }
+}
+
 #[no_mangle]
 pub struct _Error;
 
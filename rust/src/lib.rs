@@ -1,9 +1,13 @@
 extern crate postgres;
+extern crate fallible_iterator;
 
 pub mod buffer;
 pub mod opaque;
 pub mod error;
 pub mod result;
 pub mod connection;
+pub mod transaction;
 pub mod query;
 pub mod row;
+pub mod copy;
+pub mod sql;
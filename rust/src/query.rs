@@ -1,8 +1,15 @@
 use std::os::raw::c_char;
+use std::rc::Rc;
 use std::slice;
 use std::str;
 
+use fallible_iterator::FallibleIterator;
+use postgres::rows::{LazyRows, Row};
+use postgres::stmt::Statement;
+use postgres::transaction::Transaction;
+
 use opaque::*;
+use error::*;
 use result::*;
 use buffer::*;
 use connection::*;
@@ -15,93 +22,135 @@ pub struct _Query;
 #[no_mangle]
 pub struct _QueryResult;
 
-
 #[no_mangle]
-#[repr(C)]
-#[derive(Copy, Clone, Debug)]
-pub struct QueryParam {
-    pub typename: Buffer,
-    pub value: Buffer,
-}
-
-pub trait ParamType {
-    const name: &'static str;
-}
-
-macro_rules! get_typed_param {
-    ($typename: expr, $value: expr) => {
-        {
-            #[derive(Copy, Clone, Debug)]
-            struct _ParamType {}
-            impl ParamType for _ParamType {
-                const name: &'static str = $typename;
-            }
-            Box::new(TypedQueryParam::<_ParamType>::new($value))
-        }
-    }
-}
+pub struct _QueryStream;
 
-impl QueryParam {
-    pub unsafe fn typed_param(&self) -> Box<postgres::types::ToSql> {
-        match self.typename.to_str() {
-            "text" => get_typed_param!("text", self.value),
-            "int4" => get_typed_param!("int4", self.value),
-            "float8" => get_typed_param!("float8", self.value),
-            _ => {
-                println!("unknown type: {:?}", self.typename.to_str());
-                get_typed_param!("", self.value)
-            },
-        }
-    }
-}
 
+/// A parameter already encoded in the binary format of the type described by
+/// the server, with a null value for NULL.
 #[no_mangle]
 #[repr(C)]
 #[derive(Copy, Clone, Debug)]
-pub struct TypedQueryParam<T: ParamType + std::fmt::Debug> {
+pub struct QueryParam {
     pub value: Buffer,
-    phantom: std::marker::PhantomData<T>,
 }
-impl<T: ParamType + std::fmt::Debug> TypedQueryParam<T> {
-    pub fn new(value: Buffer) -> Self {
-        Self{value, phantom: std::marker::PhantomData}
-    }
-}
-impl<T: ParamType + std::fmt::Debug> postgres::types::ToSql for TypedQueryParam<T> {
-    fn to_sql(&self, ty: &postgres::types::Type, out: &mut Vec<u8>) -> Result<postgres::types::IsNull, Box<std::error::Error + 'static + Send + Sync>> {
-        for i in 0..self.value.size {
-            out.push(unsafe { *self.value.bytes.offset(i as isize) });
+
+impl postgres::types::ToSql for QueryParam {
+    fn to_sql(&self, _ty: &postgres::types::Type, out: &mut Vec<u8>) -> Result<postgres::types::IsNull, Box<std::error::Error + 'static + Send + Sync>> {
+        if self.value.bytes.is_null() {
+            return Ok(postgres::types::IsNull::Yes);
         }
+        out.extend_from_slice(unsafe { self.value.as_bytes() });
         Ok(postgres::types::IsNull::No)
     }
 
-    fn accepts(ty: &postgres::types::Type) -> bool {
-        ty.name() == T::name
+    // The encoding is picked from the parameter types on the Python side
+    fn accepts(_ty: &postgres::types::Type) -> bool {
+        true
     }
 
     postgres::to_sql_checked!();
 }
 
 pub struct Query<'a> {
-    pub conn: &'a Connection,
+    pub conn: &'a Conn,
     pub query: String,
-    pub params: Vec<Box<postgres::types::ToSql>>,
+    // Values of the parameters, back to back, owned by the query
+    pub data: Vec<u8>,
+    // Parameters pointing into data
+    pub params: Vec<QueryParam>,
 }
 
 impl<'a> Query<'a> {
     pub fn sql_params(&self) -> Vec<&postgres::types::ToSql> {
-        self.params.iter().map(|p| p.as_ref()).collect()
+        self.params.iter().map(|p| p as &postgres::types::ToSql).collect()
     }
 
-    pub fn execute(&self) -> Result<u64, postgres::Error> {
+    pub fn execute(&self) -> Result<u64, Error> {
+        self.conn.start_transaction()?;
         let params = self.sql_params();
-        self.conn.execute(&self.query, params.as_slice())
+        let result = self.conn.with_statement(&self.query, |stmt| stmt.execute(params.as_slice()));
+        self.conn.track_transaction(&self.query, result.is_ok());
+        result
+    }
+
+    /// Run the statements of the query, separated by semicolons, with the
+    /// simple query protocol: a single message, nothing prepared, and no
+    /// affected rows count.
+    pub fn execute_script(&self) -> Result<(), Error> {
+        self.conn.start_transaction()?;
+        let result = self.conn.batch_execute(&self.query);
+        self.conn.track_transaction(&self.query, result.is_ok());
+        Ok(result?)
+    }
+
+    /// Execute the query once per row of `nparams` parameters.
+    pub unsafe fn execute_many(&self, params: &[QueryParam], nrows: usize, nparams: usize) -> Result<(), Error> {
+        self.conn.start_transaction()?;
+        let stmt = self.conn.prepare(&self.query)?;
+        // One round trip per row: execute sends Bind/Execute/Sync and waits
+        for i in 0..nrows {
+            let row: Vec<_> = params[i * nparams..(i + 1) * nparams].iter()
+                .map(|param| param as &postgres::types::ToSql)
+                .collect();
+            if let Err(error) = stmt.execute(row.as_slice()) {
+                // Rows before may have run, so it isn't retried
+                self.conn.evict_stale(&self.query, &error);
+                return Err(error.into());
+            }
+        }
+        Ok(())
     }
 
-    pub fn execute_with_result(&self) -> Result<QueryResult, postgres::Error> {
+    pub fn execute_with_result(&self) -> Result<QueryResult, Error> {
+        self.conn.start_transaction()?;
         let params = self.sql_params();
-        let result = self.conn.query(&self.query, params.as_slice());
-        result.map(|rows| QueryResult::from_rows(rows))
+        let rows = self.conn.with_statement(&self.query, |stmt| stmt.query(params.as_slice()))?;
+        Ok(QueryResult::from_rows(rows))
+    }
+
+    pub unsafe fn execute_stream(&self, batch_rows: i32) -> Result<QueryStream, Error> {
+        self.conn.start_transaction()?;
+        // Portals live in the innermost transaction, opened for the stream
+        // when there is none.
+        let top = self.conn.transactions.borrow().top()
+            .map(|trans| &*(trans as *const Transaction));
+        let (trans, own) = match top {
+            Some(trans) => (trans, None),
+            None if !self.conn.is_active() => {
+                // rust-postgres panics when opening a second transaction
+                return Err(Error::new("cannot stream while a transaction is active"));
+            }
+            None if self.conn.untracked.get() => {
+                // Its COMMIT would commit the transaction of the caller
+                return Err(Error::new("cannot stream in a transaction not opened with transaction()"));
+            }
+            None => {
+                let conn = &*(self.conn.conn.as_ref() as *const Connection);
+                let own = Box::new(conn.transaction()?);
+                own.set_commit();
+                (&*(own.as_ref() as *const Transaction), Some(own))
+            }
+        };
+        let stmt = self.conn.prepare(&self.query)?;
+        let ncols = stmt.columns().len();
+
+        // The stream owns the statement the portal borrows, and its own
+        // transaction if any
+        let lazy = {
+            let stmt = &*(stmt.as_ref() as *const Statement);
+            let params = self.sql_params();
+            match stmt.lazy_query(trans, params.as_slice(), batch_rows) {
+                Ok(lazy) => lazy,
+                Err(error) => {
+                    // Not retried, the transaction being aborted
+                    self.conn.evict_stale(&self.query, &error);
+                    return Err(error.into());
+                }
+            }
+        };
+        self.conn.streams.set(self.conn.streams.get() + 1);
+        Ok(QueryStream{rows: vec![], lazy, stmt, trans: own, conn: self.conn, ncols})
     }
 }
 
@@ -130,19 +179,104 @@ impl Drop for QueryResult {
 }
 
 
+/// Server-side cursor fetching `batch_rows` rows per round trip, in the
+/// current transaction or in one committed when the stream is closed.
+pub struct QueryStream {
+    // Fields are dropped in order: rows, then the portal, the statement and
+    // finally the transaction.
+    pub rows: Vec<Row<'static>>,
+    lazy: LazyRows<'static, 'static>,
+    stmt: Rc<Statement<'static>>,
+    trans: Option<Box<Transaction<'static>>>,
+    conn: *const Conn,
+    pub ncols: usize,
+}
+
+impl Drop for QueryStream {
+    fn drop(&mut self) {
+        let conn = unsafe { &*self.conn };
+        conn.streams.set(conn.streams.get() - 1);
+    }
+}
+
+impl QueryStream {
+    pub fn columns(&self) -> &[postgres::stmt::Column] {
+        self.stmt.columns()
+    }
+
+    /// Replace the current rows by up to `nrows` next ones.
+    pub fn fetch(&mut self, nrows: usize) -> Result<&[Row<'static>], postgres::Error> {
+        self.rows.clear();
+        while self.rows.len() < nrows {
+            match self.lazy.next()? {
+                Some(row) => self.rows.push(row),
+                None => break,
+            }
+        }
+        Ok(&self.rows)
+    }
+}
+
+
 #[no_mangle]
 pub unsafe extern "C" fn new_query(conn: *mut _Connection, query: *const c_char, len: usize) -> *mut _Query {
-    let conn = OpaquePtr::<Connection>::from_opaque(conn);
+    let conn = OpaquePtr::<Conn>::from_opaque(conn);
     let query_str = str::from_utf8_unchecked(slice::from_raw_parts(query as *const _, len));
-    let q = Query { conn: &conn, query: query_str.to_string(), params: vec![] };
+    let q = Query { conn: &conn, query: query_str.to_string(), data: vec![], params: vec![] };
     OpaquePtr::new(q).opaque()
 }
 
 
+/// Bind the `nparams` parameters of the query in one call: their values are
+/// laid out back to back in `data`, `sizes` giving the size of each one, -1
+/// for NULL. The data is copied once, so it can be freed after the call.
 #[no_mangle]
-pub unsafe extern "C" fn query_param(query: *mut _Query, param: QueryParam) {
+pub unsafe extern "C" fn query_params(query: *mut _Query, data: *const u8, len: usize, sizes: *const i32, nparams: usize) {
     let query = &mut *(query as *mut Query);
-    query.params.push(param.typed_param());
+    let sizes = slice::from_raw_parts(sizes, nparams);
+    query.data = slice::from_raw_parts(data, len).to_vec();
+    // The buffer of data is never reallocated once the params point to it
+    query.params = split_params(&query.data, sizes);
+}
+
+
+/// Parameters pointing to the values laid out back to back in `data`,
+/// `sizes` giving the size of each one, -1 for NULL.
+fn split_params(data: &[u8], sizes: &[i32]) -> Vec<QueryParam> {
+    let mut offset = 0;
+    sizes.iter().map(|&size| {
+        if size < 0 {
+            return QueryParam{value: Buffer::null()};
+        }
+        let value = &data[offset..offset + size as usize];
+        offset += size as usize;
+        QueryParam{value: Buffer::from_bytes(value)}
+    }).collect()
+}
+
+
+/// Prepare the query and write the type OIDs of its parameters to `oids`, up
+/// to `len` of them, `count` getting the number of parameters.
+#[no_mangle]
+pub unsafe extern "C" fn query_param_types(query: *mut _Query, oids: *mut u32, len: usize, count: *mut usize) -> FFIResult<u8> {
+    let query = OpaquePtr::<Query>::from_opaque(query);
+    let oids = slice::from_raw_parts_mut(oids, len);
+    let result = query.conn.prepare(&query.query).map(|stmt| {
+        let types = stmt.param_types();
+        for (oid, type_) in oids.iter_mut().zip(types) {
+            *oid = type_.oid();
+        }
+        *count = types.len();
+    });
+    FFIResult::from_status(result)
+}
+
+
+/// Free a query that won't be executed.
+#[no_mangle]
+pub unsafe extern "C" fn query_close(query: *mut _Query) {
+    let query = OpaquePtr::<Query>::from_opaque(query);
+    query.free();
 }
 
 
@@ -155,6 +289,29 @@ pub unsafe extern "C" fn query_exec(query: *mut _Query) -> FFIResult<u8> {
 }
 
 
+#[no_mangle]
+pub unsafe extern "C" fn query_exec_script(query: *mut _Query) -> FFIResult<u8> {
+    let query = OpaquePtr::<Query>::from_opaque(query);
+    let result = query.execute_script();
+    query.free();
+    FFIResult::from_status(result)
+}
+
+
+/// Execute the query once per row of `nparams` parameters, the values of
+/// the `nrows` rows being laid out back to back in `data` as with
+/// query_params. The data is only borrowed for the call.
+#[no_mangle]
+pub unsafe extern "C" fn query_exec_many(query: *mut _Query, data: *const u8, len: usize, sizes: *const i32, nrows: usize, nparams: usize) -> FFIResult<u8> {
+    let query = OpaquePtr::<Query>::from_opaque(query);
+    let sizes = slice::from_raw_parts(sizes, nrows * nparams);
+    let params = split_params(slice::from_raw_parts(data, len), sizes);
+    let result = query.execute_many(&params, nrows, nparams);
+    query.free();
+    FFIResult::from_status(result)
+}
+
+
 #[no_mangle]
 pub unsafe extern "C" fn query_exec_result(query: *mut _Query) -> FFIResult<_QueryResult> {
     let query = OpaquePtr::<Query>::from_opaque(query);
@@ -164,8 +321,39 @@ pub unsafe extern "C" fn query_exec_result(query: *mut _Query) -> FFIResult<_Que
 }
 
 
+#[no_mangle]
+pub unsafe extern "C" fn query_exec_stream(query: *mut _Query, batch_rows: i32) -> FFIResult<_QueryStream> {
+    let query = OpaquePtr::<Query>::from_opaque(query);
+    let result = query.execute_stream(batch_rows);
+    query.free();
+    FFIResult::from_result(result)
+}
+
+
+#[no_mangle]
+pub unsafe extern "C" fn result_ncols(result: *mut _QueryResult) -> usize {
+    let result = OpaquePtr::<QueryResult>::from_opaque(result);
+    let rows = OpaquePtr::<postgres::rows::Rows>::from_opaque(result.rows);
+    rows.columns().len()
+}
+
+
 #[no_mangle]
 pub unsafe extern "C" fn result_close(result: *mut _QueryResult) {
     let result = OpaquePtr::<QueryResult>::from_opaque(result);
     result.free();
 }
+
+
+#[no_mangle]
+pub unsafe extern "C" fn stream_ncols(stream: *mut _QueryStream) -> usize {
+    let stream = OpaquePtr::<QueryStream>::from_opaque(stream);
+    stream.ncols
+}
+
+
+#[no_mangle]
+pub unsafe extern "C" fn stream_close(stream: *mut _QueryStream) {
+    let stream = OpaquePtr::<QueryStream>::from_opaque(stream);
+    stream.free();
+}
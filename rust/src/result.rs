@@ -12,6 +12,15 @@ impl<T> FFIResult<T> {
     fn new<O>(status: u8, obj: O) -> Self {
         Self { status, data: OpaquePtr::new(obj).opaque() }
     }
+    pub fn ok() -> Self {
+        Self { status: 0, data: std::ptr::null() }
+    }
+    pub fn from_status<E: std::error::Error>(result: Result<(), E>) -> Self {
+        match result {
+            Ok(()) => Self::ok(),
+            Err(e) => Self::from_error(e),
+        }
+    }
     pub fn from_obj<O>(obj: O) -> Self {
         Self::new(0, obj)
     }
@@ -1,72 +1,285 @@
+use std::slice;
+
 use buffer::*;
 use opaque::*;
 use query::*;
+use result::*;
 
 
 pub struct _Rows;
 pub struct _RowsIterator;
 
 
-#[no_mangle]
-pub struct _Row;
-
-#[no_mangle]
-pub struct _Opaque;
+// Tags of RowItem, telling how its value was decoded
+pub const TAG_NULL: u8 = 0;
+// value holds the binary value, left to decode to Python
+pub const TAG_RAW: u8 = 1;
+// int_value holds the value of an int2, int4, int8 or oid
+pub const TAG_INT: u8 = 2;
+// float_value holds the value of a float4 or float8
+pub const TAG_FLOAT: u8 = 3;
+// int_value holds 0 or 1
+pub const TAG_BOOL: u8 = 4;
+// value holds UTF-8 text
+pub const TAG_TEXT: u8 = 5;
+// value holds the 16 bytes of the uuid
+pub const TAG_UUID: u8 = 6;
+// int_value holds days since 2000-01-01
+pub const TAG_DATE: u8 = 7;
+// int_value holds microseconds since 2000-01-01 00:00:00
+pub const TAG_TIMESTAMP: u8 = 8;
+// int_value holds microseconds since 2000-01-01 00:00:00 UTC
+pub const TAG_TIMESTAMPTZ: u8 = 9;
+// value holds the JSON document
+pub const TAG_JSON: u8 = 10;
+// value holds the JSON document, after the version byte
+pub const TAG_JSONB: u8 = 11;
 
 
+/// A value of a row. The common types are decoded natively, so that Python
+/// only has to box the primitive, other types are left as raw values. value
+/// always holds the raw value.
 #[no_mangle]
 #[repr(C)]
 #[derive(Copy, Clone)]
 pub struct RowItem {
-    pub typename: Buffer,
+    pub tag: u8,
+    pub int_value: i64,
+    pub float_value: f64,
     pub value: Buffer,
 }
 
 impl RowItem {
     pub fn empty() -> Self {
-        let buff = Buffer::null();
-        Self{typename: buff, value: buff}
+        Self{tag: TAG_NULL, int_value: 0, float_value: 0., value: Buffer::null()}
+    }
+    pub fn fill_row(row: &postgres::rows::Row, items: &mut [RowItem]) {
+        for (i, (item, column)) in items.iter_mut().zip(row.columns()).enumerate() {
+            *item = Self::from_row(row, i, column.type_().oid());
+        }
+    }
+    pub fn from_row(row: &postgres::rows::Row, i: usize, oid: u32) -> Self {
+        match row.get_bytes(i) {
+            Some(data) => Self::decode(data, oid),
+            None => Self::empty(),
+        }
+    }
+    fn decode(data: &[u8], oid: u32) -> Self {
+        let mut item = Self{tag: TAG_RAW, int_value: 0, float_value: 0., value: Buffer::from_bytes(data)};
+        match (oid, data.len()) {
+            (16, 1) => {
+                item.tag = TAG_BOOL;
+                item.int_value = (data[0] != 0) as i64;
+            }
+            (21, 2) => {
+                item.tag = TAG_INT;
+                item.int_value = read_be(data) as u16 as i16 as i64;
+            }
+            (23, 4) => {
+                item.tag = TAG_INT;
+                item.int_value = read_be(data) as u32 as i32 as i64;
+            }
+            (26, 4) => {
+                item.tag = TAG_INT;
+                item.int_value = read_be(data) as u32 as i64;
+            }
+            (20, 8) => {
+                item.tag = TAG_INT;
+                item.int_value = read_be(data) as i64;
+            }
+            (700, 4) => {
+                item.tag = TAG_FLOAT;
+                item.float_value = f32::from_bits(read_be(data) as u32) as f64;
+            }
+            (701, 8) => {
+                item.tag = TAG_FLOAT;
+                item.float_value = f64::from_bits(read_be(data));
+            }
+            (1082, 4) => {
+                item.tag = TAG_DATE;
+                item.int_value = read_be(data) as u32 as i32 as i64;
+            }
+            (1114, 8) => {
+                item.tag = TAG_TIMESTAMP;
+                item.int_value = read_be(data) as i64;
+            }
+            (1184, 8) => {
+                item.tag = TAG_TIMESTAMPTZ;
+                item.int_value = read_be(data) as i64;
+            }
+            (2950, 16) => item.tag = TAG_UUID,
+            // text, varchar, bpchar, name, unknown
+            (25, _) | (1043, _) | (1042, _) | (19, _) | (705, _) => item.tag = TAG_TEXT,
+            (114, _) => item.tag = TAG_JSON,
+            (3802, len) if len > 0 && data[0] == 1 => item.tag = TAG_JSONB,
+            _ => {}
+        }
+        item
+    }
+}
+
+
+/// Read a big-endian integer of at most 8 bytes.
+fn read_be(data: &[u8]) -> u64 {
+    data.iter().fold(0, |value, byte| (value << 8) | *byte as u64)
+}
+
+
+// Values are always exchanged in binary format
+pub const BINARY_FORMAT: i16 = 1;
+
+#[no_mangle]
+#[repr(C)]
+#[derive(Copy, Clone)]
+pub struct ColumnItem {
+    pub name: Buffer,
+    pub typename: Buffer,
+    pub oid: u32,
+    pub format: i16,
+}
+
+impl ColumnItem {
+    pub fn fill(columns: &[postgres::stmt::Column], items: &mut [ColumnItem]) {
+        for (item, column) in items.iter_mut().zip(columns) {
+            *item = ColumnItem{
+                name: Buffer::from_str(column.name()),
+                typename: Buffer::from_str(column.type_().name()),
+                oid: column.type_().oid(),
+                format: BINARY_FORMAT,
+            };
+        }
+    }
+}
+
+
+/// Copy a big-endian value into a native-endian slot of the same width.
+fn copy_native(value: &[u8], slot: &mut [u8]) {
+    if value.len() != slot.len() {
+        return;
+    }
+    if cfg!(target_endian = "little") {
+        for (dst, src) in slot.iter_mut().zip(value.iter().rev()) {
+            *dst = *src;
+        }
+    } else {
+        slot.copy_from_slice(value);
     }
 }
 
 
 #[no_mangle]
-pub unsafe extern "C" fn next_row(result: *mut _QueryResult) -> *const _Row {
+pub unsafe extern "C" fn result_nrows(result: *mut _QueryResult) -> usize {
     let result = OpaquePtr::<QueryResult>::from_opaque(result);
-    let mut iter = OpaquePtr::<postgres::rows::Iter>::from_opaque(result.iter);
-    match iter.next() {
-        Some(x) => {
-            OpaquePtr::new(x).opaque()
+    let rows = OpaquePtr::<postgres::rows::Rows>::from_opaque(result.rows);
+    rows.len()
+}
+
+
+/// Describe the `ncols` columns of the result in `items`.
+#[no_mangle]
+pub unsafe extern "C" fn result_columns(result: *mut _QueryResult, items: *mut ColumnItem, ncols: usize) {
+    let result = OpaquePtr::<QueryResult>::from_opaque(result);
+    let rows = OpaquePtr::<postgres::rows::Rows>::from_opaque(result.rows);
+    ColumnItem::fill(rows.columns(), slice::from_raw_parts_mut(items, ncols));
+}
+
+
+#[no_mangle]
+pub unsafe extern "C" fn stream_columns(stream: *mut _QueryStream, items: *mut ColumnItem, ncols: usize) {
+    let stream = OpaquePtr::<QueryStream>::from_opaque(stream);
+    ColumnItem::fill(stream.columns(), slice::from_raw_parts_mut(items, ncols));
+}
+
+
+/// Decode the fixed-width column `col` of every row into `data`, an array of
+/// `nrows` native-endian values of `width` bytes. `nulls` gets 1 for NULL
+/// values, which are left zeroed in `data`.
+#[no_mangle]
+pub unsafe extern "C" fn column_fixed(result: *mut _QueryResult, col: usize, width: usize, data: *mut u8, nulls: *mut u8) {
+    let result = OpaquePtr::<QueryResult>::from_opaque(result);
+    let rows = OpaquePtr::<postgres::rows::Rows>::from_opaque(result.rows);
+    let data = slice::from_raw_parts_mut(data, rows.len() * width);
+    let nulls = slice::from_raw_parts_mut(nulls, rows.len());
+
+    for (i, row) in rows.iter().enumerate() {
+        match row.get_bytes(col) {
+            Some(value) => copy_native(value, &mut data[i * width..(i + 1) * width]),
+            None => nulls[i] = 1,
         }
-        None => std::ptr::null(),
     }
 }
 
 
+/// Total size of the values of column `col`, to size the `column_varlen`
+/// data array.
 #[no_mangle]
-pub unsafe extern "C" fn row_len(row: *mut _Row) -> usize {
-    let row = OpaquePtr::<postgres::rows::Row>::from_opaque(row);
-    row.len()
+pub unsafe extern "C" fn column_size(result: *mut _QueryResult, col: usize) -> usize {
+    let result = OpaquePtr::<QueryResult>::from_opaque(result);
+    let rows = OpaquePtr::<postgres::rows::Rows>::from_opaque(result.rows);
+    rows.iter().map(|row| row.get_bytes(col).map_or(0, |value| value.len())).sum()
 }
 
 
+/// Concatenate the values of column `col` into `data`, value `i` spanning
+/// `data[offsets[i]..offsets[i + 1]]` (`offsets` holds `nrows + 1` items).
 #[no_mangle]
-pub unsafe extern "C" fn row_close(row: *mut _Row) {
-    let row = OpaquePtr::<postgres::rows::Row>::from_opaque(row);
-    row.free();
+pub unsafe extern "C" fn column_varlen(result: *mut _QueryResult, col: usize, offsets: *mut u64, data: *mut u8, nulls: *mut u8) {
+    let result = OpaquePtr::<QueryResult>::from_opaque(result);
+    let rows = OpaquePtr::<postgres::rows::Rows>::from_opaque(result.rows);
+    let offsets = slice::from_raw_parts_mut(offsets, rows.len() + 1);
+    let nulls = slice::from_raw_parts_mut(nulls, rows.len());
+
+    let mut offset = 0;
+    offsets[0] = 0;
+    for (i, row) in rows.iter().enumerate() {
+        match row.get_bytes(col) {
+            Some(value) => {
+                std::ptr::copy_nonoverlapping(value.as_ptr(), data.add(offset), value.len());
+                offset += value.len();
+            }
+            None => nulls[i] = 1,
+        }
+        offsets[i + 1] = offset as u64;
+    }
 }
 
 
+/// Fill `items` with up to `nrows` rows of `ncols` items each, row after row.
+/// Returns the number of rows actually fetched, 0 meaning the result is
+/// exhausted.
 #[no_mangle]
-pub unsafe extern "C" fn row_item(row: *mut _Row, i: usize) -> RowItem {
-    let row = OpaquePtr::<postgres::rows::Row>::from_opaque(row);
-    let typename = row.columns()[i].type_().name();
-
-    match row.get_bytes(i) {
-        Some(data) => RowItem{
-            typename: Buffer::from_str(typename),
-            value: Buffer::from_bytes(data),
-        },
-        None => RowItem::empty(),
+pub unsafe extern "C" fn next_rows(result: *mut _QueryResult, items: *mut RowItem, nrows: usize, ncols: usize) -> usize {
+    let result = OpaquePtr::<QueryResult>::from_opaque(result);
+    let mut iter = OpaquePtr::<postgres::rows::Iter>::from_opaque(result.iter);
+    let items = slice::from_raw_parts_mut(items, nrows * ncols);
+
+    let mut count = 0;
+    while count < nrows {
+        match iter.next() {
+            Some(row) => {
+                RowItem::fill_row(&row, &mut items[count * ncols..(count + 1) * ncols]);
+                count += 1;
+            }
+            None => break,
+        }
     }
+    count
+}
+
+
+/// Same as `next_rows` for streams, the number of rows being written to
+/// `count`. Items stay valid until the next call.
+#[no_mangle]
+pub unsafe extern "C" fn stream_next_rows(stream: *mut _QueryStream, items: *mut RowItem, nrows: usize, ncols: usize, count: *mut usize) -> FFIResult<u8> {
+    let mut stream = OpaquePtr::<QueryStream>::from_opaque(stream);
+    let items = slice::from_raw_parts_mut(items, nrows * ncols);
+
+    *count = 0;
+    let result = stream.fetch(nrows).map(|rows| {
+        for (i, row) in rows.iter().enumerate() {
+            RowItem::fill_row(row, &mut items[i * ncols..(i + 1) * ncols]);
+        }
+        *count = rows.len();
+    });
+    FFIResult::from_status(result)
 }
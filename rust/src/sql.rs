@@ -0,0 +1,110 @@
+/// Split `sql` into its statements, on the semicolons outside of quotes,
+/// dollar quotes and comments.
+pub fn statements(sql: &str) -> Vec<&str> {
+    let bytes = sql.as_bytes();
+    let mut statements = vec![];
+    let mut start = 0;
+    let mut i = 0;
+    while i < bytes.len() {
+        match bytes[i] {
+            b';' => {
+                statements.push(&sql[start..i]);
+                start = i + 1;
+                i += 1;
+            }
+            quote @ b'\'' | quote @ b'"' => {
+                // Doubled quotes are read as two quoted strings
+                i += 1;
+                while i < bytes.len() && bytes[i] != quote {
+                    i += 1;
+                }
+                i += 1;
+            }
+            b'-' if bytes.get(i + 1) == Some(&b'-') => {
+                while i < bytes.len() && bytes[i] != b'\n' {
+                    i += 1;
+                }
+            }
+            b'/' if bytes.get(i + 1) == Some(&b'*') => {
+                // Block comments nest
+                let mut depth = 0;
+                while i < bytes.len() {
+                    if bytes[i..].starts_with(b"/*") {
+                        depth += 1;
+                        i += 2;
+                    } else if bytes[i..].starts_with(b"*/") {
+                        depth -= 1;
+                        i += 2;
+                        if depth == 0 {
+                            break;
+                        }
+                    } else {
+                        i += 1;
+                    }
+                }
+            }
+            b'$' => {
+                i += dollar_quoted(&bytes[i..]);
+            }
+            _ => i += 1,
+        }
+    }
+    statements.push(&sql[start..]);
+    statements
+}
+
+/// Length of the dollar-quoted string `bytes` starts with, or 1 if it
+/// doesn't start with one (e.g. a $1 parameter).
+fn dollar_quoted(bytes: &[u8]) -> usize {
+    let tag_len = match bytes[1..].iter().position(|&c| !(c == b'_' || c.is_ascii_alphanumeric())) {
+        Some(len) if bytes[1 + len] == b'$' && !bytes[1].is_ascii_digit() => len + 2,
+        _ => return 1,
+    };
+    let tag = &bytes[..tag_len];
+    let body = &bytes[tag_len..];
+    match (0..body.len()).find(|&i| body[i..].starts_with(tag)) {
+        Some(end) => tag_len + end + tag_len,
+        None => bytes.len(),
+    }
+}
+
+/// The first words of `statement` in upper case, after whitespace and
+/// comments.
+fn keywords(statement: &str) -> Vec<String> {
+    let mut statement = statement.trim_start();
+    loop {
+        if statement.starts_with("--") {
+            statement = statement.find('\n').map_or("", |end| &statement[end..]).trim_start();
+        } else if statement.starts_with("/*") {
+            statement = statement.find("*/").map_or("", |end| &statement[end + 2..]).trim_start();
+        } else {
+            break;
+        }
+    }
+    statement.split(|c: char| !c.is_ascii_alphabetic())
+        .filter(|word| !word.is_empty())
+        .take(5)
+        .map(|word| word.to_ascii_uppercase())
+        .collect()
+}
+
+/// Effect of `statement` on the transaction block: Some(true) if it opens
+/// one (BEGIN, START TRANSACTION, COMMIT AND CHAIN…), Some(false) if it ends
+/// it (COMMIT, ROLLBACK, END, ABORT, PREPARE TRANSACTION), None otherwise.
+pub fn transaction_control(statement: &str) -> Option<bool> {
+    let words = keywords(statement);
+    let word = |i: usize| words.get(i).map_or("", |word| word.as_str());
+    let chain = words.iter().any(|word| word == "CHAIN") && !words.iter().any(|word| word == "NO");
+    match word(0) {
+        "BEGIN" => Some(true),
+        "START" if word(1) == "TRANSACTION" => Some(true),
+        "PREPARE" if word(1) == "TRANSACTION" => Some(false),
+        // COMMIT PREPARED runs outside of transactions, ROLLBACK TO
+        // SAVEPOINT within them
+        "COMMIT" | "ROLLBACK" if word(1) == "PREPARED" => None,
+        "ROLLBACK" if word(1) == "TO" => None,
+        "COMMIT" | "END" | "ROLLBACK" | "ABORT" => Some(chain),
+        _ => None,
+    }
+}
+
@@ -0,0 +1,189 @@
+use postgres::transaction::{Config, IsolationLevel, Transaction};
+
+use connection::*;
+use error::*;
+use opaque::*;
+use result::*;
+
+
+/// Options of a transaction, -1 standing for the server default.
+#[no_mangle]
+#[repr(C)]
+#[derive(Copy, Clone, Debug)]
+pub struct TransactionOptions {
+    // 0: read uncommitted, 1: read committed, 2: repeatable read, 3: serializable
+    pub isolation: i32,
+    pub read_only: i32,
+    pub deferrable: i32,
+}
+
+impl TransactionOptions {
+    pub fn is_default(&self) -> bool {
+        self.isolation < 0 && self.read_only < 0 && self.deferrable < 0
+    }
+
+    pub fn config(&self) -> Result<Config, Error> {
+        let mut config = Config::new();
+        match self.isolation {
+            -1 => {}
+            0 => { config.isolation_level(IsolationLevel::ReadUncommitted); }
+            1 => { config.isolation_level(IsolationLevel::ReadCommitted); }
+            2 => { config.isolation_level(IsolationLevel::RepeatableRead); }
+            3 => { config.isolation_level(IsolationLevel::Serializable); }
+            _ => return Err(Error::new("invalid isolation level")),
+        }
+        if self.read_only >= 0 {
+            config.read_only(self.read_only != 0);
+        }
+        if self.deferrable >= 0 {
+            config.deferrable(self.deferrable != 0);
+        }
+        Ok(config)
+    }
+}
+
+
+/// The transaction and savepoints opened on a connection. BEGIN (or
+/// SAVEPOINT) is only sent before the first statement run in them, so that
+/// empty transactions cost no round trip. It still takes a round trip of its
+/// own, rust-postgres having no way to queue it in front of the statement.
+pub struct Transactions {
+    // Started transaction then savepoints, innermost last. They borrow the
+    // connection, and each savepoint its parent.
+    started: Vec<Box<Transaction<'static>>>,
+    // Levels not started yet, the transaction one holding its options
+    pending: Vec<Option<TransactionOptions>>,
+}
+
+impl Transactions {
+    pub fn new() -> Self {
+        Self{started: vec![], pending: vec![]}
+    }
+
+    pub fn depth(&self) -> usize {
+        self.started.len() + self.pending.len()
+    }
+
+    /// The innermost started transaction.
+    pub fn top(&self) -> Option<&Transaction<'static>> {
+        self.started.last().map(|trans| trans.as_ref())
+    }
+
+    pub fn begin(&mut self, options: TransactionOptions) -> Result<(), Error> {
+        if self.depth() == 0 {
+            options.config()?;
+            self.pending.push(Some(options));
+        } else if options.is_default() {
+            self.pending.push(None);
+        } else {
+            return Err(Error::new("isolation, read only and deferrable can only be set on the outermost transaction"));
+        }
+        Ok(())
+    }
+
+    /// Send the pending BEGIN and SAVEPOINT.
+    pub unsafe fn start(&mut self, conn: &Connection) -> Result<(), Error> {
+        while !self.pending.is_empty() {
+            let trans = match self.started.last() {
+                Some(parent) => {
+                    let parent = &*(parent.as_ref() as *const Transaction);
+                    parent.transaction()?
+                }
+                None => {
+                    let config = self.pending[0].map_or_else(
+                        || Ok(Config::new()), |options| options.config(),
+                    )?;
+                    let conn = &*(conn as *const Connection);
+                    conn.transaction_with(&config)?
+                }
+            };
+            self.started.push(Box::new(trans));
+            self.pending.remove(0);
+        }
+        Ok(())
+    }
+
+    /// Commit (or roll back) the innermost transaction or savepoint.
+    pub fn finish(&mut self, commit: bool) -> Result<(), Error> {
+        if self.pending.pop().is_some() {
+            return Ok(());
+        }
+        match self.started.pop() {
+            Some(trans) if commit => Ok(trans.commit()?),
+            Some(trans) => Ok(trans.finish()?),
+            None => Err(Error::new("no transaction in progress")),
+        }
+    }
+}
+
+impl Drop for Transactions {
+    fn drop(&mut self) {
+        // Savepoints must be rolled back before their parent
+        while let Some(trans) = self.started.pop() {
+            drop(trans);
+        }
+    }
+}
+
+
+impl Conn {
+    /// Start the pending transaction and savepoints, before running a
+    /// statement.
+    pub fn start_transaction(&self) -> Result<(), Error> {
+        let mut transactions = self.transactions.borrow_mut();
+        unsafe { transactions.start(&self.conn) }
+    }
+
+    fn check_no_stream(&self) -> Result<(), Error> {
+        if self.streams.get() > 0 {
+            return Err(Error::new("cannot open or close a transaction while a stream is open"));
+        }
+        Ok(())
+    }
+}
+
+
+#[no_mangle]
+pub unsafe extern "C" fn transaction_begin(conn: *mut _Connection, options: TransactionOptions) -> FFIResult<u8> {
+    let conn = OpaquePtr::<Conn>::from_opaque(conn);
+    let result = conn.check_no_stream()
+        .and_then(|_| conn.transactions.borrow_mut().begin(options));
+    FFIResult::from_status(result)
+}
+
+
+#[no_mangle]
+pub unsafe extern "C" fn transaction_commit(conn: *mut _Connection) -> FFIResult<u8> {
+    let conn = OpaquePtr::<Conn>::from_opaque(conn);
+    let result = conn.check_no_stream()
+        .and_then(|_| conn.transactions.borrow_mut().finish(true));
+    FFIResult::from_status(result)
+}
+
+
+#[no_mangle]
+pub unsafe extern "C" fn transaction_rollback(conn: *mut _Connection) -> FFIResult<u8> {
+    let conn = OpaquePtr::<Conn>::from_opaque(conn);
+    let result = conn.check_no_stream()
+        .and_then(|_| conn.transactions.borrow_mut().finish(false));
+    FFIResult::from_status(result)
+}
+
+
+/// Whether a transaction block opened by running a statement such as BEGIN
+/// is in progress.
+#[no_mangle]
+pub unsafe extern "C" fn transaction_untracked(conn: *mut _Connection) -> bool {
+    let conn = OpaquePtr::<Conn>::from_opaque(conn);
+    conn.untracked.get()
+}
+
+
+/// Number of transaction and savepoint levels opened with
+/// `transaction_begin`, started or not.
+#[no_mangle]
+pub unsafe extern "C" fn transaction_depth(conn: *mut _Connection) -> usize {
+    let conn = OpaquePtr::<Conn>::from_opaque(conn);
+    let transactions = conn.transactions.borrow();
+    transactions.depth()
+}
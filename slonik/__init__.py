@@ -1,4 +1,19 @@
+from .async_connection import AsyncConnection
+from .cache import QueryCache
 from .connection import Connection
+from .connection import Notification
+from .exceptions import NoRows
+from .exceptions import PoolTimeout
+from .exceptions import QueryTimeout
 from .exceptions import SlonikException
+from .pool import Pool
+from .result import class_row
+from .result import dict_row
+from .result import namedtuple_row
+from .result import tuple_row
 
-__all__ = ['Connection', 'SlonikException']
+__all__ = [
+    'AsyncConnection', 'Connection', 'NoRows', 'Notification', 'Pool',
+    'PoolTimeout', 'QueryCache', 'QueryTimeout', 'SlonikException',
+    'class_row', 'dict_row', 'namedtuple_row', 'tuple_row',
+]
@@ -0,0 +1,223 @@
+import asyncio
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any
+from typing import AsyncIterator
+from typing import List
+from typing import Tuple
+
+from .connection import Connection
+from .connection import Notification
+from .exceptions import SlonikException
+from .result import DEFAULT_FETCH_SIZE
+from .result import tuple_row
+from .transaction import Transaction
+
+# Longest native wait for notifications, bounding how long the worker stays
+# blocked once the wait is canceled or the connection closed
+NOTIFIES_SLICE = .1
+
+
+class AsyncTransaction:
+    """asyncio flavour of Transaction, used with async with."""
+
+    def __init__(self, conn, transaction: Transaction):
+        self._conn = conn
+        self._transaction = transaction
+
+    async def commit(self):
+        await self._conn._run(self._transaction.commit)
+
+    async def rollback(self):
+        await self._conn._run(self._transaction.rollback)
+
+    async def __aenter__(self):
+        await self._conn._run(self._transaction.__enter__)
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        await self._conn._run(
+            self._transaction.__exit__, exc_type, exc_value, traceback,
+        )
+
+
+class AsyncConnection:
+    """asyncio flavour of Connection.
+
+    rust-postgres only offers blocking I/O, so every connection gets a worker
+    thread running its native calls with the GIL released. The event loop is
+    woken up through its self-pipe when a call completes, and never blocks
+    on the network. This is run_in_executor with one thread per connection:
+    each call still hops to that thread and back, and concurrent queries
+    need as many connections, hence threads. Sharing a single thread would
+    take a non-blocking driver, which rust-postgres 0.15 is not.
+    """
+
+    def __init__(self, dsn: str, **kwargs):
+        self._conn = Connection(dsn, **kwargs)
+        self._executor = ThreadPoolExecutor(
+            max_workers=1, thread_name_prefix='slonik',
+        )
+        self._closed = False
+        # Token of the call the worker runs, for cancels to only hit the
+        # statement of the call they were sent for
+        self._running = None
+        self._running_lock = threading.Lock()
+
+    @classmethod
+    def from_env(cls, **kwargs):
+        env = {key: kwargs.pop(key) for key in list(kwargs)
+               if key.startswith('pg')}
+        return cls(Connection.from_env(**env).dsn, **kwargs)
+
+    @property
+    def dsn(self) -> str:
+        return self._conn.dsn
+
+    async def _run(self, func, *args, **kwargs):
+        loop = asyncio.get_running_loop()
+        token = object()
+
+        def run():
+            with self._running_lock:
+                self._running = token
+            try:
+                return func(*args, **kwargs)
+            finally:
+                # Waits for a cancel being sent for this call
+                with self._running_lock:
+                    self._running = None
+
+        try:
+            return await loop.run_in_executor(self._executor, run)
+        except asyncio.CancelledError:
+            # The worker can't be interrupted, but its statement can. Calls
+            # still queued are simply dropped.
+            loop.run_in_executor(None, self._cancel, token)
+            raise
+
+    def _cancel(self, token):
+        # Unless the call already returned, the worker then running the next
+        # one: Connection.cancel returns once the server got the request
+        with self._running_lock:
+            if self._running is not token:
+                return
+            try:
+                self._conn.cancel()
+            except SlonikException:
+                pass
+
+    async def connect(self):
+        await self._run(lambda: self._conn._conn)
+
+    async def close(self):
+        self._closed = True
+        await self._run(self._conn.close)
+        self._executor.shutdown(wait=False)
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        await self.close()
+
+    def stats(self) -> dict:
+        return self._conn.stats()
+
+    def add_hook(self, hook):
+        """Hooks are called in the worker thread of the connection."""
+        self._conn.add_hook(hook)
+
+    async def register_type(self, type_, encode=None, decode=None):
+        await self._run(self._conn.register_type, type_, encode, decode)
+
+    def transaction(self, isolation: str = None, readonly: bool = None,
+                    deferrable: bool = None) -> AsyncTransaction:
+        return AsyncTransaction(
+            self, self._conn.transaction(isolation, readonly, deferrable),
+        )
+
+    @property
+    def in_transaction(self) -> bool:
+        """Read without waiting for the statement the worker runs."""
+        return self._conn.in_transaction
+
+    async def listen(self, channel: str):
+        await self._run(self._conn.listen, channel)
+
+    async def unlisten(self, channel: str = None):
+        await self._run(self._conn.unlisten, channel)
+
+    async def notifies(self, timeout: float = None) -> List[Notification]:
+        """Wait for notifications in the worker of the connection, forever
+        by default, see Connection.notifies.
+
+        The worker waits NOTIFIES_SLICE seconds at most at a time, so that
+        canceling the wait or closing the connection doesn't depend on a
+        notification coming.
+        """
+        loop = asyncio.get_running_loop()
+        deadline = None if timeout is None else loop.time() + timeout
+        while True:
+            if self._closed:
+                raise SlonikException('Connection is closed')
+            wait = NOTIFIES_SLICE
+            if deadline is not None:
+                wait = min(wait, max(0., deadline - loop.time()))
+            # Not _run, as there is no statement to cancel
+            notifications = await loop.run_in_executor(
+                self._executor, self._conn.notifies, wait,
+            )
+            if notifications or wait < NOTIFIES_SLICE:
+                return notifications
+
+    async def execute(self, sql: str, *args, timeout: float = None):
+        await self._run(self._conn.execute, sql, *args, timeout=timeout)
+
+    async def execute_script(self, sql: str, timeout: float = None):
+        await self._run(self._conn.execute_script, sql, timeout)
+
+    async def query(self, sql: str, *args,
+                    fetch_size: int = DEFAULT_FETCH_SIZE, row_factory=None,
+                    timeout: float = None) -> AsyncIterator[Tuple[Any]]:
+        # The whole result is fetched by the worker, decoding it doesn't
+        # touch the network
+        result = await self._run(
+            self._conn._execute_result, sql, args, fetch_size, False,
+            row_factory, timeout,
+        )
+        with result:
+            for row in result:
+                yield row
+
+    async def stream(self, sql: str, *args,
+                     batch_rows: int = DEFAULT_FETCH_SIZE, row_factory=None,
+                     timeout: float = None) -> AsyncIterator[Tuple[Any]]:
+        result = await self._run(
+            self._conn._execute_stream, sql, args, batch_rows, row_factory,
+            timeout,
+        )
+        try:
+            while True:
+                rows = await self._run(result._fetch)
+                if not rows:
+                    break
+                for row in rows:
+                    yield row
+        finally:
+            await self._run(result.close)
+
+    async def get_one(self, sql: str, *args, row_factory=None,
+                      stream: bool = False, timeout: float = None
+                      ) -> Tuple[Any]:
+        return await self._run(
+            self._conn.get_one, sql, *args, row_factory=row_factory,
+            stream=stream, timeout=timeout,
+        )
+
+    async def get_value(self, sql: str, *args, stream: bool = False,
+                        timeout: float = None) -> Any:
+        value, = await self.get_one(
+            sql, *args, row_factory=tuple_row, stream=stream, timeout=timeout,
+        )
+        return value
@@ -0,0 +1,150 @@
+import copy
+import datetime
+import decimal
+import sys
+import threading
+import time
+import uuid
+from collections import namedtuple
+from collections import OrderedDict
+
+DEFAULT_MAX_BYTES = 16 * 1024 * 1024
+DEFAULT_TTL = 60.
+
+# A cached result: its description and rows as tuples of decoded values
+CacheEntry = namedtuple('CacheEntry', [
+    'description', 'rows', 'expires', 'size', 'tags',
+])
+
+
+# Types of the values shared as is by the copies of the rows, the others
+# (e.g. lists of arrays, dicts of json) being deep-copied
+IMMUTABLE_TYPES = frozenset([
+    type(None), bool, int, float, str, bytes, decimal.Decimal, uuid.UUID,
+    datetime.date, datetime.datetime, datetime.time, datetime.timedelta,
+])
+
+
+def copy_row(row) -> list:
+    """Values of a cached row, which callers can mutate without touching
+    the cache."""
+    return [
+        value if type(value) in IMMUTABLE_TYPES else copy.deepcopy(value)
+        for value in row
+    ]
+
+
+def sizeof(rows) -> int:
+    """Approximate memory used by rows of decoded values, in bytes."""
+    size = sys.getsizeof(rows)
+    for row in rows:
+        size += sys.getsizeof(row)
+        for value in row:
+            size += sys.getsizeof(value)
+    return size
+
+
+class QueryCache:
+    """LRU cache of query results, bounded by their size in bytes.
+
+    Entries are keyed by the SQL and the encoded parameters, expire after
+    their TTL, and can be tagged (e.g. with the names of the tables they
+    read) to be invalidated together. A cache can be shared by several
+    connections, e.g. those of a pool:
+
+    >>> pool = Pool(dsn, cache=QueryCache())
+
+    With a channel, the notifications sent on it and received by
+    Connection.notifies invalidate the tag given as payload, e.g. from a
+    trigger running NOTIFY slonik_cache, 'users' when users change.
+    """
+
+    def __init__(self, max_bytes: int = DEFAULT_MAX_BYTES,
+                 ttl: float = DEFAULT_TTL, channel: str = None):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.channel = channel
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()  # key -> CacheEntry
+        self._tags = {}  # tag -> keys
+        self.size = 0
+        # Incremented by each invalidation, for put to skip the results read
+        # before one
+        self.generation = 0
+        self.hits = self.misses = self.evictions = self.invalidations = 0
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry.expires <= time.monotonic():
+                self._remove(key)
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._entries.move_to_end(key)
+            return entry
+
+    def put(self, key, description, rows, ttl: float = None, tags=(),
+            generation: int = None):
+        """Cache rows, unless the cache was invalidated since generation
+        was read, before running the query: they could be stale."""
+        rows = tuple(rows)
+        size = sizeof(rows)
+        if size > self.max_bytes:
+            return
+        ttl = self.ttl if ttl is None else ttl
+        entry = CacheEntry(
+            description, rows, time.monotonic() + ttl, size, frozenset(tags),
+        )
+
+        with self._lock:
+            if generation is not None and generation != self.generation:
+                return
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = entry
+            self.size += size
+            for tag in entry.tags:
+                self._tags.setdefault(tag, set()).add(key)
+
+            while self.size > self.max_bytes:
+                self._remove(next(iter(self._entries)))
+                self.evictions += 1
+
+    def _remove(self, key):
+        entry = self._entries.pop(key)
+        self.size -= entry.size
+        for tag in entry.tags:
+            keys = self._tags[tag]
+            keys.discard(key)
+            if not keys:
+                del self._tags[tag]
+
+    def invalidate(self, *tags):
+        """Drop the entries tagged with any of tags."""
+        with self._lock:
+            self.generation += 1
+            for tag in tags:
+                for key in list(self._tags.get(tag, ())):
+                    self._remove(key)
+                    self.invalidations += 1
+
+    def clear(self):
+        with self._lock:
+            self.generation += 1
+            self._entries.clear()
+            self._tags.clear()
+            self.size = 0
+
+    def stats(self) -> dict:
+        return {
+            'entries': len(self._entries),
+            'bytes': self.size,
+            'max_bytes': self.max_bytes,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'invalidations': self.invalidations,
+        }
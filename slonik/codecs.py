@@ -0,0 +1,199 @@
+import functools
+import struct
+from collections import OrderedDict
+from collections import namedtuple
+
+from .exceptions import SlonikException
+from .query import encode_array
+from .query import Query
+from .row import ARRAY_TYPES
+from .row import decode_array
+from .row import decode_record
+from .row import decode_text
+from .row import Row
+
+# Errors of the encoders given values they cannot encode
+ENCODE_ERRORS = (TypeError, ValueError, AttributeError, OverflowError,
+                 struct.error)
+
+# Type of a pg_type row: kind is typtype (b for base, c for composite, d for
+# domain, e for enum, p for pseudo-types…), category is typcategory (A for
+# arrays), fields the type OIDs of the attributes of composite types.
+TypeInfo = namedtuple(
+    'TypeInfo', ['oid', 'name', 'kind', 'category', 'element', 'base', 'fields'],
+)
+
+TYPE_INFO_SQL = (
+    'SELECT t.typname, t.typtype, t.typcategory, t.typelem, t.typbasetype, '
+    'ARRAY(SELECT a.atttypid FROM pg_attribute AS a '
+    'WHERE a.attrelid = t.typrelid AND a.attnum > 0 AND NOT a.attisdropped '
+    'ORDER BY a.attnum) '
+    'FROM pg_type AS t WHERE t.oid = $1'
+)
+
+# Names of the types with builtin codecs, not to query them to report errors
+BUILTIN_TYPES = {
+    16: 'bool', 17: 'bytea', 18: 'char', 19: 'name', 20: 'int8', 21: 'int2',
+    23: 'int4', 25: 'text', 26: 'oid', 114: 'json', 700: 'float4',
+    701: 'float8', 705: 'unknown', 1042: 'bpchar', 1043: 'varchar',
+    1082: 'date', 1114: 'timestamp', 1184: 'timestamptz', 1700: 'numeric',
+    2249: 'record', 2950: 'uuid', 3802: 'jsonb',
+}
+BUILTIN_TYPES.update(
+    (oid, '_' + BUILTIN_TYPES[element]) for oid, element in ARRAY_TYPES.items()
+)
+
+DEFAULT_STATEMENTS_SIZE = 100
+
+
+def encode_record(oids, encoders, value) -> bytes:
+    if len(value) != len(oids):
+        raise ValueError(f'Expected {len(oids)} fields, got {len(value)}')
+
+    parts = [struct.pack('>i', len(oids))]
+    for oid, encode, field in zip(oids, encoders, value):
+        if field is None:
+            parts.append(struct.pack('>Ii', oid, -1))
+        else:
+            data = encode(field)
+            parts.append(struct.pack('>Ii', oid, len(data)))
+            parts.append(data)
+    return b''.join(parts)
+
+
+class CodecRegistry:
+    """Encoders and decoders of the types of a connection, by type OID.
+
+    Types without builtin codec are looked up once in pg_type: enums are
+    handled as text, domains as their base type, composites as tuples and
+    arrays as lists. The encoders of the parameters of each statement are
+    cached too.
+    """
+
+    def __init__(self, conn, statements_size: int = DEFAULT_STATEMENTS_SIZE):
+        self.conn = conn
+        self.statements_size = statements_size
+        self._types = {}  # oid -> TypeInfo
+        self._encoders = {}  # oid -> checked encoder
+        self._decoders = {
+            oid: self._bind(deserializer)
+            for oid, deserializer in Row.deserializers.items()
+        }
+        self._statements = OrderedDict()  # sql -> encoders of the params
+
+    def _bind(self, deserializer):
+        # Elements and fields of arrays and records go through the registry
+        if deserializer in (decode_array, decode_record):
+            return functools.partial(deserializer, deserializers=self.decoder)
+        return deserializer
+
+    def type_info(self, oid: int) -> TypeInfo:
+        info = self._types.get(oid)
+        if info is None:
+            rows = list(self.conn.query(TYPE_INFO_SQL, oid))
+            if not rows:
+                raise SlonikException(f'Unknown type OID {oid}')
+            info = self._types[oid] = TypeInfo(oid, *rows[0])
+        return info
+
+    def type_name(self, oid: int) -> str:
+        return BUILTIN_TYPES.get(oid) or self.type_info(oid).name
+
+    def register_type(self, type_, encode=None, decode=None):
+        """Register the encoder (value to binary format) and/or decoder
+        (binary format to value) of a type, given by name or OID."""
+        if isinstance(type_, str):
+            oid = self.conn.get_value('SELECT to_regtype($1)::oid', type_)
+            if oid is None:
+                raise SlonikException(f'Unknown type {type_!r}')
+        else:
+            oid = type_
+
+        if encode is not None:
+            self._encoders[oid] = self._checked(encode, oid)
+            self._statements.clear()
+        if decode is not None:
+            self._decoders[oid] = decode
+
+    def encoder(self, oid: int):
+        encoder = self._encoders.get(oid)
+        if encoder is None:
+            encoder = self._encoders[oid] = self._checked(self._encoder(oid), oid)
+        return encoder
+
+    def _encoder(self, oid):
+        encoder = Query.encoders.get(oid)
+        if encoder is not None:
+            return encoder
+
+        element = ARRAY_TYPES.get(oid)
+        if element is None:
+            info = self.type_info(oid)
+            if info.kind == 'e':
+                return Query.encoders[25]
+            if info.kind == 'd':
+                return self.encoder(info.base)
+            if info.kind == 'c':
+                encoders = [self.encoder(field) for field in info.fields]
+                return functools.partial(encode_record, info.fields, encoders)
+            if info.category != 'A' or not info.element:
+                raise SlonikException(f'No encoder for type {info.name}')
+            element = info.element
+
+        return functools.partial(encode_array, element, self.encoder(element))
+
+    def _checked(self, encode, oid):
+        name = self.type_name(oid)
+
+        def checked(value):
+            try:
+                return encode(value)
+            except ENCODE_ERRORS as e:
+                raise SlonikException(
+                    f'type conversion error: cannot convert to or from a '
+                    f'Postgres value of type `{name}`'
+                ) from e
+
+        return checked
+
+    def decoder(self, oid: int):
+        """Deserializer of the type, None to leave the values raw."""
+        try:
+            return self._decoders[oid]
+        except KeyError:
+            pass
+
+        info = self.type_info(oid)
+        if info.kind == 'e':
+            decoder = decode_text
+        elif info.kind == 'd':
+            decoder = self.decoder(info.base)
+        elif info.kind == 'c' or info.name == 'record':
+            decoder = self._bind(decode_record)
+        elif info.category == 'A' and info.element:
+            decoder = self._bind(decode_array)
+        else:
+            decoder = None
+
+        self._decoders[oid] = decoder
+        return decoder
+
+    def cached_param_encoders(self, sql: bytes):
+        """Encoders of the parameters of the statement if already known,
+        None otherwise."""
+        return self._statements.get(sql)
+
+    def param_encoders(self, query: Query):
+        """Encoders of the parameters of the query, from their types described
+        by the server."""
+        statements = self._statements
+        encoders = statements.get(query.sql)
+        if encoders is not None:
+            statements.move_to_end(query.sql)
+            return encoders
+
+        encoders = tuple(self.encoder(oid) for oid in query.param_types())
+        statements[query.sql] = encoders
+        if len(statements) > self.statements_size:
+            statements.popitem(last=False)
+        return encoders
@@ -1,17 +1,47 @@
+import io
 import json
+import math
 import os
 import struct
+import threading
+import time
 import uuid
+from collections import namedtuple
 from typing import Any
 from typing import Iterable
+from typing import List
 from typing import Tuple
 
+from slonik import copy
 from slonik import rust
 from slonik._native import ffi
 from slonik._native import lib
 
+from .cache import copy_row
+from .cache import QueryCache
+from .codecs import CodecRegistry
+from .exceptions import NoRows
+from .exceptions import SlonikException
+from .pipeline import Pipeline
 from .query import _Query
 from .query import Query
+from .result import check_fetch_size
+from .result import Column
+from .result import DEFAULT_FETCH_SIZE
+from .result import Result
+from .result import tuple_row
+from .stats import Instruments
+from .transaction import Transaction
+from .watchdog import Deadline
+from .watchdog import NO_DEADLINE
+
+
+# A notification sent with NOTIFY, pid being the server process ID of the
+# sender
+Notification = namedtuple('Notification', ['pid', 'channel', 'payload'])
+
+# Notifications returned at most by one native call
+MAX_NOTIFIES = 256
 
 
 class _Conn(rust.RustObject):
@@ -24,20 +54,112 @@ class _Conn(rust.RustObject):
     def close(self):
         self._methodcall(lib.close)
 
+    def cancel_key(self):
+        return self._methodcall(lib.cancel_key)
+
+    def statement_cache_resize(self, capacity: int):
+        self._methodcall(lib.statement_cache_resize, capacity)
+
+    def statement_cache_stats(self):
+        stats = self._methodcall(lib.statement_cache_stats)
+        return {
+            'capacity': stats.capacity,
+            'size': stats.size,
+            'hits': stats.hits,
+            'misses': stats.misses,
+        }
+
+    def transaction_begin(self, options):
+        self._methodcall(lib.transaction_begin, options)
+
+    def transaction_commit(self):
+        self._methodcall(lib.transaction_commit)
+
+    def transaction_rollback(self):
+        self._methodcall(lib.transaction_rollback)
+
+    def transaction_depth(self) -> int:
+        return self._methodcall(lib.transaction_depth)
+
+    def transaction_untracked(self) -> bool:
+        return self._methodcall(lib.transaction_untracked)
+
     def new_query(self, sql: bytes):
         query = self._methodcall(lib.new_query, sql, len(sql))
         return _Query._from_objptr(query)
 
+    def notifies(self, timeout_ms: int, size: int) -> List[Notification]:
+        items = ffi.new('NotificationItem[]', size)
+        count = ffi.new('uintptr_t *')
+        self._methodcall(lib.notifies, timeout_ms, items, size, count)
+        return [
+            Notification(
+                item.process_id,
+                rust.buff_to_bytes(item.channel).decode(),
+                (rust.buff_to_bytes(item.payload) or b'').decode(),
+            )
+            for item in items[0:count[0]]
+        ]
+
+
+DEFAULT_STATEMENT_CACHE_SIZE = 100
+
+
+class ConnectionLock:
+    """Reentrant lock of a connection, refusing to wait for it while it is
+    busy with a long operation such as copy_out(), whose consumer would
+    otherwise wait on itself."""
+
+    def __init__(self):
+        self._lock = threading.RLock()
+        # What the holder of the lock is busy with, None if anything else
+        self.busy = None
+
+    def __enter__(self):
+        if self._lock.acquire(blocking=False):
+            return self
+        # Polled while waiting, as the connection may get busy meanwhile
+        while self.busy is None:
+            if self._lock.acquire(timeout=.1):
+                return self
+        raise SlonikException(f'The connection is busy with {self.busy}')
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self._lock.release()
+
 
 class Connection:
-    def __init__(self, dsn: str):
+    def __init__(self, dsn: str,
+                 statement_cache_size: int = DEFAULT_STATEMENT_CACHE_SIZE,
+                 row_factory=None, instrument: bool = False,
+                 cache: QueryCache = None, timeout: float = None):
         self.dsn = dsn
+        self.statement_cache_size = statement_cache_size
+        # Default timeout of the statements in seconds, see execute
+        self.timeout = timeout
+        # Default row factory of the queries, see slonik.result
+        self.row_factory = row_factory
+        # Statistics of the statements, only gathered when instrumented
+        self.instruments = Instruments() if instrument else None
+        # Results of the queries run with cached(), possibly shared
+        self.cache = cache
         self.__conn = None
+        # Levels of transaction() in progress, mirrored to be read without
+        # the lock
+        self._transaction_depth = 0
+        # Identifies the connection in CancelRequests
+        self._cancel_key = None
+        # cffi releases the GIL during native calls, which must not run
+        # concurrently on the same connection
+        self._lock = ConnectionLock()
+        self.types = CodecRegistry(
+            self, max(statement_cache_size, DEFAULT_STATEMENT_CACHE_SIZE),
+        )
 
     @classmethod
     def from_env(cls, pghost: str = '', pgport: str = '', pguser: str = '',
                  pgpassword: str = '', pgdatabase: str = '',
-                 pgoptions: str = ''):
+                 pgoptions: str = '', **kwargs):
         pghost = pghost or os.environ.get('PGHOST', 'localhost')
         pgport = pgport or os.environ.get('PGPORT', '5432')
         pguser = pguser or os.environ.get('PGUSER', 'postgres')
@@ -49,18 +171,81 @@ class Connection:
             f'postgresql://{pguser}:{pgpassword}@{pghost}:{pgport}'
             f'/{pgdatabase}?{pgoptions}'
         )
-        return cls(dsn)
+        return cls(dsn, **kwargs)
 
     @property
     def _conn(self):
         if not self.__conn:
-            self.__conn = _Conn.connect(self.dsn.encode('utf-8'))
+            with self._lock:
+                if not self.__conn:
+                    self.__conn = self._connect()
 
         return self.__conn
 
+    def _connect(self):
+        conn = _Conn.connect(self.dsn.encode('utf-8'))
+        if self.statement_cache_size != DEFAULT_STATEMENT_CACHE_SIZE:
+            conn.statement_cache_resize(self.statement_cache_size)
+        self._cancel_key = conn.cancel_key()
+        return conn
+
+    def cancel(self):
+        """Ask the server to cancel the statement running on the connection.
+
+        The request goes through a socket of its own, so this can be called
+        from any thread while another one waits for the statement, which
+        then fails. Canceling an idle connection does nothing. This returns
+        once the server processed the request, which then can't cancel the
+        statements sent afterwards.
+        """
+        key = self._cancel_key
+        if key is not None:
+            dsn = self.dsn.encode('utf-8')
+            rust.call(lib.cancel, dsn, len(dsn), key)
+
+    def _deadline(self, timeout: float = None):
+        """Context manager canceling the statements still running after
+        timeout seconds, or the timeout of the connection if None."""
+        timeout = self.timeout if timeout is None else timeout
+        if timeout is None:
+            return NO_DEADLINE
+        return Deadline(timeout, self.cancel)
+
+    def stats(self) -> dict:
+        """Cumulative statistics of the statements by fingerprint (their SQL
+        without literals), when the connection is instrumented: calls,
+        errors, rows, bytes of the values, native calls and the times spent
+        in total, executing and fetching natively, decoding in Python and
+        until the first row, plus a latency histogram."""
+        if self.instruments is None:
+            return {}
+        return {
+            key: stats.as_dict()
+            for key, stats in self.instruments.snapshot().items()
+        }
+
+    def add_hook(self, hook):
+        """Call hook with a slonik.stats.QueryEvent after each statement of
+        an instrumented connection."""
+        if self.instruments is None:
+            raise SlonikException('The connection is not instrumented')
+        self.instruments.hooks.append(hook)
+
+    def statement_cache_stats(self) -> dict:
+        """Capacity, size, hits and misses of the prepared statement
+        cache."""
+        with self._lock:
+            return self._conn.statement_cache_stats()
+
     def close(self):
-        if self.__conn is not None:
-            self.__conn.close()
+        """Close the connection, which fails while a stream() is still
+        open."""
+        with self._lock:
+            if self.__conn is not None:
+                self.__conn.close()
+                self.__conn = None
+                self._cancel_key = None
+                self._transaction_depth = 0
 
     def __enter__(self):
         return self
@@ -68,23 +253,397 @@ class Connection:
     def __exit__(self, exc_type, exc_value, traceback):
         self.close()
 
+    def register_type(self, type_, encode=None, decode=None):
+        """Register the codec of a type, given by name or OID.
+
+        encode gets a Python value and returns its binary representation,
+        decode does the opposite. Parameters are always encoded according to
+        the types described by the server.
+
+        >>> conn.register_type(
+        ...     'point', decode=lambda value: struct.unpack('>dd', value),
+        ... )
+        """
+        with self._lock:
+            self.types.register_type(type_, encode, decode)
+
+    def transaction(self, isolation: str = None, readonly: bool = None,
+                    deferrable: bool = None) -> Transaction:
+        """Transaction context manager, nested ones using savepoints.
+
+        isolation is one of 'read uncommitted', 'read committed',
+        'repeatable read' or 'serializable', the options left to None using
+        the server defaults. They can only be set on the outermost
+        transaction.
+
+        >>> with conn.transaction(isolation='serializable'):
+        ...     conn.execute('UPDATE foo SET bar = 1')
+        ...     with conn.transaction():  # SAVEPOINT
+        ...         conn.execute('DELETE FROM foo')
+        """
+        return Transaction(self, isolation, readonly, deferrable)
+
+    @property
+    def in_transaction(self) -> bool:
+        """Whether transactions opened with transaction() are in progress,
+        without any round trip nor lock: this can be checked from any thread,
+        e.g. from an event loop while a statement runs."""
+        return self._transaction_depth > 0
+
+    def _rollback(self):
+        """Roll back the transactions left open, with transaction() or by
+        running BEGIN."""
+        with self._lock:
+            if self.__conn is None:
+                return
+            try:
+                while self.__conn.transaction_depth():
+                    self.__conn.transaction_rollback()
+            finally:
+                self._transaction_depth = self.__conn.transaction_depth()
+            if self.__conn.transaction_untracked():
+                self.execute_script('ROLLBACK')
+
+    def listen(self, channel: str):
+        """LISTEN to channel, see notifies."""
+        self.execute(f'LISTEN {copy.quote_ident(channel)}')
+
+    def unlisten(self, channel: str = None):
+        """Stop listening to channel, or to all the channels if None."""
+        self.execute(
+            'UNLISTEN *' if channel is None
+            else f'UNLISTEN {copy.quote_ident(channel)}'
+        )
+
+    def notifies(self, timeout: float = 0.) -> List[Notification]:
+        """Notifications received on the channels listened to.
+
+        When none is pending, wait up to timeout seconds (forever if None) for
+        one to come, with the GIL released. All the pending notifications are
+        returned by a single native call. Those sent on the channel of the
+        cache of the connection invalidate the tag given as payload.
+
+        >>> conn.listen('jobs')
+        >>> for notification in conn.notifies(timeout=5):
+        ...     print(notification.payload)
+        """
+        if timeout is None:
+            timeout_ms = -1
+        else:
+            timeout_ms = max(0, math.ceil(timeout * 1000))
+
+        with self._lock:
+            notifications = more = self._conn.notifies(
+                timeout_ms, MAX_NOTIFIES,
+            )
+            # Drain what didn't fit in one call, without waiting again
+            while len(more) == MAX_NOTIFIES:
+                more = self._conn.notifies(0, MAX_NOTIFIES)
+                notifications += more
+
+        cache = self.cache
+        if cache is not None and cache.channel is not None:
+            cache.invalidate(*(
+                notification.payload for notification in notifications
+                if notification.channel == cache.channel
+            ))
+        return notifications
+
+    def fileno(self) -> int:
+        """The socket of the connection isn't exposed by rust-postgres: use
+        notifies with a timeout, or AsyncConnection.notifies, to wait for
+        notifications."""
+        raise io.UnsupportedOperation(
+            'The socket of the connection is not available, '
+            'use notifies(timeout=...) to wait for notifications'
+        )
+
     def _get_query(self, sql: str, params):
         sql = sql.encode('utf-8')
-        query = Query(self._conn.new_query(sql))
-        query.add_params(params)
+        query = Query(self._conn.new_query(sql), sql, self.types)
+        if params:
+            try:
+                query.add_params(params)
+            except Exception:
+                query.close()
+                raise
         return query
 
-    def execute(self, sql: str, *args):
-        query = self._get_query(sql, args)
-        query.execute()
+    def _measured(self, sql: str, args, run):
+        """Run run(query) under a probe of the instruments, counting its
+        native calls."""
+        probe = self.instruments.probe(sql)
+        try:
+            with rust.counting(probe):
+                query = self._get_query(sql, args)
+                start = time.perf_counter()
+                value = run(query)
+        except Exception as e:
+            probe.finish(e)
+            raise
+        probe.executed(start)
+        return probe, value
+
+    def execute(self, sql: str, *args, timeout: float = None):
+        """Run a statement.
+
+        Statements still running after timeout seconds (the timeout of the
+        connection if None, no timeout by default) are canceled on the
+        server and raise QueryTimeout, as for the other methods running
+        statements.
+        """
+        with self._lock, self._deadline(timeout):
+            if self.instruments is not None:
+                probe, _ = self._measured(sql, args, Query.execute)
+                probe.finish()
+                return
+            query = self._get_query(sql, args)
+            query.execute()
+
+    def execute_script(self, sql: str, timeout: float = None):
+        """Run statements separated by semicolons in a single round trip.
+
+        Unlike execute, which only runs one statement, this uses the simple
+        query protocol, so statements are neither prepared nor cached.
+        """
+        with self._lock, self._deadline(timeout):
+            if self.instruments is not None:
+                probe, _ = self._measured(sql, (), Query.execute_script)
+                probe.finish()
+                return
+            query = self._get_query(sql, ())
+            query.execute_script()
+
+    def executemany(self, sql: str, rows: Iterable[Tuple[Any]],
+                    timeout: float = None):
+        """Execute a query once per row of parameters.
+
+        This saves preparing the statement and crossing into Rust for each
+        row, not the round trips: every row is still executed and waited for
+        on its own (see Query.execute_many).
+        """
+        with self._lock, self._deadline(timeout):
+            if self.instruments is not None:
+                probe, _ = self._measured(
+                    sql, (), lambda query: query.execute_many(rows),
+                )
+                probe.finish()
+                return
+            query = self._get_query(sql, ())
+            query.execute_many(rows)
+
+    def copy_in(self, table: str, rows: Iterable[Tuple[Any]],
+                columns: Iterable[str] = None, format: str = 'binary'):
+        """COPY rows into a table, streamed in chunks.
+
+        With the binary format, values are encoded with Query.serializers and
+        must match the column types exactly.
+        """
+        copy.copy_in(self, table, rows, columns, format)
+
+    def copy_out(self, sql: str, format: str = 'binary',
+                 raw: bool = False) -> Iterable:
+        """COPY the result of a query out, yielding decoded rows (binary
+        format only) or the raw data chunks when raw is true.
+
+        The connection is busy until the generator is exhausted or closed,
+        using it meanwhile raising SlonikException. Closing it early cancels
+        the COPY, or within a transaction() reads the rest of the data,
+        which canceling would abort.
+        """
+        return copy.copy_out(self, sql, format, raw)
+
+    def _execute_result(self, sql: str, args,
+                        fetch_size: int = DEFAULT_FETCH_SIZE,
+                        zero_copy: bool = False, row_factory=None,
+                        timeout: float = None) -> Result:
+        check_fetch_size(fetch_size)
+        row_factory = row_factory or self.row_factory
+        with self._lock, self._deadline(timeout):
+            if self.instruments is not None:
+                probe, result = self._measured(sql, args, lambda query: (
+                    query.execute_result(fetch_size, zero_copy, row_factory)
+                ))
+                result.probe = probe
+                return result
+            query = self._get_query(sql, args)
+            return query.execute_result(fetch_size, zero_copy, row_factory)
 
-    def query(self, sql: str, *args) -> Iterable[Tuple[Any]]:
-        query = self._get_query(sql, args)
-        yield from query.execute_result()
+    def _execute_stream(self, sql: str, args,
+                        batch_rows: int = DEFAULT_FETCH_SIZE,
+                        row_factory=None, timeout: float = None) -> Result:
+        check_fetch_size(batch_rows)
+        row_factory = row_factory or self.row_factory
+        # Each round trip of the stream gets the timeout
+        deadline = self._deadline(timeout)
+        with self._lock, deadline:
+            if self.instruments is not None:
+                probe, result = self._measured(sql, args, lambda query: (
+                    query.execute_stream(batch_rows, self._lock, row_factory)
+                ))
+                result.probe = probe
+            else:
+                query = self._get_query(sql, args)
+                result = query.execute_stream(
+                    batch_rows, self._lock, row_factory,
+                )
+            result.deadline = deadline
+            return result
 
-    def get_one(self, sql: str, *args) -> Tuple[Any]:
-        return next(self.query(sql, *args))
+    def query(self, sql: str, *args, fetch_size: int = DEFAULT_FETCH_SIZE,
+              row_factory=None, timeout: float = None
+              ) -> Iterable[Tuple[Any]]:
+        """Iterate over the rows of the query.
 
-    def get_value(self, sql: str, *args) -> Any:
-        value, = self.get_one(sql, *args)
+        row_factory overrides the row factory of the connection: tuple_row,
+        namedtuple_row, dict_row, class_row(cls) or any callable getting the
+        description of the result and returning the function building a row
+        from its list of values.
+        """
+        with self._execute_result(
+            sql, args, fetch_size, row_factory=row_factory, timeout=timeout,
+        ) as result:
+            yield from result
+
+    def query_result(self, sql: str, *args,
+                     fetch_size: int = DEFAULT_FETCH_SIZE,
+                     zero_copy: bool = False, row_factory=None,
+                     timeout: float = None) -> Result:
+        """Like query, but return the Result to iterate, to be closed once
+        done (e.g. in a with block).
+
+        With zero_copy, bytea values (and values of types without
+        deserializer) are memoryviews over the result's memory instead of
+        bytes copies, which pays off with large values. The memoryviews are
+        released when the result is closed, reading them then raising
+        ValueError.
+        """
+        return self._execute_result(
+            sql, args, fetch_size, zero_copy, row_factory, timeout,
+        )
+
+    def stream(self, sql: str, *args, batch_rows: int = DEFAULT_FETCH_SIZE,
+               row_factory=None, timeout: float = None
+               ) -> Iterable[Tuple[Any]]:
+        """Like query, but rows are fetched batch_rows at a time from a
+        server-side cursor, so memory stays bounded whatever the result size.
+
+        The cursor lives in the current transaction, or in a transaction of
+        its own committed once the generator is exhausted or closed.
+        Streaming in a transaction opened by running BEGIN (with execute or
+        execute_script) rather than with transaction() fails. Closing the generator early closes the cursor,
+        so the rows left are never sent. timeout applies to each batch.
+        """
+        with self._execute_stream(
+            sql, args, batch_rows, row_factory, timeout,
+        ) as result:
+            yield from result
+
+    def pipeline(self) -> Pipeline:
+        """Queue queries, run in order when leaving the with block, one
+        round trip each (see Pipeline).
+
+        >>> with conn.pipeline() as pipeline:
+        ...     count = pipeline.query('SELECT count(*) FROM foo')
+        ...     pipeline.execute('DELETE FROM foo')
+        >>> count.result()
+        [(42,)]
+        """
+        return Pipeline(self)
+
+    def query_columns(self, sql: str, *args) -> List[Column]:
+        """Fetch the whole result column by column.
+
+        Fixed-width numeric columns come back as native-endian array.array
+        objects (usable as-is with memoryview or numpy.frombuffer), other
+        columns as their raw binary values plus offsets.
+        """
+        with self._execute_result(sql, args) as result:
+            return result.columns()
+
+    def _cache_key(self, sql: str, args):
+        if not args:
+            return sql, ()
+        encoders = self.types.cached_param_encoders(sql.encode('utf-8'))
+        if encoders is None or len(encoders) != len(args):
+            return None  # known once the query ran
+        return sql, tuple(
+            None if arg is None else bytes(encode(arg))
+            for arg, encode in zip(args, encoders)
+        )
+
+    def cached(self, sql: str, *args, ttl: float = None, tags=(),
+               row_factory=None, timeout: float = None) -> List[Any]:
+        """Like list(query(...)), the result being kept in the cache of the
+        connection for ttl seconds (the default TTL of the cache if None).
+
+        Cached results are shared by the identical queries, hits not doing
+        any native call, and each call gets its own copy of the mutable
+        values. tags can be invalidated with cache.invalidate(). Within
+        transactions, whose writes other connections don't see, the query
+        always runs and its result isn't cached.
+        """
+        cache = self.cache
+        if cache is None:
+            raise SlonikException('The connection has no cache')
+        if self.in_transaction:
+            return list(self.query(
+                sql, *args, row_factory=row_factory, timeout=timeout,
+            ))
+
+        key = self._cache_key(sql, args)
+        entry = None if key is None else cache.get(key)
+        if entry is None:
+            generation = cache.generation
+            with self._execute_result(
+                sql, args, row_factory=tuple_row, timeout=timeout,
+            ) as result:
+                rows = list(result)
+            description = result.description
+            key = key or self._cache_key(sql, args)
+            if key is not None:
+                cache.put(key, description, rows, ttl, tags, generation)
+        else:
+            description, rows = entry.description, entry.rows
+
+        make_row = (row_factory or self.row_factory or tuple_row)(description)
+        return [make_row(copy_row(row)) for row in rows]
+
+    def get_one(self, sql: str, *args, row_factory=None,
+                cache_ttl: float = None, cache_tags=(), stream: bool = False,
+                timeout: float = None) -> Tuple[Any]:
+        """First row of the query, cached with cached() when cache_ttl is
+        given. Raise NoRows if there is none.
+
+        With stream, the server only sends the first row, through a cursor
+        as with stream(), instead of the whole result. This pays off with
+        large results, at the cost of a round trip to close the cursor (and
+        of a transaction outside of transactions).
+        """
+        if cache_ttl is not None:
+            rows = self.cached(
+                sql, *args, ttl=cache_ttl, tags=cache_tags,
+                row_factory=row_factory, timeout=timeout,
+            )
+            if not rows:
+                raise NoRows('The query returned no rows')
+            return rows[0]
+        if stream:
+            result = self._execute_stream(sql, args, 1, row_factory, timeout)
+        else:
+            result = self._execute_result(
+                sql, args, 1, row_factory=row_factory, timeout=timeout,
+            )
+        with result:
+            for row in result:
+                return row
+        raise NoRows('The query returned no rows')
+
+    def get_value(self, sql: str, *args, cache_ttl: float = None,
+                  cache_tags=(), stream: bool = False,
+                  timeout: float = None) -> Any:
+        value, = self.get_one(
+            sql, *args, row_factory=tuple_row, cache_ttl=cache_ttl,
+            cache_tags=cache_tags, stream=stream, timeout=timeout,
+        )
         return value
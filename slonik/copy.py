@@ -0,0 +1,278 @@
+import queue
+import struct
+import threading
+from typing import Any
+from typing import Iterable
+from typing import Tuple
+
+from slonik._native import ffi
+
+from .exceptions import SlonikException
+from .row import Row
+
+CHUNK_SIZE = 64 * 1024
+
+BINARY_HEADER = b'PGCOPY\n\xff\r\n\x00' + struct.pack('>ii', 0, 0)
+BINARY_TRAILER = struct.pack('>h', -1)
+BINARY_NULL = struct.pack('>i', -1)
+
+TEXT_ESCAPES = str.maketrans({
+    '\\': '\\\\', '\n': '\\n', '\r': '\\r', '\t': '\\t',
+})
+
+
+def quote_ident(name: str) -> str:
+    return '"' + name.replace('"', '""') + '"'
+
+
+def _chunked(parts: Iterable[bytes], chunk_size: int) -> Iterable[bytes]:
+    chunk = []
+    size = 0
+    for part in parts:
+        chunk.append(part)
+        size += len(part)
+        if size >= chunk_size:
+            yield b''.join(chunk)
+            chunk = []
+            size = 0
+    if chunk:
+        yield b''.join(chunk)
+
+
+def encode_binary(rows: Iterable[Tuple[Any]], encoders) -> Iterable[bytes]:
+    """COPY binary format, encoders being the encoders of the columns."""
+    pack_count = struct.Struct('>h').pack
+    pack_size = struct.Struct('>i').pack
+
+    yield BINARY_HEADER
+    for row in rows:
+        yield pack_count(len(row))
+        for value, encode in zip(row, encoders):
+            if value is None:
+                yield BINARY_NULL
+            else:
+                data = encode(value)
+                yield pack_size(len(data))
+                yield data
+    yield BINARY_TRAILER
+
+
+def encode_text(rows: Iterable[Tuple[Any]], encoders) -> Iterable[bytes]:
+    for row in rows:
+        line = '\t'.join(
+            '\\N' if value is None else str(value).translate(TEXT_ESCAPES)
+            for value in row
+        )
+        yield line.encode() + b'\n'
+
+
+ENCODERS = {
+    'binary': encode_binary,
+    'text': encode_text,
+}
+
+
+class BinaryDecoder:
+    """Incremental parser of the COPY binary format."""
+
+    def __init__(self, type_oids, deserializers=None):
+        deserializers = deserializers or Row.deserializers.get
+        self.deserializers = [deserializers(oid) for oid in type_oids]
+        self.buffer = bytearray()
+        self.started = False
+
+    def feed(self, data: bytes):
+        buffer = self.buffer
+        buffer += data
+        pos = 0
+
+        if not self.started:
+            if len(buffer) < len(BINARY_HEADER):
+                return []
+            extension, = struct.unpack_from('>i', buffer, 15)
+            pos = len(BINARY_HEADER) + extension
+            if len(buffer) < pos:
+                return []
+            self.started = True
+
+        rows = []
+        while len(buffer) - pos >= 2:
+            count, = struct.unpack_from('>h', buffer, pos)
+            if count == -1:
+                pos += 2
+                break
+
+            row = self._parse_row(buffer, pos + 2, count)
+            if row is None:
+                break
+            values, pos = row
+            rows.append(tuple(values))
+
+        del buffer[:pos]
+        return rows
+
+    def _parse_row(self, buffer, pos, count):
+        values = []
+        for deserializer in self.deserializers[:count]:
+            if len(buffer) - pos < 4:
+                return None
+            size, = struct.unpack_from('>i', buffer, pos)
+            pos += 4
+            if size == -1:
+                values.append(None)
+                continue
+            if len(buffer) - pos < size:
+                return None
+            value = bytes(buffer[pos:pos + size])
+            pos += size
+            if deserializer is not None:
+                value = deserializer(value)
+            values.append(value)
+        return values, pos
+
+
+class _Reader:
+    """Feeds the COPY data chunks to Rust."""
+
+    def __init__(self, chunks: Iterable[bytes]):
+        self.chunks = iter(chunks)
+        self.chunk = memoryview(b'')
+        self.error = None
+
+    def read(self, ctx, buf, size):
+        try:
+            while not self.chunk:
+                chunk = next(self.chunks, None)
+                if chunk is None:
+                    return 0
+                self.chunk = memoryview(chunk)
+
+            size = min(size, len(self.chunk))
+            ffi.memmove(buf, self.chunk[:size], size)
+            self.chunk = self.chunk[size:]
+            return size
+        except Exception as e:
+            # Raised once Rust aborted the COPY
+            self.error = e
+            return -1
+
+
+def copy_in(conn, table: str, rows: Iterable[Tuple[Any]],
+            columns: Iterable[str] = None, format: str = 'binary'):
+    if format not in ENCODERS:
+        raise ValueError(f'Unsupported COPY format {format!r}')
+
+    columns = ', '.join(map(quote_ident, columns)) if columns else ''
+    column_list = f' ({columns})' if columns else ''
+    sql = f'COPY {table}{column_list} FROM STDIN (FORMAT {format})'
+
+    encoders = None
+    if format == 'binary':
+        # Values are encoded according to the types of the columns
+        description = f'SELECT {columns or "*"} FROM {table} LIMIT 0'
+        with conn._execute_result(description, ()) as result:
+            encoders = [conn.types.encoder(c.type_oid) for c in result.description]
+
+    chunks = _chunked(ENCODERS[format](rows, encoders), CHUNK_SIZE)
+    reader = _Reader(chunks)
+    read = ffi.callback('ReadCallback', reader.read)
+
+    with conn._lock:
+        query = conn._get_query(sql, ())
+        try:
+            query.copy_in(read)
+        except SlonikException:
+            if reader.error is not None:
+                raise reader.error
+            raise
+
+
+_DONE = object()
+
+
+def copy_out(conn, sql: str, format: str = 'binary', raw: bool = False,
+             max_chunks: int = 16) -> Iterable:
+    if not raw and format != 'binary':
+        raise ValueError('Only the binary COPY format can be decoded')
+
+    if not raw:
+        description = f'SELECT * FROM ({sql}) AS copy_out LIMIT 0'
+        with conn._execute_result(description, ()) as result:
+            decoder = BinaryDecoder(
+                [c.type_oid for c in result.description], conn.types.decoder,
+            )
+
+    # Canceling the COPY would abort the transaction, which can't change
+    # while the COPY keeps the connection busy
+    cancelable = not conn.in_transaction
+
+    # Rust pushes the data from a worker thread, at most max_chunks chunks
+    # being waiting to be consumed
+    chunks = queue.Queue(max_chunks)
+    stopped = threading.Event()
+    copying = threading.Event()
+    pending = bytearray()
+    errors = []
+
+    def write(ctx, buf, size):
+        if stopped.is_set():
+            return -1
+        pending.extend(ffi.buffer(buf, size))
+        if len(pending) >= CHUNK_SIZE:
+            chunks.put(bytes(pending))
+            pending.clear()
+        return size
+
+    write = ffi.callback('WriteCallback', write)
+    copy_sql = f'COPY ({sql}) TO STDOUT (FORMAT {format})'
+
+    def work():
+        try:
+            with conn._lock:
+                query = conn._get_query(copy_sql, ())
+                # Until the end of the COPY, the connection can't be used,
+                # not even by the consumer of the rows
+                conn._lock.busy = 'a COPY'
+                copying.set()
+                try:
+                    query.copy_out(write)
+                finally:
+                    copying.clear()
+                    conn._lock.busy = None
+            if pending:
+                chunks.put(bytes(pending))
+        except Exception as e:
+            errors.append(e)
+        finally:
+            chunks.put(_DONE)
+
+    worker = threading.Thread(target=work, name='slonik-copy-out')
+    worker.start()
+    try:
+        while True:
+            chunk = chunks.get()
+            if chunk is _DONE:
+                break
+            if raw:
+                yield chunk
+            else:
+                yield from decoder.feed(chunk)
+        if errors:
+            raise errors[0]
+    finally:
+        # Abort the COPY if the generator wasn't exhausted. rust-postgres
+        # reads the rest of the data before failing, so outside of
+        # transactions the statement is canceled for the server to stop
+        # sending it. Within them, the rest is drained instead.
+        stopped.set()
+        if cancelable and copying.is_set():
+            try:
+                conn.cancel()
+            except SlonikException:
+                pass  # the rest of the data is then read
+        while worker.is_alive():
+            try:
+                chunks.get(timeout=0.1)
+            except queue.Empty:
+                pass
+        worker.join()
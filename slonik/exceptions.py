@@ -1,2 +1,14 @@
 class SlonikException(Exception):
     pass
+
+
+class PoolTimeout(SlonikException):
+    pass
+
+
+class QueryTimeout(SlonikException):
+    pass
+
+
+class NoRows(SlonikException):
+    pass
@@ -0,0 +1,74 @@
+from concurrent.futures import Future
+
+from .result import DEFAULT_FETCH_SIZE
+
+
+class Pipeline:
+    """Queue of queries run back-to-back.
+
+    Queries are only built, prepared and run, in order, when the pipeline is
+    flushed, holding the connection for the whole batch. Each query gets a
+    Future, holding either its result or its own error: a failing query
+    doesn't prevent the next ones from running.
+
+    This is not protocol-level pipelining: rust-postgres 0.15 can't send the
+    Bind/Execute messages of several statements followed by a single Sync,
+    so each query still takes its own round trip.
+    """
+
+    def __init__(self, conn):
+        self.conn = conn
+        self._queue = []
+
+    def _add(self, kind: str, sql: str, args) -> Future:
+        future = Future()
+        self._queue.append((kind, sql, args, future))
+        return future
+
+    def execute(self, sql: str, *args) -> Future:
+        """Queue a query, its future resolving to None."""
+        return self._add('execute', sql, args)
+
+    def query(self, sql: str, *args) -> Future:
+        """Queue a query, its future resolving to the list of rows."""
+        return self._add('query', sql, args)
+
+    def flush(self):
+        queue, self._queue = self._queue, []
+        with self.conn._lock:
+            for kind, sql, args, future in queue:
+                try:
+                    query = self.conn._get_query(sql, args)
+                    if kind == 'execute':
+                        with self.conn._deadline():
+                            query.execute()
+                        value = None
+                    else:
+                        with self.conn._deadline():
+                            result = query.execute_result(
+                                DEFAULT_FETCH_SIZE,
+                                row_factory=self.conn.row_factory,
+                            )
+                        with result:
+                            value = list(result)
+                except Exception as e:
+                    future.set_exception(e)
+                else:
+                    future.set_result(value)
+
+    def discard(self):
+        queue, self._queue = self._queue, []
+        for *_, future in queue:
+            future.cancel()
+
+    def __len__(self):
+        return len(self._queue)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.flush()
+        else:
+            self.discard()
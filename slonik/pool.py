@@ -0,0 +1,216 @@
+import collections
+import contextlib
+import threading
+import time
+from typing import Iterator
+
+from .connection import Connection
+from .exceptions import PoolTimeout
+from .exceptions import SlonikException
+from .stats import merge
+
+
+class Pool:
+    """Thread-safe pool of connections.
+
+    Connections are checked out with the connection() context manager,
+    pinged before being handed out, closed when idle for more than max_idle
+    seconds (keeping at least min_size of them) and recycled after
+    max_lifetime seconds.
+    """
+
+    def __init__(self, dsn: str, min_size: int = 1, max_size: int = 10,
+                 timeout: float = 30., max_idle: float = 600.,
+                 max_lifetime: float = 3600., **kwargs):
+        if not 0 <= min_size <= max_size or max_size < 1:
+            raise ValueError(
+                f'Invalid pool size: min_size={min_size!r}, '
+                f'max_size={max_size!r}'
+            )
+
+        self.dsn = dsn
+        self.min_size = min_size
+        self.max_size = max_size
+        self.timeout = timeout
+        self.max_idle = max_idle
+        self.max_lifetime = max_lifetime
+        self.kwargs = kwargs
+
+        self._cond = threading.Condition()
+        self._idle = collections.deque()  # (connection, released at)
+        self._created = {}  # connection -> created at
+        self._connecting = 0
+        self._closed = False
+
+        for _ in range(min_size):
+            conn = self._connect()
+            self._created[conn] = time.monotonic()
+            self._idle.append((conn, time.monotonic()))
+
+    @classmethod
+    def from_env(cls, min_size: int = 1, max_size: int = 10,
+                 timeout: float = 30., max_idle: float = 600.,
+                 max_lifetime: float = 3600., **kwargs):
+        env = {key: kwargs.pop(key) for key in list(kwargs)
+               if key.startswith('pg')}
+        dsn = Connection.from_env(**env).dsn
+        return cls(dsn, min_size, max_size, timeout, max_idle, max_lifetime,
+                   **kwargs)
+
+    @property
+    def size(self) -> int:
+        return len(self._created) + self._connecting
+
+    def _connect(self) -> Connection:
+        conn = Connection(self.dsn, **self.kwargs)
+        conn._conn  # connect now so errors are raised on checkout
+        return conn
+
+    def _discard(self, conn: Connection, discarded: list):
+        # Called with the lock held, the connections being closed once it
+        # is released
+        self._created.pop(conn, None)
+        discarded.append(conn)
+
+    @staticmethod
+    def _close(conns):
+        for conn in conns:
+            try:
+                conn.close()
+            except SlonikException:
+                pass
+
+    def _expired(self, conn: Connection, now: float) -> bool:
+        return now - self._created[conn] > self.max_lifetime
+
+    def _reap(self, now: float, discarded: list):
+        # The least recently released connections are on the left
+        while (self.size > self.min_size and self._idle and
+               now - self._idle[0][1] > self.max_idle):
+            conn, _ = self._idle.popleft()
+            self._discard(conn, discarded)
+
+    def _check(self, conn: Connection) -> bool:
+        try:
+            conn.execute('SELECT 1')
+        except SlonikException:
+            return False
+        return True
+
+    def acquire(self, timeout: float = None) -> Connection:
+        timeout = self.timeout if timeout is None else timeout
+        deadline = time.monotonic() + timeout
+
+        while True:
+            conn = None
+            reserved = False
+            discarded = []
+            try:
+                with self._cond:
+                    while conn is None:
+                        if self._closed:
+                            raise SlonikException('Pool is closed')
+
+                        now = time.monotonic()
+                        self._reap(now, discarded)
+                        if self._idle:
+                            conn, _ = self._idle.pop()
+                            if self._expired(conn, now):
+                                self._discard(conn, discarded)
+                                conn = None
+                                continue
+                            break
+
+                        if self.size < self.max_size:
+                            # Reserve the slot, connect outside of the lock
+                            self._connecting += 1
+                            reserved = True
+                            break
+
+                        if discarded:
+                            break  # close them before waiting
+
+                        if not self._cond.wait(deadline - now):
+                            raise PoolTimeout(
+                                f'No connection available after {timeout}s'
+                            )
+            finally:
+                self._close(discarded)
+
+            if reserved:
+                try:
+                    conn = self._connect()
+                finally:
+                    with self._cond:
+                        self._connecting -= 1
+                        if conn is not None:
+                            self._created[conn] = time.monotonic()
+                        self._cond.notify()
+                return conn
+
+            if conn is None:
+                continue
+
+            if self._check(conn):
+                return conn
+
+            with self._cond:
+                self._discard(conn, discarded)
+                self._cond.notify()
+            self._close(discarded)
+
+    def _reset(self, conn: Connection) -> bool:
+        # Roll back the transactions left open, so that they don't leak to
+        # the next user of the connection
+        try:
+            conn._rollback()
+        except SlonikException:
+            return False
+        return True
+
+    def release(self, conn: Connection):
+        reset = self._reset(conn)
+        discarded = []
+        with self._cond:
+            now = time.monotonic()
+            if not reset or self._closed or self._expired(conn, now):
+                self._discard(conn, discarded)
+            else:
+                self._idle.append((conn, now))
+            self._cond.notify()
+        self._close(discarded)
+
+    @contextlib.contextmanager
+    def connection(self, timeout: float = None) -> Iterator[Connection]:
+        conn = self.acquire(timeout)
+        try:
+            yield conn
+        finally:
+            self.release(conn)
+
+    def stats(self) -> dict:
+        """Statistics of the statements of all the connections, created
+        with instrument=True, see Connection.stats."""
+        with self._cond:
+            conns = list(self._created)
+        snapshots = [
+            conn.instruments.snapshot() for conn in conns
+            if conn.instruments is not None
+        ]
+        return {key: stats.as_dict() for key, stats in merge(snapshots).items()}
+
+    def close(self):
+        discarded = []
+        with self._cond:
+            self._closed = True
+            while self._idle:
+                conn, _ = self._idle.pop()
+                self._discard(conn, discarded)
+            self._cond.notify_all()
+        self._close(discarded)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
@@ -1,63 +1,357 @@
+import array
+import datetime
+import decimal
+import json
 import struct
+import sys
 
 from slonik import rust
 from slonik._native import ffi
 from slonik._native import lib
 
+from .exceptions import SlonikException
 from .result import _Result
+from .result import _Stream
+from .result import DEFAULT_FETCH_SIZE
 from .result import Result
+from .row import ARRAY_FORMATS
+from .row import EPOCH
+from .row import EPOCH_DATE
+from .row import EPOCH_TZ
+from .row import NUMERIC_NEGATIVE
 
+MICROSECOND = datetime.timedelta(microseconds=1)
 
-def get_serializer(typename, fmt):
-    fmt = '>' + fmt
 
-    def pack(value):
-        return typename, struct.pack(fmt, value)
+def get_serializer(fmt):
+    return struct.Struct('>' + fmt).pack
 
-    return pack
+
+def encode_bool(value) -> bytes:
+    if not isinstance(value, bool):
+        raise TypeError(f'Expected a bool, got {value!r}')
+    return b'\x01' if value else b'\x00'
+
+
+def encode_text(value) -> bytes:
+    return value.encode()
+
+
+def encode_bytea(value) -> bytes:
+    return memoryview(value).tobytes()
+
+
+def encode_json(value) -> bytes:
+    return json.dumps(value).encode()
+
+
+def encode_date(value) -> bytes:
+    return struct.pack('>i', (value - EPOCH_DATE).days)
+
+
+def encode_timestamp(value) -> bytes:
+    return struct.pack('>q', (value - EPOCH) // MICROSECOND)
+
+
+def encode_timestamptz(value) -> bytes:
+    # Naive datetimes are taken as UTC
+    if value.tzinfo is None:
+        value = value.replace(tzinfo=datetime.timezone.utc)
+    return struct.pack('>q', (value - EPOCH_TZ) // MICROSECOND)
+
+
+def encode_numeric(value) -> bytes:
+    if isinstance(value, float):
+        value = decimal.Decimal(repr(value))
+    elif isinstance(value, int):
+        value = decimal.Decimal(value)
+    elif not isinstance(value, decimal.Decimal):
+        raise TypeError(f'Expected a number, got {value!r}')
+
+    if value.is_nan():
+        return struct.pack('>hhHH', 0, 0, 0xC000, 0)
+    if value.is_infinite():
+        return struct.pack('>hhHH', 0, 0, 0xF000 if value < 0 else 0xD000, 0)
+
+    sign, digits, exponent = value.as_tuple()
+    digits = ''.join(map(str, digits))
+    if exponent > 0:
+        digits += '0' * exponent
+        exponent = 0
+    dscale = -exponent
+
+    # Pad the integral and fractional parts to groups of 4 digits
+    integral = len(digits) - dscale
+    if integral < 0:
+        digits = '0' * -integral + digits
+        integral = 0
+    left = -integral % 4
+    digits = '0' * left + digits + '0' * (-dscale % 4)
+    groups = [int(digits[i:i + 4]) for i in range(0, len(digits), 4)]
+    weight = (integral + left) // 4 - 1
+
+    while groups and groups[0] == 0:
+        groups.pop(0)
+        weight -= 1
+    while groups and groups[-1] == 0:
+        groups.pop()
+    if not groups:
+        weight = 0
+
+    return struct.pack(
+        f'>hhHH{len(groups)}h', len(groups), weight,
+        NUMERIC_NEGATIVE if sign else 0, dscale, *groups,
+    )
+
+
+def pack_fixed_array(values, fmt: str) -> bytes:
+    """Pack fixed-width elements with their size prefixes, in one pass for
+    the values and one strided copy per byte of the elements."""
+    if isinstance(values, array.array) and values.typecode == fmt:
+        values = array.array(fmt, values)
+        if sys.byteorder == 'little':
+            values.byteswap()
+        packed = values.tobytes()
+    else:
+        packed = struct.pack(f'>{len(values)}{fmt}', *values)
+
+    count = len(values)
+    width = struct.calcsize(fmt)
+    stride = 4 + width
+    data = bytearray(count * stride)
+    for i, byte in enumerate(struct.pack('>i', width)):
+        data[i::stride] = bytes([byte]) * count
+    for i in range(width):
+        data[4 + i::stride] = packed[i::width]
+    return data
+
+
+def array_dims(values):
+    dims = []
+    while isinstance(values, (list, array.array)):
+        dims.append(len(values))
+        if not values:
+            break
+        values = values[0]
+    return dims
+
+
+def flatten_array(values, dims):
+    if len(values) != dims[0]:
+        raise ValueError('Sub-arrays must have matching dimensions')
+    if len(dims) == 1:
+        return values
+
+    flat = []
+    for value in values:
+        if not isinstance(value, (list, array.array)):
+            raise ValueError('Sub-arrays must have matching dimensions')
+        flat.extend(flatten_array(value, dims[1:]))
+    return flat
+
+
+def encode_array(oid: int, encode, values) -> bytes:
+    """Encode a (nested) list or an array.array, oid and encode being the
+    type OID and the encoder of the elements."""
+    dims = array_dims(values)
+    if not dims:
+        raise TypeError(f'Expected a list, got {values!r}')
+    if not all(dims):
+        return struct.pack('>iiI', 0, 0, oid)
+
+    header = struct.pack(f'>iiI{len(dims) * 2}i', len(dims), 0, oid, *(
+        value for dim in dims for value in (dim, 1)
+    ))
+
+    fmt = ARRAY_FORMATS.get(oid)
+    if fmt is not None and len(dims) == 1:
+        try:
+            return header + pack_fixed_array(values, fmt)
+        except (struct.error, TypeError):
+            pass  # NULL elements, or values to report through encode
+
+    parts = [header]
+    has_null = False
+    pack_size = struct.Struct('>i').pack
+    for value in flatten_array(values, dims):
+        if value is None:
+            has_null = True
+            parts.append(pack_size(-1))
+        else:
+            data = encode(value)
+            parts.append(pack_size(len(data)))
+            parts.append(data)
+
+    if has_null:
+        parts[0] = header[:4] + pack_size(1) + header[8:]
+    return b''.join(parts)
 
 
 class _Query(rust.RustObject):
-    def add_param(self, typename: bytes, value: bytes):
-        typename = ffi.from_buffer(typename)
-        value = ffi.from_buffer(value)
-        self._methodcall(lib.query_param, ((len(typename), typename), (len(value), value)))
+    def bind(self, values):
+        """Bind the encoded values of the parameters (None for NULL), packed
+        into a single buffer handed over in one call."""
+        sizes = ffi.new(
+            'int32_t[]', [-1 if value is None else len(value) for value in values],
+        )
+        data = b''.join([value for value in values if value is not None])
+        self._methodcall(
+            lib.query_params, ffi.from_buffer(data), len(data), sizes,
+            len(values),
+        )
+
+    def param_types(self):
+        oids = ffi.new('uint32_t[]', 16)
+        count = ffi.new('uintptr_t *')
+        self._methodcall(lib.query_param_types, oids, len(oids), count)
+        if count[0] > len(oids):
+            oids = ffi.new('uint32_t[]', count[0])
+            self._methodcall(lib.query_param_types, oids, len(oids), count)
+        return list(oids[0:count[0]])
 
     def execute(self):
         self._methodcall(lib.query_exec)
 
+    def execute_script(self):
+        self._methodcall(lib.query_exec_script)
+
+    def execute_many(self, data: bytes, sizes, nrows: int, nparams: int):
+        self._methodcall(
+            lib.query_exec_many, ffi.from_buffer(data), len(data), sizes,
+            nrows, nparams,
+        )
+
+    def copy_in(self, read):
+        self._methodcall(lib.query_copy_in, read, ffi.NULL)
+
+    def copy_out(self, write):
+        self._methodcall(lib.query_copy_out, write, ffi.NULL)
+
     def execute_result(self):
         result = self._methodcall(lib.query_exec_result)
         return _Result._from_objptr(result)
 
-    # TODO: Add a close method called if Query is cancelled (or called everytime?)
+    def execute_stream(self, batch_rows: int):
+        stream = self._methodcall(lib.query_exec_stream, batch_rows)
+        return _Stream._from_objptr(stream)
+
+    def close(self):
+        self._methodcall(lib.query_close)
 
 
 class Query:
-    serializers = {
-        int: get_serializer(b'int4', 'i'),
-        float: get_serializer(b'float8', 'd'),
-        str: lambda s: (b'text', s.encode()),
+    # Encoders of the parameters by type OID, to the binary format
+    encoders = {
+        16: encode_bool,  # bool
+        21: get_serializer('h'),  # int2
+        23: get_serializer('i'),  # int4
+        20: get_serializer('q'),  # int8
+        26: get_serializer('I'),  # oid
+        700: get_serializer('f'),  # float4
+        701: get_serializer('d'),  # float8
+        1700: encode_numeric,  # numeric
+        25: encode_text,  # text
+        18: encode_text,  # "char"
+        19: encode_text,  # name
+        705: encode_text,  # unknown
+        1042: encode_text,  # bpchar
+        1043: encode_text,  # varchar
+        17: encode_bytea,  # bytea
+        114: encode_json,  # json
+        3802: lambda value: b'\x01' + encode_json(value),  # jsonb
+        2950: lambda value: value.bytes,  # uuid
+        1082: encode_date,  # date
+        1114: encode_timestamp,  # timestamp
+        1184: encode_timestamptz,  # timestamptz
     }
 
-    def __init__(self, _query):
+    def __init__(self, _query, sql: bytes, types):
         self._query = _query
-        self.params = []
-
-    def add_param(self, param):
-        serializer = self.serializers[type(param)]
-        typename, value = serializer(param)
+        self.sql = sql
+        self.types = types
 
-        self.params.append((typename, value))
-        self._query.add_param(typename, value)
+    def param_types(self):
+        """Type OIDs of the parameters, as described by the server."""
+        return self._query.param_types()
 
     def add_params(self, params):
-        for param in params:
-            self.add_param(param)
+        encoders = self.types.param_encoders(self)
+        if len(params) != len(encoders):
+            raise SlonikException(
+                f'expected {len(encoders)} parameters but got {len(params)}'
+            )
+
+        self._query.bind([
+            None if param is None else encode(param)
+            for param, encode in zip(params, encoders)
+        ])
 
     def execute(self):
         self._query.execute()
 
-    def execute_result(self):
-        with Result(self._query.execute_result()) as result:
-            yield from result
+    def execute_script(self):
+        self._query.execute_script()
+
+    def execute_many(self, rows):
+        """Execute the query once per row of parameters.
+
+        All the rows are serialized in one pass into a single buffer, handed
+        over to Rust in one call, and the statement is prepared once. Each row
+        is still its own Bind/Execute/Sync round trip, rust-postgres 0.15
+        having no way to send them in one batch.
+        """
+        try:
+            data, sizes, nrows, nparams = self._pack_rows(rows)
+        except Exception:
+            self.close()
+            raise
+
+        self._query.execute_many(data, sizes, nrows, nparams)
+
+    def _pack_rows(self, rows):
+        encoders = self.types.param_encoders(self)
+        nparams = len(encoders)
+        values = []
+        sizes = []  # -1 for NULL
+        nrows = 0
+
+        for row in rows:
+            nrows += 1
+            if len(row) != nparams:
+                raise ValueError(
+                    f'Expected {nparams} parameters, got {len(row)}: {row!r}'
+                )
+            for param, encode in zip(row, encoders):
+                if param is None:
+                    sizes.append(-1)
+                    continue
+                value = encode(param)
+                values.append(value)
+                sizes.append(len(value))
+
+        # The same layout as _Query.bind, split into rows by Rust
+        data = b''.join(values)
+        return data, ffi.new('int32_t[]', sizes or 1), nrows, nparams
+
+    def close(self):
+        self._query.close()
+
+    def copy_in(self, read):
+        self._query.copy_in(read)
+
+    def copy_out(self, write):
+        self._query.copy_out(write)
+
+    def execute_result(self, fetch_size: int = DEFAULT_FETCH_SIZE,
+                       zero_copy: bool = False, row_factory=None) -> Result:
+        return Result(
+            self._query.execute_result(), fetch_size, None, zero_copy,
+            self.types.decoder, row_factory,
+        )
+
+    def execute_stream(self, batch_rows: int = DEFAULT_FETCH_SIZE,
+                       lock=None, row_factory=None) -> Result:
+        return Result(
+            self._query.execute_stream(batch_rows), batch_rows, lock, False,
+            self.types.decoder, row_factory,
+        )
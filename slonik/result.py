@@ -1,44 +1,281 @@
+import array
+import contextlib
+import functools
+import time
+from collections import namedtuple
+
 from slonik import rust
 from slonik._native import ffi
 from slonik._native import lib
 
-from .row import _Row
 from .row import Row
 
+DEFAULT_FETCH_SIZE = 100
+
+# A whole result column. Fixed-width types get their values decoded in a
+# native-endian array.array, other types get their raw values concatenated in
+# a bytearray, value i being data[offsets[i]:offsets[i + 1]]. nulls holds 1 for
+# each NULL value.
+Column = namedtuple('Column', ['name', 'typename', 'values', 'offsets', 'nulls'])
+
+# Description of a result column, format being 1 for binary
+Description = namedtuple('Description', ['name', 'type_oid', 'typename', 'format'])
+
+
+def check_fetch_size(fetch_size: int):
+    if fetch_size < 1:
+        raise ValueError(f'fetch_size must be positive, got {fetch_size!r}')
+
+
+def describe(items):
+    return [
+        Description(
+            rust.buff_to_bytes(item.name).decode(), item.oid,
+            rust.buff_to_bytes(item.typename).decode(), item.format,
+        )
+        for item in items
+    ]
+
+
+# Row factories get the description of a result, once, and return the
+# function building a row from the list of its values
+
+
+def tuple_row(description):
+    """Rows as plain tuples, the default."""
+    return tuple
+
+
+@functools.lru_cache(maxsize=128)
+def _namedtuple(names):
+    # Invalid or duplicate column names get positional names (_0, _1…)
+    return namedtuple('Row', names, rename=True)
+
+
+def namedtuple_row(description):
+    """Rows as named tuples, one class being built per set of column
+    names."""
+    return _namedtuple(tuple(column.name for column in description))._make
+
+
+def dict_row(description):
+    """Rows as dicts keyed by column name."""
+    names = [column.name for column in description]
+    return lambda values: dict(zip(names, values))
+
+
+def class_row(cls):
+    """Rows as instances of cls (e.g. a dataclass), built with the columns
+    as keyword arguments.
+
+    >>> conn.query('SELECT id, name FROM users', row_factory=class_row(User))
+    """
+    def factory(description):
+        names = [column.name for column in description]
+        return lambda values: cls(**dict(zip(names, values)))
+
+    return factory
+
 
 class _Result(rust.RustObject):
-    def next_row(self):
-        row = self._methodcall(lib.next_row)
-        if row == ffi.NULL:
-            return
-        return _Row._from_objptr(row)
+    def ncols(self):
+        return self._methodcall(lib.result_ncols)
+
+    def nrows(self):
+        return self._methodcall(lib.result_nrows)
+
+    def columns(self, ncols: int):
+        items = ffi.new('ColumnItem[]', ncols)
+        self._methodcall(lib.result_columns, items, ncols)
+        return describe(items)
+
+    def column_fixed(self, i: int, values, nulls):
+        self._methodcall(
+            lib.column_fixed, i, values.itemsize,
+            ffi.from_buffer(values), ffi.from_buffer(nulls),
+        )
+
+    def column_size(self, i: int) -> int:
+        return self._methodcall(lib.column_size, i)
+
+    def column_varlen(self, i: int, offsets, data, nulls):
+        self._methodcall(
+            lib.column_varlen, i, ffi.from_buffer('uint64_t[]', offsets),
+            ffi.from_buffer(data), ffi.from_buffer(nulls),
+        )
+
+    def next_rows(self, items, nrows: int, ncols: int) -> int:
+        return self._methodcall(lib.next_rows, items, nrows, ncols)
 
     def close(self):
         self._methodcall(lib.result_close)
 
 
+class _Stream(rust.RustObject):
+    def ncols(self):
+        return self._methodcall(lib.stream_ncols)
+
+    def columns(self, ncols: int):
+        items = ffi.new('ColumnItem[]', ncols)
+        self._methodcall(lib.stream_columns, items, ncols)
+        return describe(items)
+
+    def next_rows(self, items, nrows: int, ncols: int) -> int:
+        count = ffi.new('uintptr_t *')
+        self._methodcall(lib.stream_next_rows, items, nrows, ncols, count)
+        return count[0]
+
+    def close(self):
+        self._methodcall(lib.stream_close)
+
+
 class Result:
-    def __init__(self, _result):
+    # slonik.stats.Probe measuring the statement, on instrumented connections
+    probe = None
+    # slonik.watchdog.Deadline of the fetches of streams
+    deadline = contextlib.nullcontext()
+
+    # array.array typecodes of the types decoded natively by column_fixed
+    # by type OID
+    column_typecodes = {
+        16: 'B',  # bool
+        21: 'h',  # int2
+        23: 'i',  # int4
+        20: 'q',  # int8
+        26: 'I',  # oid
+        700: 'f',  # float4
+        701: 'd',  # float8
+    }
+
+    def __init__(self, _result, fetch_size: int = DEFAULT_FETCH_SIZE,
+                 lock=None, zero_copy: bool = False, deserializers=None,
+                 row_factory=None):
+        # With zero_copy, raw values without deserializer are memoryviews
+        # over the result's memory, released once it is closed.
+        # deserializers gives the deserializer of a type OID, row_factory
+        # builds the rows (tuple_row by default).
         self._result = _result
+        self.fetch_size = fetch_size
+        # Held while fetching from results reading from the connection
+        self._lock = lock or contextlib.nullcontext()
+        self._views = [] if zero_copy else None
+        try:
+            check_fetch_size(fetch_size)
+            self._ncols = _result.ncols()
+            self.description = _result.columns(self._ncols)
+            self._decoders = Row.decoders(
+                [column.type_oid for column in self.description], zero_copy,
+                deserializers, self._views,
+            )
+            self._make_row = (row_factory or tuple_row)(self.description)
+        except BaseException:
+            # Nobody else can free the native result (or stream)
+            with self._lock:
+                _result.close()
+            raise
+        # Reused for every chunk, the items only live until they are decoded
+        self._items = ffi.new('RowItem[]', fetch_size * self._ncols or 1)
+        self._rows = iter(())
 
     def __iter__(self):
         return self
 
     def __next__(self):
+        row = next(self._rows, None)
+        if row is None:
+            self._rows = iter(self._fetch())
+            row = next(self._rows, None)
+            if row is None:
+                raise StopIteration
+        return row
+
+    def _fetch(self):
+        """Fetch and decode the next chunk of rows, empty once exhausted."""
         if self._result is None:
-            raise StopIteration
+            return []
+
+        probe = self.probe
+        if probe is not None:
+            return self._measured_fetch(probe)
+
+        items, ncols = self._items, self._ncols
+        with self._lock, self.deadline:
+            count = self._result.next_rows(items, self.fetch_size, ncols)
+        return self._decode(items, ncols, count)
+
+    def _decode(self, items, ncols, count):
+        make_row = self._make_row
+        if not ncols:
+            return [make_row([]) for _ in range(count)]
+
+        decoders = self._decoders
+        return [
+            make_row([
+                decode[item.tag](item)
+                for decode, item in zip(decoders, items[start:start + ncols])
+            ])
+            for start in range(0, count * ncols, ncols)
+        ]
+
+    def _measured_fetch(self, probe):
+        items, ncols = self._items, self._ncols
+        start = time.perf_counter()
+        try:
+            with self._lock, self.deadline, rust.counting(probe):
+                count = self._result.next_rows(items, self.fetch_size, ncols)
+        except Exception as e:
+            probe.finish(e)
+            raise
+        fetched = time.perf_counter()
+        probe.executed(start)
+
+        rows = self._decode(items, ncols, count)
+        nbytes = sum(item.value.size for item in items[0:count * ncols])
+        probe.fetched(count, nbytes, time.perf_counter() - fetched)
+        return rows
+
+    def columns(self):
+        if self._result is None:
+            return []
+
+        nrows = self._result.nrows()
+        return [self._column(i, nrows) for i in range(self._ncols)]
+
+    def _column(self, i, nrows):
+        name, type_oid, typename, _ = self.description[i]
+        nulls = bytearray(nrows)
 
-        _row = self._result.next_row()
-        if _row is None:
-            raise StopIteration
+        typecode = self.column_typecodes.get(type_oid)
+        if typecode is not None:
+            values = array.array(typecode)
+            values.frombytes(bytes(nrows * values.itemsize))
+            self._result.column_fixed(i, values, nulls)
+            return Column(name, typename, values, None, nulls)
 
-        with Row(_row) as row:
-            return tuple(row)
+        offsets = array.array('Q')
+        offsets.frombytes(bytes((nrows + 1) * offsets.itemsize))
+        data = bytearray(self._result.column_size(i))
+        self._result.column_varlen(i, offsets, data, nulls)
+        return Column(name, typename, data, offsets, nulls)
 
     def close(self):
+        if self._views:
+            # Reading them past this point would read freed memory
+            for view in self._views:
+                view.release()
+            self._views.clear()
         if self._result is not None:
-            self._result.close()
+            probe = self.probe
+            if probe is not None:
+                with self._lock, rust.counting(probe):
+                    self._result.close()
+                probe.finish()
+            else:
+                with self._lock:
+                    self._result.close()
         self._result = None
+        self._items = None
+        self._rows = iter(())
 
     def __enter__(self):
         return self
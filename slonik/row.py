@@ -1,10 +1,38 @@
+import array
+import datetime
+import decimal
 import json
 import struct
+import sys
 import uuid
 
-from slonik import rust
 from slonik._native import ffi
-from slonik._native import lib
+
+# Tags of the values decoded natively, must match rust/src/row.rs
+(TAG_NULL, TAG_RAW, TAG_INT, TAG_FLOAT, TAG_BOOL, TAG_TEXT, TAG_UUID,
+ TAG_DATE, TAG_TIMESTAMP, TAG_TIMESTAMPTZ, TAG_JSON, TAG_JSONB) = range(12)
+
+# Dates and timestamps are relative to the Postgres epoch
+EPOCH_DATE = datetime.date(2000, 1, 1)
+EPOCH = datetime.datetime(2000, 1, 1)
+EPOCH_TZ = datetime.datetime(2000, 1, 1, tzinfo=datetime.timezone.utc)
+
+# Element type OIDs of the builtin array types
+ARRAY_TYPES = {
+    1000: 16, 1001: 17, 1003: 19, 1005: 21, 1007: 23, 1009: 25, 1014: 1042,
+    1015: 1043, 1016: 20, 1021: 700, 1022: 701, 1028: 26, 1115: 1114,
+    1182: 1082, 1185: 1184, 1231: 1700, 199: 114, 2951: 2950, 3807: 3802,
+}
+
+# struct (and array) formats of the fixed-width array elements, by type OID
+ARRAY_FORMATS = {21: 'h', 23: 'i', 20: 'q', 26: 'I', 700: 'f', 701: 'd'}
+
+NUMERIC_NEGATIVE = 0x4000
+NUMERIC_SPECIALS = {
+    0xC000: decimal.Decimal('NaN'),
+    0xD000: decimal.Decimal('Infinity'),
+    0xF000: decimal.Decimal('-Infinity'),
+}
 
 
 def get_deserializer(fmt):
@@ -17,68 +45,275 @@ def get_deserializer(fmt):
     return unpack
 
 
-class _Row(rust.RustObject):
-    def len(self):
-        return self._methodcall(lib.row_len)
+def decode_text(value):
+    # str() decodes any buffer, without copying memoryviews to bytes first
+    return str(value, 'utf-8')
 
-    def item(self, i):
-        item = self._methodcall(lib.row_item, i)
-        typename = rust.buff_to_bytes(item.typename)
-        value = rust.buff_to_bytes(item.value)
-        return typename, value
 
-    def close(self):
-        self._methodcall(lib.row_close)
+def date_from_days(days: int) -> datetime.date:
+    try:
+        return EPOCH_DATE + datetime.timedelta(days=days)
+    except OverflowError:  # infinity
+        return datetime.date.max if days > 0 else datetime.date.min
 
 
-class Row:
-    deserializers = {
-        b'int2': get_deserializer('h'),
-        b'int4': get_deserializer('i'),
-        b'int8': get_deserializer('q'),
-        b'float8': get_deserializer('d'),
-        b'text': lambda value: value.decode(),
-        b'unknown': lambda value: value.decode(),
-        b'bpchar': lambda value: value.decode(),
-        b'varchar': lambda value: value.decode(),
-        b'json': json.loads,
-        b'jsonb': lambda value: json.loads(value[1:]),  # always start with '1'
-        b'uuid': lambda value: uuid.UUID(bytes=value),
-    }
+def timestamp_from_micros(micros: int, epoch=EPOCH) -> datetime.datetime:
+    try:
+        return epoch + datetime.timedelta(microseconds=micros)
+    except OverflowError:  # infinity
+        limit = datetime.datetime.max if micros > 0 else datetime.datetime.min
+        return limit.replace(tzinfo=epoch.tzinfo)
+
+
+def decode_numeric(value) -> decimal.Decimal:
+    ndigits, weight, sign, dscale = struct.unpack_from('>hhHH', value)
+    if sign in NUMERIC_SPECIALS:
+        return NUMERIC_SPECIALS[sign]
+
+    # base 10000 digits, the last one being at 10000 ** (weight - ndigits + 1)
+    digits = ''.join(
+        f'{digit:04d}' for digit in struct.unpack_from(f'>{ndigits}h', value, 8)
+    )
+    exponent = (weight - ndigits + 1) * 4
+    # Pad or trim the trailing zeros to get dscale decimal digits
+    trim = -exponent - dscale
+    if trim > 0:
+        digits = digits[:-trim]
+    else:
+        digits += '0' * -trim
+    exponent += trim
+
+    return decimal.Decimal(
+        (sign == NUMERIC_NEGATIVE, tuple(map(int, digits)) or (0,), exponent)
+    )
+
 
-    def __init__(self, _row):
-        self._row = _row
-        self._len = None
+def unpack_fixed_array(value, pos: int, count: int, fmt: str) -> array.array:
+    """Unpack count fixed-width elements without NULL, stripping their size
+    prefixes with one strided copy per byte of the elements."""
+    values = array.array(fmt)
+    width = values.itemsize
+    stride = 4 + width
+    end = pos + count * stride
+    packed = bytearray(count * width)
+    for i in range(width):
+        packed[i::width] = bytes(value[pos + 4 + i:end:stride])
 
-    def __len__(self):
-        if self._len is None:
-            if self._row is None:
-                self._len = 0
+    values.frombytes(packed)
+    if sys.byteorder == 'little':
+        values.byteswap()
+    return values
+
+
+def decode_array(value, deserializers=None):
+    """Decode an array into (nested) lists, deserializers giving the
+    deserializer of the elements from their type OID."""
+    ndim, has_null, oid = struct.unpack_from('>iiI', value)
+    if not ndim:
+        return []
+
+    dims = struct.unpack_from(f'>{ndim * 2}i', value, 12)[::2]
+    deserializer = (deserializers or Row.deserializers.get)(oid)
+    pos = 12 + ndim * 8
+
+    fmt = ARRAY_FORMATS.get(oid)
+    if (ndim == 1 and not has_null and fmt is not None
+            and deserializer is Row.deserializers.get(oid)):
+        return unpack_fixed_array(value, pos, dims[0], fmt).tolist()
+
+    deserializer = deserializer or bytes
+
+    def read(dims):
+        nonlocal pos
+        if len(dims) > 1:
+            return [read(dims[1:]) for _ in range(dims[0])]
+
+        values = []
+        for _ in range(dims[0]):
+            size, = struct.unpack_from('>i', value, pos)
+            pos += 4
+            if size == -1:
+                values.append(None)
             else:
-                self._len = self._row.len()
-        return self._len
+                values.append(deserializer(value[pos:pos + size]))
+                pos += size
+        return values
+
+    return read(dims)
+
+
+def decode_array_buffer(value, deserializers=None):
+    """Like decode_array, but one-dimensional arrays of fixed-width types
+    without NULL are returned as array.array objects.
+
+    >>> conn.register_type('int8[]', decode=decode_array_buffer)
+    """
+    ndim, has_null, oid = struct.unpack_from('>iiI', value)
+    fmt = ARRAY_FORMATS.get(oid)
+    if ndim == 1 and not has_null and fmt is not None:
+        count, = struct.unpack_from('>i', value, 12)
+        return unpack_fixed_array(value, 20, count, fmt)
+    return decode_array(value, deserializers)
+
+
+def decode_record(value, deserializers=None):
+    """Decode a composite value into a tuple, the fields without
+    deserializer as bytes."""
+    deserializers = deserializers or Row.deserializers.get
+    count, = struct.unpack_from('>i', value)
+    pos = 4
 
-    def __getitem__(self, i):
-        if not 0 <= i < len(self):
-            raise IndexError(f'Index {i!r} out fo range')
+    values = []
+    for _ in range(count):
+        oid, size = struct.unpack_from('>Ii', value, pos)
+        pos += 8
+        if size == -1:
+            values.append(None)
+            continue
 
-        typename, value = self._row.item(i)
-        if typename is None:
-            return
+        data = value[pos:pos + size]
+        pos += size
+        deserializer = deserializers(oid)
+        # Copied, value may be a zero-copy memoryview released later on
+        values.append(
+            bytes(data) if deserializer is None else deserializer(data)
+        )
+    return tuple(values)
 
-        deserializer = self.deserializers.get(typename)
-        if deserializer is not None:
-            value = deserializer(value)
 
+def decode_null(item):
+    return None
+
+
+def decode_int(item):
+    return item.int_value
+
+
+def decode_float(item):
+    return item.float_value
+
+
+def decode_bool(item):
+    return item.int_value != 0
+
+
+def decode_text_item(item):
+    value = item.value
+    return str(ffi.buffer(value.bytes, value.size), 'utf-8')
+
+
+def decode_uuid_item(item):
+    value = item.value
+    return uuid.UUID(bytes=ffi.buffer(value.bytes, value.size)[:])
+
+
+def decode_json_item(item):
+    return json.loads(decode_text_item(item))
+
+
+def decode_jsonb_item(item):
+    value = item.value
+    return json.loads(str(ffi.buffer(value.bytes + 1, value.size - 1), 'utf-8'))
+
+
+def get_raw_decoder(deserializer, zero_copy: bool = False, views=None):
+    # The zero-copy memoryviews returned, including the slices deserializers
+    # return, are appended to views, to be released once the memory they
+    # point to is freed
+    buffer = ffi.buffer
+
+    def decode(item):
+        value = item.value
+        if not zero_copy:
+            value = buffer(value.bytes, value.size)[:]
+            return value if deserializer is None else deserializer(value)
+
+        view = memoryview(buffer(value.bytes, value.size))
+        if deserializer is None:
+            views.append(view)
+            return view
+        with view:
+            value = deserializer(view)
+        if isinstance(value, memoryview):
+            views.append(value)
         return value
 
-    def close(self):
-        self._row.close()
-        self._row = None
-        self._len = 0
+    return decode
 
-    def __enter__(self):
-        return self
 
-    def __exit__(self, exc_type, exc_value, traceback):
-        self.close()
+class Row:
+    # Deserializers of the binary values by type OID, the values of other
+    # types being returned as bytes (or memoryviews in zero-copy mode).
+    # Values can be any buffer.
+    deserializers = {
+        16: lambda value: value[0] != 0,  # bool
+        18: decode_text,  # "char"
+        21: get_deserializer('h'),  # int2
+        23: get_deserializer('i'),  # int4
+        20: get_deserializer('q'),  # int8
+        26: get_deserializer('I'),  # oid
+        700: get_deserializer('f'),  # float4
+        701: get_deserializer('d'),  # float8
+        1700: decode_numeric,  # numeric
+        25: decode_text,  # text
+        19: decode_text,  # name
+        705: decode_text,  # unknown
+        1042: decode_text,  # bpchar
+        1043: decode_text,  # varchar
+        114: lambda value: json.loads(decode_text(value)),  # json
+        # jsonb, always start with 1
+        3802: lambda value: json.loads(decode_text(value[1:])),
+        2950: lambda value: uuid.UUID(bytes=bytes(value)),  # uuid
+        # date
+        1082: lambda value: date_from_days(struct.unpack('>i', value)[0]),
+        # timestamp
+        1114: lambda value: timestamp_from_micros(struct.unpack('>q', value)[0]),
+        # timestamptz
+        1184: lambda value: timestamp_from_micros(
+            struct.unpack('>q', value)[0], EPOCH_TZ,
+        ),
+    }
+    deserializers.update(dict.fromkeys(ARRAY_TYPES, decode_array))
+    deserializers[2249] = decode_record  # record
+
+    # Decoders of the values decoded natively, by tag
+    natives = {
+        TAG_NULL: decode_null,
+        TAG_INT: decode_int,
+        TAG_FLOAT: decode_float,
+        TAG_BOOL: decode_bool,
+        TAG_TEXT: decode_text_item,
+        TAG_UUID: decode_uuid_item,
+        TAG_DATE: lambda item: date_from_days(item.int_value),
+        TAG_TIMESTAMP: lambda item: timestamp_from_micros(item.int_value),
+        TAG_TIMESTAMPTZ: lambda item: timestamp_from_micros(
+            item.int_value, EPOCH_TZ,
+        ),
+        TAG_JSON: decode_json_item,
+        TAG_JSONB: decode_jsonb_item,
+    }
+
+    @classmethod
+    def decoders(cls, type_oids, zero_copy: bool = False, deserializers=None,
+                 views=None):
+        """Decoders of each column, resolved once per result set: tuples
+        indexed by the tag of the row items.
+
+        deserializers gives the deserializer of the raw values from their type
+        OID, Row.deserializers being used by default. The values of the types
+        with a custom deserializer are not decoded natively. With zero_copy,
+        the memoryviews returned are appended to the views list.
+        """
+        deserializers = deserializers or cls.deserializers.get
+        natives = [cls.natives.get(tag) for tag in range(TAG_JSONB + 1)]
+        decoders = []
+        for oid in type_oids:
+            deserializer = deserializers(oid)
+            raw = get_raw_decoder(deserializer, zero_copy, views)
+            builtin = cls.deserializers.get(oid)
+            if builtin is not None and deserializer is not builtin:
+                decoders.append((decode_null,) + (raw,) * TAG_JSONB)
+            else:
+                natives[TAG_RAW] = raw
+                decoders.append(tuple(natives))
+        return tuple(decoders)
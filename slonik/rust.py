@@ -2,6 +2,7 @@
 Adapted from https://github.com/getsentry/semaphore/blob/886661cb2d421d3435657969c3e12e50813b8010/py/semaphore/exceptions.py
 """  # noqa
 
+import threading
 import uuid
 import weakref
 from slonik._native import ffi, lib
@@ -15,6 +16,9 @@ class _NoDict(type):
 
     def __new__(cls, name, bases, d):
         d.setdefault('__slots__', ())
+        # Finalizers aren't free, only objects with something to free get one
+        if d.get('__dealloc_func__') is not None:
+            d.setdefault('__del__', RustObject._dealloc)
         return type.__new__(cls, name, bases, d)
 
 
@@ -34,14 +38,17 @@ class RustObject(metaclass=_NoDict):
         return rv
 
     def _methodcall(self, func, *args):
-        return call(func, self._get_objptr(), *args)
+        objptr = self._objptr
+        if not objptr:
+            raise RuntimeError('Object is closed')
+        return call(func, objptr, *args)
 
     def _get_objptr(self):
         if not self._objptr:
             raise RuntimeError('Object is closed')
         return self._objptr
 
-    def __del__(self):
+    def _dealloc(self):
         if self._objptr is None or self._shared:
             return
         f = self.__class__.__dealloc_func__
@@ -58,18 +65,70 @@ def isresult(value):
     return False
 
 
+# Whether each native function returns an FFIResult, checked on its first
+# call only as the return type of a function doesn't change
+returns_result = {}
+
+# Number of threads counting their native calls, so that the others only pay
+# for checking it
+_counting = 0
+_counting_lock = threading.Lock()
+_local = threading.local()
+
+
+class counting:
+    """Add the native calls the current thread makes in the block to the
+    ffi_calls attribute of counter (a slonik.stats.Probe). Blocks nest, the
+    calls only counting for the innermost one."""
+
+    __slots__ = ['counter', '_outer']
+
+    def __init__(self, counter):
+        self.counter = counter
+
+    def __enter__(self):
+        global _counting
+        with _counting_lock:
+            _counting += 1
+        self._outer = getattr(_local, 'counter', None)
+        _local.counter = self.counter
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        global _counting
+        _local.counter = self._outer
+        with _counting_lock:
+            _counting -= 1
+
+
+def _count(calls: int):
+    counter = getattr(_local, 'counter', None)
+    if counter is not None:
+        counter.ffi_calls += calls
+
+
+def raise_error(result):
+    error = ffi.cast('_Error*', result.data)
+    if _counting:
+        _count(2)
+    try:
+        error_msg = buff_to_bytes(lib.error_msg(error)).decode()
+        raise SlonikException(error_msg)
+    finally:
+        lib.error_free(error)
+
+
 def call(func, *args):
     """Calls rust method and does some error handling."""
+    if _counting:
+        _count(1)
     result = func(*args)
-    if isresult(result):
+    checked = returns_result.get(func)
+    if checked is None:
+        checked = returns_result[func] = isresult(result)
+    if checked:
         if result.status:
-            error = ffi.cast('_Error*', result.data)
-            try:
-                error_msg = buff_to_bytes(lib.error_msg(error)).decode()
-                raise SlonikException(error_msg)
-            finally:
-                lib.error_free(error)
-        result = result.data
+            raise_error(result)
+        return result.data
     return result
 
 
@@ -0,0 +1,180 @@
+import bisect
+import re
+import threading
+import time
+from collections import namedtuple
+
+# Upper bounds of the latency histogram buckets in seconds, from 100µs to
+# ~13s doubling each time, the last bucket catching anything slower
+BUCKETS = tuple(0.0001 * 2 ** i for i in range(18))
+
+# Literals replaced in fingerprints, so that statements differing only by
+# inlined values share their statistics ($1 parameters are kept)
+LITERALS = re.compile(r"'(?:[^']|'')*'|(?<!\$)\b\d+(?:\.\d+)?\b")
+SPACES = re.compile(r'\s+')
+
+# What happened during a statement, handed to the hooks once it is done:
+# times are in seconds, first_row being None for statements without rows.
+QueryEvent = namedtuple('QueryEvent', [
+    'fingerprint', 'sql', 'error', 'total', 'execute', 'first_row', 'decode',
+    'rows', 'bytes', 'ffi_calls',
+])
+
+
+def fingerprint(sql: str) -> str:
+    return SPACES.sub(' ', LITERALS.sub('?', sql)).strip()
+
+
+class Histogram:
+    """Counts of values per bucket of BUCKETS."""
+
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS) + 1)
+
+    def add(self, value: float):
+        self.counts[bisect.bisect_left(BUCKETS, value)] += 1
+
+    def merge(self, other: 'Histogram'):
+        self.counts = [a + b for a, b in zip(self.counts, other.counts)]
+
+    def percentile(self, p: float) -> float:
+        """Upper bound of the bucket holding percentile p (0 to 100)."""
+        total = sum(self.counts)
+        if not total:
+            return 0.
+        rank = total * p / 100
+        seen = 0
+        for bound, count in zip(BUCKETS + (float('inf'),), self.counts):
+            seen += count
+            if seen >= rank:
+                return bound
+        return float('inf')
+
+    def as_dict(self) -> dict:
+        return {
+            str(bound): count
+            for bound, count in zip(BUCKETS + (float('inf'),), self.counts)
+            if count
+        }
+
+
+class StatementStats:
+    """Cumulative statistics of the statements of a fingerprint."""
+
+    fields = ['calls', 'errors', 'rows', 'bytes', 'ffi_calls', 'total',
+              'execute', 'first_row', 'decode']
+
+    def __init__(self):
+        self.calls = self.errors = self.rows = self.bytes = 0
+        self.ffi_calls = 0
+        self.total = self.execute = self.first_row = self.decode = 0.
+        self.latency = Histogram()
+
+    def add(self, event: QueryEvent):
+        self.calls += 1
+        self.errors += event.error is not None
+        self.rows += event.rows
+        self.bytes += event.bytes
+        self.ffi_calls += event.ffi_calls
+        self.total += event.total
+        self.execute += event.execute
+        self.first_row += event.first_row or 0.
+        self.decode += event.decode
+        self.latency.add(event.total)
+
+    def merge(self, other: 'StatementStats'):
+        for field in self.fields:
+            setattr(self, field, getattr(self, field) + getattr(other, field))
+        self.latency.merge(other.latency)
+
+    def as_dict(self) -> dict:
+        stats = {field: getattr(self, field) for field in self.fields}
+        stats['latency'] = self.latency.as_dict()
+        stats['p50'] = self.latency.percentile(50)
+        stats['p99'] = self.latency.percentile(99)
+        return stats
+
+
+class Probe:
+    """Measures one statement, from its execution to its result being
+    closed."""
+
+    __slots__ = ['instruments', 'sql', 'start', 'execute', 'first_row',
+                 'decode', 'rows', 'bytes', 'ffi_calls', 'done']
+
+    def __init__(self, instruments, sql: str):
+        self.instruments = instruments
+        self.sql = sql
+        self.start = time.perf_counter()
+        self.execute = self.decode = 0.
+        self.first_row = None
+        self.rows = self.bytes = self.ffi_calls = 0
+        self.done = False
+
+    def executed(self, start: float):
+        """The native execution started at start is done."""
+        self.execute += time.perf_counter() - start
+
+    def fetched(self, rows: int, nbytes: int, decode: float):
+        self.rows += rows
+        self.bytes += nbytes
+        self.decode += decode
+        if self.first_row is None and rows:
+            self.first_row = time.perf_counter() - self.start
+
+    def finish(self, error: Exception = None):
+        if self.done:
+            return
+        self.done = True
+        self.instruments.record(QueryEvent(
+            fingerprint(self.sql), self.sql, error,
+            time.perf_counter() - self.start, self.execute, self.first_row,
+            self.decode, self.rows, self.bytes, self.ffi_calls,
+        ))
+
+
+class Instruments:
+    """Statistics of the statements of a connection, by fingerprint.
+
+    Hooks get a QueryEvent once each statement is done, e.g. to export its
+    timings, and must not raise.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._stats = {}  # fingerprint -> StatementStats
+        self.hooks = []
+
+    def probe(self, sql: str) -> Probe:
+        return Probe(self, sql)
+
+    def record(self, event: QueryEvent):
+        with self._lock:
+            stats = self._stats.get(event.fingerprint)
+            if stats is None:
+                stats = self._stats[event.fingerprint] = StatementStats()
+            stats.add(event)
+        for hook in self.hooks:
+            hook(event)
+
+    def snapshot(self) -> dict:
+        """Copy of the statistics, by fingerprint."""
+        with self._lock:
+            snapshot = {}
+            for key, stats in self._stats.items():
+                snapshot[key] = StatementStats()
+                snapshot[key].merge(stats)
+            return snapshot
+
+    def reset(self):
+        with self._lock:
+            self._stats.clear()
+
+
+def merge(snapshots) -> dict:
+    """Sum snapshots of several connections."""
+    merged = {}
+    for snapshot in snapshots:
+        for key, stats in snapshot.items():
+            merged.setdefault(key, StatementStats()).merge(stats)
+    return merged
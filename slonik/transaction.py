@@ -0,0 +1,81 @@
+from .exceptions import SlonikException
+
+# Must match TransactionOptions in rust/src/transaction.rs
+ISOLATION_LEVELS = {
+    'read uncommitted': 0,
+    'read committed': 1,
+    'repeatable read': 2,
+    'serializable': 3,
+}
+
+
+def _option(value) -> int:
+    return -1 if value is None else int(bool(value))
+
+
+class Transaction:
+    """Transaction, or savepoint when nested, committed when leaving the with
+    block and rolled back on error. It can also be committed or rolled back
+    explicitly within the block.
+
+    BEGIN (or SAVEPOINT) is only sent before the first statement run in the
+    block, so empty transactions cost no round trip. It still takes a round
+    trip of its own, as does COMMIT: rust-postgres 0.15 can't queue them
+    with the statements.
+    """
+
+    def __init__(self, conn, isolation: str = None, readonly: bool = None,
+                 deferrable: bool = None):
+        if isolation is not None and isolation not in ISOLATION_LEVELS:
+            raise ValueError(f'Invalid isolation level: {isolation!r}')
+
+        self.conn = conn
+        self.options = (
+            ISOLATION_LEVELS.get(isolation, -1),
+            _option(readonly),
+            _option(deferrable),
+        )
+        self._depth = None
+        self._finished = False
+
+    def __enter__(self):
+        if self._depth is not None:
+            raise SlonikException('Transaction already started')
+        with self.conn._lock:
+            self.conn._conn.transaction_begin(self.options)
+            self._depth = self.conn._conn.transaction_depth()
+            self.conn._transaction_depth = self._depth
+        return self
+
+    def _finish(self, commit: bool):
+        if self._depth is None or self._finished:
+            raise SlonikException('Transaction not in progress')
+        with self.conn._lock:
+            conn = self.conn._conn
+            if conn.transaction_depth() != self._depth:
+                raise SlonikException(
+                    'Transactions must be closed innermost first'
+                )
+            # The transaction is closed even when COMMIT fails
+            self._finished = True
+            try:
+                if commit:
+                    conn.transaction_commit()
+                else:
+                    conn.transaction_rollback()
+            finally:
+                self.conn._transaction_depth = self._depth - 1
+
+    def commit(self):
+        self._finish(True)
+
+    def rollback(self):
+        self._finish(False)
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if self._finished:
+            return
+        if exc_type is None:
+            self.commit()
+        else:
+            self.rollback()
@@ -0,0 +1,126 @@
+import contextlib
+import heapq
+import itertools
+import threading
+import time
+
+from .exceptions import QueryTimeout
+from .exceptions import SlonikException
+
+# Used instead of a Deadline by the calls without timeout
+NO_DEADLINE = contextlib.nullcontext()
+
+
+class Timer:
+    __slots__ = ['callback', 'fired', '_lock']
+
+    def __init__(self, callback):
+        self.callback = callback
+        self.fired = False
+        self._lock = threading.Lock()
+
+    def fire(self):
+        with self._lock:
+            if self.callback is None:
+                return
+            self.fired = True
+            try:
+                self.callback()
+            except Exception:
+                pass  # the statement simply runs to completion
+            self.callback = None
+
+    def disarm(self) -> bool:
+        """Make sure the callback won't be called, returning whether it
+        was."""
+        with self._lock:
+            self.callback = None
+            return self.fired
+
+
+class Watchdog:
+    """Thread calling the callbacks of timers once their timeout expired,
+    shared by all the connections so that arming a timer costs no thread."""
+
+    def __init__(self):
+        self._cond = threading.Condition()
+        self._timers = []  # heap of (expires, sequence, timer)
+        self._sequence = itertools.count()
+        self._disarmed = 0
+        self._thread = None
+
+    def arm(self, timeout: float, callback) -> Timer:
+        timer = Timer(callback)
+        with self._cond:
+            heapq.heappush(self._timers, (
+                time.monotonic() + timeout, next(self._sequence), timer,
+            ))
+            if self._thread is None:
+                self._thread = threading.Thread(
+                    target=self._run, name='slonik-watchdog', daemon=True,
+                )
+                self._thread.start()
+            elif self._timers[0][2] is timer:
+                self._cond.notify()
+        return timer
+
+    def disarm(self, timer: Timer) -> bool:
+        fired = timer.disarm()
+        with self._cond:
+            # Disarmed timers are dropped once they make half of the heap
+            self._disarmed += 1
+            if self._disarmed * 2 > len(self._timers):
+                self._timers = [
+                    entry for entry in self._timers
+                    if entry[2].callback is not None
+                ]
+                heapq.heapify(self._timers)
+                self._disarmed = 0
+        return fired
+
+    def _run(self):
+        while True:
+            with self._cond:
+                now = time.monotonic()
+                while not self._timers or self._timers[0][0] > now:
+                    self._cond.wait(
+                        self._timers[0][0] - now if self._timers else None
+                    )
+                    now = time.monotonic()
+                expired = []
+                while self._timers and self._timers[0][0] <= now:
+                    expired.append(heapq.heappop(self._timers)[2])
+            # The callbacks may block, e.g. to cancel a statement
+            for timer in expired:
+                timer.fire()
+
+
+WATCHDOG = Watchdog()
+
+
+class Deadline:
+    """Call cancel if a block runs for more than timeout seconds, turning
+    the error of the canceled statement into QueryTimeout.
+
+    A statement completing as the cancel request is sent is not canceled.
+    Leaving the block waits for a cancel being sent, which returns once the
+    server processed it, so it can't hit the next statements either.
+    """
+
+    def __init__(self, timeout: float, cancel):
+        if timeout <= 0:
+            raise ValueError(f'timeout must be positive, got {timeout!r}')
+        self.timeout = timeout
+        self.cancel = cancel
+        self._timer = None
+
+    def __enter__(self):
+        self._timer = WATCHDOG.arm(self.timeout, self.cancel)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        fired = WATCHDOG.disarm(self._timer)
+        if fired and isinstance(exc_value, SlonikException):
+            raise QueryTimeout(
+                f'Statement canceled after {self.timeout}s'
+            ) from exc_value
@@ -6,9 +6,10 @@ from slonik import Connection
 @pytest.fixture()
 def conn():
     conn_ = Connection.from_env()
-    conn_.execute('BEGIN')
+    transaction = conn_.transaction()
+    transaction.__enter__()
     try:
         yield conn_
     finally:
-        conn_.execute('ROLLBACK')
+        transaction.rollback()
         conn_.close()
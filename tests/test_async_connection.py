@@ -0,0 +1,129 @@
+import asyncio
+
+from slonik import AsyncConnection
+from slonik import NoRows
+from slonik import SlonikException
+
+import pytest
+
+
+def run(coroutine):
+    return asyncio.get_event_loop().run_until_complete(coroutine)
+
+
+@pytest.fixture()
+def aconn():
+    conn = AsyncConnection.from_env()
+    transaction = conn.transaction()
+    run(transaction.__aenter__())
+    try:
+        yield conn
+    finally:
+        run(transaction.rollback())
+        run(conn.close())
+
+
+def test_get_value(aconn):
+    assert run(aconn.get_value('SELECT 42')) == 42
+    assert run(aconn.get_value('SELECT $1::int', 42)) == 42
+
+
+def test_get_one(aconn):
+    assert run(aconn.get_one('SELECT 42, $1::text', 'foo')) == (42, 'foo')
+
+    # As with Connection
+    with pytest.raises(NoRows):
+        run(aconn.get_one('SELECT 1 WHERE false'))
+    with pytest.raises(NoRows):
+        run(aconn.get_value('SELECT 1 WHERE false'))
+
+
+def test_query(aconn):
+    async def fetch(sql, *args):
+        return [row async for row in aconn.query(sql, *args, fetch_size=3)]
+
+    result = run(fetch('SELECT * FROM generate_series($1::int, 10)', 1))
+    assert result == [(i,) for i in range(1, 11)]
+
+
+def test_execute(aconn):
+    run(aconn.execute('CREATE TABLE test_table(name text, value int)'))
+    run(aconn.execute(
+        'INSERT INTO test_table(name, value) VALUES ($1, $2)', 'bar', 21,
+    ))
+    assert run(aconn.get_one('SELECT * FROM test_table')) == ('bar', 21)
+
+
+def test_error(aconn):
+    with pytest.raises(SlonikException) as e:
+        run(aconn.execute('DELETE FROM foo'))
+    assert 'relation "foo" does not exist' in str(e.value)
+
+
+def test_in_transaction(aconn):
+    async def main():
+        sleeping = asyncio.ensure_future(aconn.execute('SELECT pg_sleep(1)'))
+        await asyncio.sleep(.1)
+        # Doesn't wait for the statement
+        start = asyncio.get_running_loop().time()
+        assert aconn.in_transaction
+        assert asyncio.get_running_loop().time() - start < .5
+        await sleeping
+
+    run(main())
+
+
+def test_concurrent_connections():
+    async def sleep(i):
+        async with AsyncConnection.from_env() as conn:
+            return await conn.get_value('SELECT $1::int FROM pg_sleep(0.1)', i)
+
+    async def main():
+        return await asyncio.gather(*(sleep(i) for i in range(10)))
+
+    loop = asyncio.get_event_loop()
+    start = loop.time()
+    assert run(main()) == list(range(10))
+    assert loop.time() - start < 1
+
+
+def test_stream():
+    async def fetch():
+        async with AsyncConnection.from_env() as conn:
+            stream = conn.stream(
+                'SELECT generate_series(1, $1::int)', 25, batch_rows=10,
+            )
+            return [row async for row in stream]
+
+    assert run(fetch()) == [(i,) for i in range(1, 26)]
+
+
+def test_notifies():
+    async def main():
+        async with AsyncConnection.from_env() as listener, \
+                AsyncConnection.from_env() as sender:
+            await listener.listen('slonik_test')
+            waiting = asyncio.ensure_future(listener.notifies(timeout=5))
+            await sender.execute("NOTIFY slonik_test, 'foo'")
+            return await waiting
+
+    notification, = run(main())
+    assert (notification.channel, notification.payload) == (
+        'slonik_test', 'foo',
+    )
+
+
+def test_notifies_cancel():
+    async def main():
+        async with AsyncConnection.from_env() as listener:
+            await listener.listen('slonik_test')
+            waiting = asyncio.ensure_future(listener.notifies())
+            await asyncio.sleep(.3)
+            waiting.cancel()
+            with pytest.raises(asyncio.CancelledError):
+                await waiting
+            # The worker is free again, instead of waiting forever
+            value = await asyncio.wait_for(listener.get_value('SELECT 1'), 1)
+            assert value == 1
+
+    run(main())
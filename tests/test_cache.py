@@ -0,0 +1,117 @@
+import time
+
+from slonik import Connection
+from slonik import dict_row
+from slonik import Pool
+from slonik import QueryCache
+from slonik import SlonikException
+
+import pytest
+
+
+def test_cache_lru():
+    cache = QueryCache(max_bytes=1300)
+    cache.put('a', [], [(1,)])
+    cache.put('b', [], [(2,)])
+    assert cache.get('a').rows == ((1,),)
+
+    # 'b' is the least recently used
+    cache.put('c', [], [('x' * 400,)])
+    cache.put('d', [], [('y' * 400,)])
+    assert cache.get('b') is None
+    assert cache.get('a') is not None
+    assert cache.size <= 1300
+
+    stats = cache.stats()
+    assert stats['evictions'] >= 1
+    assert stats['hits'] == 2
+    assert stats['misses'] == 1
+
+    # too large to be cached at all
+    cache.put('e', [], [('z' * 2000,)])
+    assert cache.get('e') is None
+
+
+def test_cache_ttl_and_tags():
+    cache = QueryCache()
+    cache.put('a', [], [(1,)], ttl=0.01, tags=['foo'])
+    cache.put('b', [], [(2,)], tags=['foo', 'bar'])
+    cache.put('c', [], [(3,)], tags=['bar'])
+    time.sleep(0.02)
+    assert cache.get('a') is None
+
+    cache.invalidate('foo')
+    assert cache.get('b') is None
+    assert cache.get('c') is not None
+    assert cache.stats()['invalidations'] == 1
+
+
+def test_cache_invalidated_before_put():
+    cache = QueryCache()
+    # Read before running the query, an invalidation landing before the
+    # result is put
+    generation = cache.generation
+    cache.invalidate('foo')
+    cache.put('a', [], [(1,)], tags=['foo'], generation=generation)
+    assert cache.get('a') is None
+
+    generation = cache.generation
+    cache.clear()
+    cache.put('a', [], [(1,)], generation=generation)
+    assert cache.get('a') is None
+
+    cache.put('a', [], [(1,)], generation=cache.generation)
+    assert cache.get('a') is not None
+
+
+def test_cached_queries():
+    cache = QueryCache()
+    with Connection.from_env(cache=cache, instrument=True) as conn:
+        sql = 'SELECT $1::int AS value, now() AS time'
+        one = conn.get_one(sql, 1, cache_ttl=10)
+        assert conn.get_one(sql, 1, cache_ttl=10) == one
+        assert conn.get_one(sql, 2, cache_ttl=10) != one
+        # hits don't run the query
+        assert conn.stats()['SELECT $1::int AS value, now() AS time'][
+            'calls'
+        ] == 2
+
+        assert conn.get_value('SELECT 42', cache_ttl=10, cache_tags=['x']) == 42
+        assert conn.cached(sql, 1, row_factory=dict_row) == [
+            {'value': 1, 'time': one[1]},
+        ]
+
+        cache.invalidate('x')
+        assert conn.get_value('SELECT 42', cache_ttl=10) == 42
+        assert cache.stats()['hits'] == 2
+
+    with Connection.from_env() as conn:
+        with pytest.raises(SlonikException):
+            conn.cached('SELECT 1')
+
+
+def test_cached_copies():
+    with Connection.from_env(cache=QueryCache()) as conn:
+        sql = "SELECT ARRAY[1, 2], '{\"a\": 1}'::json"
+        array, doc = conn.get_one(sql, cache_ttl=10)
+        array.append(3)
+        doc['b'] = 2
+        assert conn.get_one(sql, cache_ttl=10) == ([1, 2], {'a': 1})
+
+
+def test_cached_in_transaction():
+    cache = QueryCache()
+    with Connection.from_env(cache=cache) as conn:
+        with conn.transaction():
+            assert conn.get_value('SELECT 42', cache_ttl=10) == 42
+            assert conn.cached('SELECT 42') == [(42,)]
+        assert cache.stats()['entries'] == 0
+        assert cache.stats()['misses'] == 0
+
+
+def test_pool_cache():
+    cache = QueryCache()
+    with Pool.from_env(min_size=2, max_size=2, cache=cache) as pool:
+        with pool.connection() as conn1, pool.connection() as conn2:
+            value = conn1.get_value('SELECT random()', cache_ttl=10)
+            assert conn2.get_value('SELECT random()', cache_ttl=10) == value
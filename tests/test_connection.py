@@ -1,4 +1,17 @@
+import dataclasses
+import datetime
+import decimal
+import threading
+import uuid
+
+from slonik import class_row
 from slonik import Connection
+from slonik import dict_row
+from slonik import namedtuple_row
+from slonik import NoRows
+from slonik import SlonikException
+
+import pytest
 
 
 def test_from_env():
@@ -19,6 +32,11 @@ def test_get_one(conn):
     assert conn.get_one('SELECT * FROM generate_series(1, 10)') == (1,)
     assert conn.get_one("SELECT 'foo', generate_series(1, 10)") == ('foo', 1)
 
+    with pytest.raises(NoRows):
+        conn.get_one('SELECT 1 WHERE false')
+    with pytest.raises(NoRows):
+        conn.get_value('SELECT 1 WHERE false')
+
     assert conn.get_one('SELECT $1::int, $2::text', 42, 'foo') == (42, 'foo')
 
 
@@ -49,3 +67,515 @@ def test_execute(conn):
     )
     result = list(conn.query("SELECT * FROM test_table ORDER BY name ASC"))
     assert result == [('bar', 21), ('foo', 42)]
+
+
+def test_query_fetch_size(conn):
+    sql = 'SELECT i, i::text FROM generate_series(1, 250) AS i'
+    expected = [(i, str(i)) for i in range(1, 251)]
+
+    for fetch_size in (1, 7, 100, 1000):
+        assert list(conn.query(sql, fetch_size=fetch_size)) == expected
+
+    assert list(conn.query('SELECT FROM generate_series(1, 3)')) == [()] * 3
+
+    with pytest.raises(ValueError):
+        list(conn.query(sql, fetch_size=0))
+    with pytest.raises(ValueError):
+        list(conn.stream(sql, batch_rows=0))
+    # Nothing was left open
+    with conn.transaction():
+        assert conn.get_value('SELECT 1') == 1
+
+
+def test_types(conn):
+    row = conn.get_one(
+        "SELECT true, 1::int2, 2::int8, 42::oid, 1.5::float4, "
+        "'3d9d291d-8668-480f-98bf-46ee10d07a5d'::uuid, 'foo'::name, "
+        "'{\"a\": [1]}'::json, '{\"a\": [1]}'::jsonb, '\\x0102'::bytea"
+    )
+    assert row == (
+        True, 1, 2, 42, 1.5,
+        uuid.UUID('3d9d291d-8668-480f-98bf-46ee10d07a5d'), 'foo',
+        {'a': [1]}, {'a': [1]}, b'\x01\x02',
+    )
+
+
+def test_numeric(conn):
+    values = conn.get_one(
+        "SELECT 12.340::numeric, -0.001::numeric, 10000::numeric, "
+        "0::numeric(4, 2), 'NaN'::numeric, 123456789.123456789::numeric"
+    )
+    assert values[:4] == (
+        decimal.Decimal('12.340'), decimal.Decimal('-0.001'),
+        decimal.Decimal(10000), decimal.Decimal('0.00'),
+    )
+    assert str(values[0]) == '12.340'
+    assert values[4].is_nan()
+    assert values[5] == decimal.Decimal('123456789.123456789')
+
+
+def test_dates(conn):
+    utc = datetime.timezone.utc
+    assert conn.get_one(
+        "SELECT '2020-02-29'::date, '1999-12-31 12:34:56.789'::timestamp, "
+        "'2020-02-29 12:34:56+02'::timestamptz, 'infinity'::date, "
+        "'-infinity'::timestamp"
+    ) == (
+        datetime.date(2020, 2, 29),
+        datetime.datetime(1999, 12, 31, 12, 34, 56, 789000),
+        datetime.datetime(2020, 2, 29, 10, 34, 56, tzinfo=utc),
+        datetime.date.max,
+        datetime.datetime.min,
+    )
+
+
+def test_arrays(conn):
+    assert conn.get_one(
+        "SELECT ARRAY[[1, 2], [3, NULL]], ARRAY['a', NULL]::text[], "
+        "'{}'::int[], ARRAY['2020-02-29'::date]"
+    ) == (
+        [[1, 2], [3, None]], ['a', None], [], [datetime.date(2020, 2, 29)],
+    )
+
+
+def test_description(conn):
+    sql = "SELECT 1 AS id, 'foo'::text AS name, NULL::int8"
+    with conn._execute_result(sql, ()) as result:
+        assert [(c.name, c.type_oid, c.typename) for c in result.description] == [
+            ('id', 23, 'int4'),
+            ('name', 25, 'text'),
+            ('int8', 20, 'int8'),
+        ]
+        assert {c.format for c in result.description} == {1}
+        assert list(result) == [(1, 'foo', None)]
+
+
+def test_query_result_zero_copy(conn):
+    sql = (
+        "SELECT repeat('é', 50000), convert_to(repeat('x', 50000), 'UTF8'), "
+        "'{\"a\": 1}'::jsonb, NULL::bytea"
+    )
+    with conn.query_result(sql, zero_copy=True) as result:
+        (text, data, doc, null), = result
+        assert text == 'é' * 50000
+        assert isinstance(data, memoryview)
+        assert data == b'x' * 50000
+        assert doc == {'a': 1}
+        assert null is None
+    # Released with the result, instead of pointing to freed memory
+    with pytest.raises(ValueError):
+        bytes(data)
+
+    with conn.query_result(sql) as result:
+        assert isinstance(next(result)[1], bytes)
+
+
+def test_query_result_zero_copy_derived(conn):
+    sql = "SELECT ROW('x'::bytea, 1), '\\x0102'::bytea"
+    conn.register_type('bytea', decode=lambda value: value[1:])
+    with conn.query_result(sql, zero_copy=True) as result:
+        (record, tail), = result
+        assert tail == b'\x02'
+    # Record fields are copied, slices returned by deserializers released
+    assert record == (b'x', 1)
+    with pytest.raises(ValueError):
+        bytes(tail)
+
+
+def test_query_columns(conn):
+    ids, names, ratios = conn.query_columns(
+        'SELECT i, nullif(i::text, $1), i / 2::float '
+        'FROM generate_series(1, 4) AS i', '3',
+    )
+
+    assert ids.typename == 'int4'
+    assert list(ids.values) == [1, 2, 3, 4]
+    assert ids.offsets is None
+    assert ids.nulls == bytearray(4)
+
+    assert names.typename == 'text'
+    assert list(names.offsets) == [0, 1, 2, 2, 3]
+    assert bytes(names.values) == b'124'
+    assert list(names.nulls) == [0, 0, 1, 0]
+
+    assert ratios.name == '?column?'
+    assert list(ratios.values) == [0.5, 1, 1.5, 2]
+    assert memoryview(ratios.values).format == 'd'
+
+
+def test_stream():
+    # Streams open their own transaction, so don't use the conn fixture
+    with Connection.from_env() as conn:
+        sql = 'SELECT i, i::text FROM generate_series($1::int, 250) AS i'
+        expected = [(i, str(i)) for i in range(1, 251)]
+
+        for batch_rows in (1, 7, 100, 1000):
+            assert list(conn.stream(sql, 1, batch_rows=batch_rows)) == expected
+
+        stream = conn.stream(sql, 1, batch_rows=10)
+        assert next(stream) == (1, '1')
+        stream.close()
+
+        # the connection is still usable once the stream is closed
+        assert conn.get_value('SELECT 42') == 42
+
+        # the stream borrows the connection
+        stream = conn.stream(sql, 1, batch_rows=10)
+        assert next(stream) == (1, '1')
+        with pytest.raises(SlonikException):
+            conn.close()
+        stream.close()
+
+        # closing the stream would commit a transaction opened with BEGIN
+        conn.execute('BEGIN')
+        conn.execute('CREATE TEMPORARY TABLE test_table(value int)')
+        with pytest.raises(SlonikException):
+            list(conn.stream(sql, 1))
+        with pytest.raises(SlonikException):
+            conn.get_one(sql, 1, stream=True)
+        conn.execute('ROLLBACK')
+        with pytest.raises(SlonikException):
+            conn.get_value('SELECT count(*) FROM test_table')
+
+        # outside of the transaction again
+        assert list(conn.stream(sql, 249)) == expected[-2:]
+        conn.execute_script('SELECT 1; BEGIN')
+        with pytest.raises(SlonikException):
+            conn.get_one(sql, 1, stream=True)
+        conn.execute_script('COMMIT')
+        assert conn.get_one(sql, 1, stream=True) == (1, '1')
+
+
+def test_statement_cache(conn):
+    stats = conn.statement_cache_stats()
+    assert stats['capacity'] == 100
+
+    for i in range(3):
+        assert conn.get_value('SELECT $1::int + 1', i) == i + 1
+
+    new_stats = conn.statement_cache_stats()
+    assert new_stats['size'] == stats['size'] + 1
+    assert new_stats['misses'] == stats['misses'] + 1
+    assert new_stats['hits'] == stats['hits'] + 2
+
+
+def test_statement_cache_eviction():
+    with Connection.from_env(statement_cache_size=2) as conn:
+        for i in range(5):
+            assert conn.get_value(f'SELECT {i}') == i
+        assert conn.get_value('SELECT 4') == 4
+
+        stats = conn.statement_cache_stats()
+        assert stats == {'capacity': 2, 'size': 2, 'hits': 1, 'misses': 5}
+
+    # The least recently used statement is evicted
+    with Connection.from_env(statement_cache_size=2) as conn:
+        for i in (0, 1, 0, 2, 0):
+            assert conn.get_value(f'SELECT {i}') == i
+        assert conn.statement_cache_stats()['hits'] == 2
+
+
+def test_statement_cache_invalidation():
+    with Connection.from_env() as conn:
+        conn.execute('CREATE TEMPORARY TABLE test_table(a int)')
+        conn.execute('INSERT INTO test_table VALUES ($1)', 1)
+        assert list(conn.query('SELECT * FROM test_table')) == [(1,)]
+
+        # The cached statement no longer matches the table
+        conn.execute('ALTER TABLE test_table ADD COLUMN b int')
+        assert list(conn.query('SELECT * FROM test_table')) == [(1, None)]
+        assert list(conn.query('SELECT * FROM test_table')) == [(1, None)]
+
+
+def test_statement_cache_disabled():
+    with Connection.from_env(statement_cache_size=0) as conn:
+        assert conn.get_value('SELECT 1') == 1
+        assert conn.get_value('SELECT 1') == 1
+
+        stats = conn.statement_cache_stats()
+        assert stats == {'capacity': 0, 'size': 0, 'hits': 0, 'misses': 2}
+
+
+def test_threads(conn):
+    results = []
+
+    def worker(i):
+        for _ in range(10):
+            results.append(conn.get_value('SELECT $1::int', i))
+
+    threads = [threading.Thread(target=worker, args=(i,)) for i in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert sorted(results) == sorted(list(range(4)) * 10)
+
+
+def test_pipeline(conn):
+    conn.execute('CREATE TABLE test_table(name text, value int)')
+
+    with conn.pipeline() as pipeline:
+        insert = pipeline.execute(
+            'INSERT INTO test_table(name, value) VALUES ($1, $2)', 'foo', 42,
+        )
+        select = pipeline.query('SELECT * FROM test_table')
+        series = pipeline.query('SELECT generate_series(1, $1::int)', 3)
+        assert len(pipeline) == 3
+        assert not select.done()
+
+    assert insert.result() is None
+    assert select.result() == [('foo', 42)]
+    assert series.result() == [(1,), (2,), (3,)]
+
+    # queries are only prepared when flushed, after the ones before ran
+    with conn.pipeline() as pipeline:
+        pipeline.execute('CREATE TABLE test_other(value int)')
+        pipeline.execute('INSERT INTO test_other VALUES ($1)', 1)
+        count = pipeline.query('SELECT count(*) FROM test_other')
+    assert count.result() == [(1,)]
+
+
+def test_pipeline_errors():
+    with Connection.from_env() as conn:
+        with conn.pipeline() as pipeline:
+            first = pipeline.query('SELECT 1')
+            error = pipeline.query('SELECT bar FROM foo')
+            last = pipeline.query('SELECT 2')
+
+        assert first.result() == [(1,)]
+        with pytest.raises(SlonikException) as e:
+            error.result()
+        assert 'relation "foo" does not exist' in str(e.value)
+        assert last.result() == [(2,)]
+
+
+def test_pipeline_discarded(conn):
+    with pytest.raises(ZeroDivisionError):
+        with conn.pipeline() as pipeline:
+            query = pipeline.query('SELECT 1')
+            1 / 0
+
+    assert query.cancelled()
+
+
+def test_executemany(conn):
+    conn.execute('CREATE TABLE test_table(name text, value int, ratio float)')
+
+    rows = [(f'name {i}', i, i / 2) for i in range(100)]
+    conn.executemany(
+        'INSERT INTO test_table(name, value, ratio) VALUES ($1, $2, $3)', rows,
+    )
+    result = list(conn.query('SELECT * FROM test_table ORDER BY value'))
+    assert result == rows
+
+    conn.executemany('INSERT INTO test_table DEFAULT VALUES', [(), ()])
+    assert conn.get_value('SELECT count(*) FROM test_table') == 102
+
+    conn.executemany('INSERT INTO test_table(value) VALUES ($1)', [])
+    assert conn.get_value('SELECT count(*) FROM test_table') == 102
+
+
+def test_executemany_errors(conn):
+    conn.execute('CREATE TABLE test_table(value int)')
+
+    with pytest.raises(ValueError):
+        conn.executemany('INSERT INTO test_table VALUES ($1)', [(1,), (1, 2)])
+
+    with pytest.raises(SlonikException) as e:
+        conn.executemany('INSERT INTO test_table VALUES ($1)', [(1,), ('2',)])
+    assert 'type conversion error' in str(e.value)
+
+
+def test_transaction():
+    with Connection.from_env() as conn:
+        conn.execute('CREATE TEMP TABLE test_table(value int)')
+        assert not conn.in_transaction
+
+        with conn.transaction():
+            assert conn.in_transaction
+            conn.execute('INSERT INTO test_table VALUES (1)')
+        assert not conn.in_transaction
+
+        with pytest.raises(ZeroDivisionError):
+            with conn.transaction():
+                conn.execute('INSERT INTO test_table VALUES (2)')
+                1 / 0
+
+        with conn.transaction() as transaction:
+            conn.execute('INSERT INTO test_table VALUES (3)')
+            transaction.rollback()
+
+        assert list(conn.query('SELECT * FROM test_table')) == [(1,)]
+
+        # empty transactions are fine
+        with conn.transaction():
+            pass
+        with pytest.raises(SlonikException):
+            conn.transaction().commit()
+
+
+def test_savepoints(conn):
+    conn.execute('CREATE TABLE test_table(value int)')
+
+    with conn.transaction():
+        conn.execute('INSERT INTO test_table VALUES (1)')
+        with pytest.raises(SlonikException):
+            with conn.transaction():
+                conn.execute('INSERT INTO test_table VALUES (2)')
+                conn.execute('SELECT bar FROM foo')
+        with conn.transaction():
+            conn.execute('INSERT INTO test_table VALUES (3)')
+
+    assert list(conn.query('SELECT * FROM test_table ORDER BY 1')) == [
+        (1,), (3,),
+    ]
+
+    outer = conn.transaction()
+    with outer:
+        with conn.transaction():
+            with pytest.raises(SlonikException):
+                outer.commit()
+
+
+def test_transaction_options():
+    with Connection.from_env() as conn:
+        with conn.transaction(isolation='serializable', readonly=True):
+            assert conn.get_value('SHOW transaction_isolation') == (
+                'serializable'
+            )
+            assert conn.get_value('SHOW transaction_read_only') == 'on'
+
+        with conn.transaction():
+            with pytest.raises(SlonikException):
+                with conn.transaction(readonly=True):
+                    pass
+
+        with pytest.raises(ValueError):
+            conn.transaction(isolation='snapshot')
+
+
+def test_transaction_stream(conn):
+    with conn.transaction():
+        conn.execute('CREATE TABLE test_table AS SELECT generate_series(1, 5)')
+        stream = conn.stream('SELECT * FROM test_table', batch_rows=2)
+        assert next(stream) == (1,)
+        with pytest.raises(SlonikException) as e:
+            conn.transaction().__enter__()
+        assert 'stream is open' in str(e.value)
+        stream.close()
+
+    assert conn.get_value('SELECT count(*) FROM test_table') == 5
+
+
+def test_execute_script(conn):
+    conn.execute_script(
+        'CREATE TABLE test_table(value int); '
+        'INSERT INTO test_table VALUES (1), (2); '
+        'UPDATE test_table SET value = value * 10'
+    )
+    assert list(conn.query('SELECT * FROM test_table ORDER BY 1')) == [
+        (10,), (20,),
+    ]
+
+    with pytest.raises(SlonikException) as e:
+        conn.execute_script('SELECT 1; SELECT bar FROM foo')
+    assert 'relation "foo" does not exist' in str(e.value)
+
+
+def test_execute_simple_query():
+    with Connection.from_env() as conn:
+        conn.execute_script("SET application_name = 'slonik'")
+        assert conn.get_value('SHOW application_name') == 'slonik'
+        # scripts are not prepared
+        assert conn.statement_cache_stats()['size'] == 1
+
+        # execute runs a single statement, even without parameters
+        with pytest.raises(SlonikException) as e:
+            conn.execute('SELECT 1; SELECT 2')
+        assert 'multiple commands' in str(e.value)
+        assert conn.get_value('SELECT 42') == 42
+
+
+def test_row_factories(conn):
+    sql = "SELECT 1 AS id, 'foo' AS name UNION ALL SELECT 2, 'bar'"
+
+    assert list(conn.query(sql, row_factory=dict_row)) == [
+        {'id': 1, 'name': 'foo'}, {'id': 2, 'name': 'bar'},
+    ]
+
+    rows = list(conn.query(sql, row_factory=namedtuple_row))
+    assert rows == [(1, 'foo'), (2, 'bar')]
+    assert rows[1].name == 'bar'
+    # the class is built once per set of column names
+    assert type(conn.get_one(sql, row_factory=namedtuple_row)) is type(rows[0])
+
+    @dataclasses.dataclass
+    class Item:
+        id: int
+        name: str
+
+    assert conn.get_one(sql, row_factory=class_row(Item)) == Item(1, 'foo')
+
+    def factory(description):
+        assert [column.name for column in description] == ['id', 'name']
+        return lambda values: values[::-1]
+
+    assert list(conn.stream(sql, row_factory=factory)) == [
+        ['foo', 1], ['bar', 2],
+    ]
+
+
+def test_connection_row_factory():
+    with Connection.from_env(row_factory=dict_row) as conn:
+        assert conn.get_one('SELECT 1 AS value') == {'value': 1}
+        assert conn.get_value('SELECT 1 AS value') == 1
+        assert list(conn.query('SELECT 1 AS a, 2 AS a')) == [{'a': 2}]
+        assert list(conn.query('SELECT 1 AS a, 2 AS a',
+                               row_factory=namedtuple_row)) == [(1, 2)]
+
+
+def test_stats():
+    events = []
+    with Connection.from_env(instrument=True) as conn:
+        conn.add_hook(events.append)
+        for i in range(3):
+            assert list(conn.query(
+                f'SELECT generate_series(1, {i + 1}), $1::text', 'foo',
+            ))
+        with pytest.raises(SlonikException):
+            conn.execute('SELECT bar FROM foo')
+
+        stats = conn.stats()
+        select = stats['SELECT generate_series(?, ?), $1::text']
+        assert select['calls'] == 3
+        assert select['rows'] == 6
+        assert select['bytes'] == 6 * (4 + 3)
+        assert select['errors'] == 0
+        assert select['ffi_calls'] > 0
+        assert 0 < select['first_row'] <= select['total']
+        assert sum(select['latency'].values()) == 3
+        assert stats['SELECT bar FROM foo']['errors'] == 1
+
+    assert len(events) == 4
+    assert events[0].sql == "SELECT generate_series(1, 1), $1::text"
+    assert isinstance(events[-1].error, SlonikException)
+
+
+def test_stats_ffi_calls():
+    with Connection.from_env(instrument=True) as conn:
+        conn.execute('SELECT 1')  # connected
+        assert list(conn.query('SELECT generate_series(1, 3)')) == [
+            (1,), (2,), (3,),
+        ]
+
+        # new_query, query_exec_result, result_ncols, result_columns,
+        # next_rows until it returns no rows and result_close
+        stats = conn.stats()['SELECT generate_series(?, ?)']
+        assert stats['ffi_calls'] == 7
+
+
+def test_stats_disabled(conn):
+    assert conn.stats() == {}
+    with pytest.raises(SlonikException):
+        conn.add_hook(print)
@@ -0,0 +1,75 @@
+from slonik import SlonikException
+
+import pytest
+
+
+@pytest.fixture()
+def table(conn):
+    conn.execute('CREATE TABLE test_copy(id int, name text, ratio float)')
+    return 'test_copy'
+
+
+def test_copy_in_binary(conn, table):
+    rows = [(i, f'name {i}', None if i % 3 else i / 2) for i in range(10000)]
+    conn.copy_in(table, rows)
+
+    result = list(conn.query('SELECT * FROM test_copy ORDER BY id'))
+    assert result == rows
+
+
+def test_copy_in_text(conn, table):
+    rows = [(1, 'tab\tand\nnewline', 0.5), (2, None, None)]
+    conn.copy_in(table, rows, columns=['id', 'name', 'ratio'], format='text')
+
+    result = list(conn.query('SELECT * FROM test_copy ORDER BY id'))
+    assert result == rows
+
+
+def test_copy_in_columns(conn, table):
+    conn.copy_in(table, [('foo',), ('bar',)], columns=['name'])
+
+    result = list(conn.query('SELECT * FROM test_copy ORDER BY name'))
+    assert result == [(None, 'bar', None), (None, 'foo', None)]
+
+
+def test_copy_in_source_error(conn, table):
+    def rows():
+        yield (1, 'foo', 0.5)
+        raise KeyError('boom')
+
+    with pytest.raises(KeyError):
+        conn.copy_in(table, rows())
+
+
+def test_copy_out(conn, table):
+    rows = [(i, f'name {i}', None if i % 3 else i / 2) for i in range(10000)]
+    conn.copy_in(table, rows)
+
+    result = list(conn.copy_out('SELECT * FROM test_copy ORDER BY id'))
+    assert result == rows
+
+    chunks = list(conn.copy_out(
+        'SELECT id FROM test_copy ORDER BY id LIMIT 3', format='text', raw=True,
+    ))
+    assert b''.join(chunks) == b'0\n1\n2\n'
+
+
+def test_copy_out_early_close(conn):
+    rows = conn.copy_out('SELECT generate_series(1, 1000000)')
+    assert next(rows) == (1,)
+    rows.close()
+
+    # The transaction of the fixture wasn't aborted by a cancel
+    assert conn.in_transaction
+    assert conn.get_value('SELECT 42') == 42
+
+
+def test_copy_out_busy(conn):
+    # Instead of waiting for the COPY, which waits for the rows to be
+    # consumed
+    for row in conn.copy_out('SELECT generate_series(1, 1000000)'):
+        with pytest.raises(SlonikException, match='busy'):
+            conn.get_value('SELECT 42')
+        break
+
+    assert conn.get_value('SELECT 42') == 42
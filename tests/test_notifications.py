@@ -0,0 +1,95 @@
+import io
+import threading
+import time
+
+from slonik import Connection
+from slonik import Notification
+from slonik import QueryCache
+
+import pytest
+
+
+def receive(conn, count):
+    notifications = []
+    while len(notifications) < count:
+        received = conn.notifies(timeout=5)
+        assert received
+        notifications += received
+    return notifications
+
+
+def test_notifies():
+    with Connection.from_env() as listener, Connection.from_env() as sender:
+        listener.listen('slonik test')
+        assert listener.notifies() == []
+
+        sender.execute('''NOTIFY "slonik test", 'foo' ''')
+        sender.get_value("SELECT pg_notify('slonik test', 'bar')")
+        pid = sender.get_value('SELECT pg_backend_pid()')
+
+        assert receive(listener, 2) == [
+            Notification(pid, 'slonik test', 'foo'),
+            Notification(pid, 'slonik test', 'bar'),
+        ]
+
+        listener.unlisten('slonik test')
+        sender.execute('''NOTIFY "slonik test", 'baz' ''')
+        assert listener.notifies(timeout=0.1) == []
+
+
+def test_notifies_timeout():
+    with Connection.from_env() as conn:
+        conn.listen('slonik_test')
+        start = time.monotonic()
+        assert conn.notifies(timeout=0.1) == []
+        assert time.monotonic() - start >= 0.1
+
+
+def test_notifies_wait():
+    def notify():
+        time.sleep(0.1)
+        with Connection.from_env() as sender:
+            sender.execute("NOTIFY slonik_test, 'foo'")
+
+    with Connection.from_env() as conn:
+        conn.listen('slonik_test')
+        thread = threading.Thread(target=notify)
+        thread.start()
+        try:
+            notification, = conn.notifies(timeout=None)
+        finally:
+            thread.join()
+        assert notification.payload == 'foo'
+
+
+def test_notifies_drain():
+    with Connection.from_env() as listener, Connection.from_env() as sender:
+        listener.listen('slonik_test')
+        # Delivered together on commit
+        sender.execute(
+            "SELECT pg_notify('slonik_test', i::text) "
+            "FROM generate_series(1, 600) i"
+        )
+        notifications = receive(listener, 600)
+        assert [n.payload for n in notifications] == [
+            str(i) for i in range(1, 601)
+        ]
+
+
+def test_fileno(conn):
+    with pytest.raises(io.UnsupportedOperation):
+        conn.fileno()
+
+
+def test_cache_invalidation():
+    cache = QueryCache(channel='slonik_cache')
+    with Connection.from_env(cache=cache) as conn, \
+            Connection.from_env() as sender:
+        conn.listen('slonik_cache')
+        conn.get_value('SELECT 1', cache_ttl=10, cache_tags=['users'])
+        conn.get_value('SELECT 2', cache_ttl=10, cache_tags=['groups'])
+
+        sender.execute("NOTIFY slonik_cache, 'users'")
+        receive(conn, 1)
+        assert cache.stats()['invalidations'] == 1
+        assert cache.stats()['entries'] == 1
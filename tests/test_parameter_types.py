@@ -1,4 +1,11 @@
+import array
+import datetime
+import decimal
+import struct
+import uuid
+
 from slonik import SlonikException
+from slonik.row import decode_array_buffer
 
 import pytest
 
@@ -25,3 +32,87 @@ def test_text(conn):
     with pytest.raises(SlonikException) as e:
         conn.get_value('SELECT $1::text', 42)
     assert 'type conversion error' in str(e.value)
+
+
+def test_server_types(conn):
+    # Encoded according to the type of the parameter, not of the value
+    assert conn.get_value('SELECT $1::int8', 2 ** 40) == 2 ** 40
+    assert conn.get_value('SELECT $1::float4', 1) == 1.0
+    assert conn.get_value('SELECT $1::numeric', 42) == decimal.Decimal(42)
+    assert conn.get_value('SELECT $1::int + 1', None) is None
+
+    values = (
+        True, decimal.Decimal('-12.340'), b'\x00\x01',
+        uuid.UUID('3d9d291d-8668-480f-98bf-46ee10d07a5d'), {'a': [1]},
+        datetime.date(2020, 2, 29), datetime.datetime(2020, 2, 29, 12, 34),
+        datetime.datetime(2020, 2, 29, 12, 34, tzinfo=datetime.timezone.utc),
+    )
+    assert conn.get_one(
+        'SELECT $1::bool, $2::numeric, $3::bytea, $4::uuid, $5::jsonb, '
+        '$6::date, $7::timestamp, $8::timestamptz', *values,
+    ) == values
+
+
+def test_parameters_count(conn):
+    with pytest.raises(SlonikException) as e:
+        conn.get_value('SELECT $1::int', 1, 2)
+    assert str(e.value) == 'expected 1 parameters but got 2'
+
+
+def test_custom_types(conn):
+    conn.execute("CREATE TYPE mood AS ENUM ('sad', 'happy')")
+    conn.execute('CREATE DOMAIN positive AS int CHECK (VALUE > 0)')
+    conn.execute('CREATE TYPE pair AS (name text, value positive)')
+
+    assert conn.get_value('SELECT $1::mood', 'happy') == 'happy'
+    assert conn.get_value('SELECT $1::positive', 42) == 42
+    assert conn.get_value('SELECT $1::pair', ('foo', 42)) == ('foo', 42)
+    assert conn.get_value("SELECT ARRAY['sad', 'happy']::mood[]") == [
+        'sad', 'happy',
+    ]
+    assert conn.get_value("SELECT (1, 'foo')") == (1, 'foo')
+
+
+def test_register_type(conn):
+    conn.register_type(
+        'point',
+        encode=lambda value: struct.pack('>dd', *value),
+        decode=lambda value: struct.unpack('>dd', value),
+    )
+    assert conn.get_value('SELECT $1::point', (1, 2)) == (1.0, 2.0)
+    assert conn.get_value('SELECT ARRAY[$1::point]', (1, 2)) == [(1.0, 2.0)]
+
+    with pytest.raises(SlonikException):
+        conn.register_type('no_such_type', decode=bytes)
+
+
+def test_arrays(conn):
+    ids = list(range(10000))
+    assert conn.get_value(
+        'SELECT count(*) FROM generate_series(1, 20000) AS i '
+        'WHERE i = ANY($1)', ids,
+    ) == 9999
+    assert conn.get_value('SELECT $1::int8[]', [2 ** 40, None]) == [2 ** 40, None]
+    assert conn.get_value('SELECT $1::float8[]', [1.5, 2]) == [1.5, 2.0]
+    assert conn.get_value('SELECT $1::text[]', ['a', None]) == ['a', None]
+    assert conn.get_value('SELECT $1::int[]', [[1, 2], [3, 4]]) == [[1, 2], [3, 4]]
+    assert conn.get_value('SELECT $1::int[]', []) == []
+    assert conn.get_value(
+        'SELECT $1::int8[]', array.array('q', [1, 2, 3]),
+    ) == [1, 2, 3]
+
+    uuids = [uuid.uuid4(), uuid.uuid4()]
+    assert conn.get_value('SELECT $1::uuid[]', uuids) == uuids
+
+    with pytest.raises(SlonikException):
+        conn.get_value('SELECT $1::int[]', [[1, 2], [3]])
+
+    with pytest.raises(SlonikException) as e:
+        conn.get_value('SELECT $1::int[]', [1, 'foo'])
+    assert 'type `int4`' in str(e.value)
+
+
+def test_array_buffers(conn):
+    conn.register_type('int8[]', decode=decode_array_buffer)
+    values = conn.get_value('SELECT ARRAY[1, 2, 3]::int8[]')
+    assert values == array.array('q', [1, 2, 3])
@@ -0,0 +1,98 @@
+import threading
+
+from slonik import Pool
+from slonik import PoolTimeout
+from slonik import SlonikException
+
+import pytest
+
+
+def test_pool_checkout():
+    with Pool.from_env(min_size=1, max_size=2) as pool:
+        assert pool.size == 1
+
+        with pool.connection() as conn:
+            assert conn.get_value('SELECT 42') == 42
+
+        with pool.connection() as conn1, pool.connection() as conn2:
+            assert conn1 is not conn2
+            assert pool.size == 2
+
+            with pytest.raises(PoolTimeout):
+                pool.acquire(timeout=0.01)
+
+        # connections are reused
+        with pool.connection() as conn3:
+            assert conn3 in (conn1, conn2)
+
+
+def test_pool_threads():
+    results = []
+
+    def worker(pool, i):
+        for _ in range(10):
+            with pool.connection() as conn:
+                results.append(conn.get_value('SELECT $1::int', i))
+
+    with Pool.from_env(max_size=3) as pool:
+        threads = [
+            threading.Thread(target=worker, args=(pool, i)) for i in range(8)
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        assert pool.size <= 3
+
+    assert sorted(results) == sorted(list(range(8)) * 10)
+
+
+def test_pool_max_lifetime():
+    with Pool.from_env(min_size=0, max_size=1, max_lifetime=0) as pool:
+        with pool.connection() as conn1:
+            pass
+        with pool.connection() as conn2:
+            pass
+        assert conn1 is not conn2
+
+
+def test_pool_discards_broken_connections():
+    with Pool.from_env(min_size=1, max_size=1) as pool:
+        with pool.connection() as conn1:
+            conn1.close()
+            conn1.dsn = 'postgresql://255.255.255.255/db'
+
+        with pool.connection() as conn2:
+            assert conn2 is not conn1
+            assert conn2.get_value('SELECT 1') == 1
+
+
+def test_pool_rollback():
+    with Pool.from_env(min_size=1, max_size=1) as pool:
+        with pool.connection() as conn:
+            conn.transaction().__enter__()
+            conn.execute('CREATE TEMP TABLE test_table(value int)')
+            assert conn.in_transaction
+
+        with pool.connection() as conn:
+            assert not conn.in_transaction
+            with pytest.raises(SlonikException):
+                conn.execute('SELECT * FROM test_table')
+
+            # as are those opened by running BEGIN
+            conn.execute('BEGIN')
+            conn.execute('CREATE TEMP TABLE test_table(value int)')
+
+        with pool.connection() as conn:
+            with pytest.raises(SlonikException):
+                conn.execute('SELECT * FROM test_table')
+
+
+def test_pool_stats():
+    with Pool.from_env(min_size=2, max_size=2, instrument=True) as pool:
+        with pool.connection() as conn1, pool.connection() as conn2:
+            conn1.get_value('SELECT $1::int', 1)
+            conn2.get_value('SELECT $1::int', 2)
+
+        assert pool.stats()['SELECT $1::int']['calls'] == 2
@@ -0,0 +1,161 @@
+import asyncio
+import threading
+import time
+
+from slonik import AsyncConnection
+from slonik import Connection
+from slonik import NoRows
+from slonik import QueryTimeout
+from slonik import SlonikException
+from slonik.watchdog import Deadline
+from slonik.watchdog import WATCHDOG
+
+import pytest
+
+
+def test_watchdog():
+    fired = []
+    timers = [
+        WATCHDOG.arm(timeout, lambda timeout=timeout: fired.append(timeout))
+        for timeout in (0.05, 0.01, 10)
+    ]
+    time.sleep(0.1)
+    assert fired == [0.01, 0.05]
+    assert [WATCHDOG.disarm(timer) for timer in timers] == [True, True, False]
+
+
+def test_deadline():
+    canceled = []
+    with pytest.raises(QueryTimeout):
+        with Deadline(0.01, lambda: canceled.append(True)):
+            time.sleep(0.05)
+            raise SlonikException('canceling statement due to user request')
+    assert canceled == [True]
+
+    # Completed in time
+    with Deadline(1, lambda: canceled.append(False)):
+        pass
+    time.sleep(0.01)
+    assert canceled == [True]
+
+    # Leaving the block waits for the cancel being sent
+    def cancel():
+        time.sleep(0.1)
+        canceled.append(None)
+
+    with Deadline(0.01, cancel):
+        time.sleep(0.05)
+    assert canceled == [True, None]
+
+    with pytest.raises(ValueError):
+        Deadline(0, lambda: None)
+
+
+def test_timeout():
+    with Connection.from_env() as conn:
+        start = time.monotonic()
+        with pytest.raises(QueryTimeout):
+            conn.execute('SELECT pg_sleep(10)', timeout=0.1)
+        assert time.monotonic() - start < 5
+
+        with pytest.raises(QueryTimeout):
+            conn.get_value('SELECT 1 FROM pg_sleep(10)', timeout=0.1)
+
+        # Statements completing in time aren't canceled later on
+        assert conn.get_value('SELECT 42', timeout=0.1) == 42
+        time.sleep(0.2)
+        assert conn.get_value('SELECT 42') == 42
+
+
+def test_connection_timeout():
+    with Connection.from_env(timeout=0.1) as conn:
+        with pytest.raises(QueryTimeout):
+            list(conn.query('SELECT pg_sleep(10)'))
+
+        # The connection is still usable, per-call timeouts taking
+        # precedence
+        assert conn.get_value('SELECT 42') == 42
+        assert conn.get_value('SELECT 42 FROM pg_sleep(0.2)', timeout=5) == 42
+
+
+def test_stream_timeout():
+    with Connection.from_env() as conn:
+        rows = conn.stream(
+            'SELECT i FROM generate_series(1, 3) i, pg_sleep(i / 10.)',
+            batch_rows=1, timeout=0.15,
+        )
+        assert next(rows) == (1,)
+        with pytest.raises(QueryTimeout):
+            list(rows)
+
+
+def test_cancel():
+    with Connection.from_env() as conn:
+        conn.cancel()  # idle, nothing to cancel
+        assert conn.get_value('SELECT 1') == 1
+
+        timer = threading.Timer(0.1, conn.cancel)
+        timer.start()
+        with pytest.raises(SlonikException) as e:
+            conn.execute('SELECT pg_sleep(10)')
+        assert not isinstance(e.value, QueryTimeout)
+        timer.join()
+        assert conn.get_value('SELECT 1') == 1
+
+
+def test_get_one_stream(conn):
+    sql = 'SELECT i FROM generate_series(1, $1::int) i'
+    assert conn.get_one(sql, 1000000, stream=True) == (1,)
+    assert conn.get_value(sql, 3, stream=True) == 1
+    with pytest.raises(NoRows):
+        conn.get_one(sql, 0, stream=True)
+
+    # Outside of transactions
+    with Connection.from_env() as conn:
+        assert conn.get_value(sql, 1000000, stream=True) == 1
+        assert not conn.in_transaction
+
+
+def test_copy_out_closed():
+    with Connection.from_env() as conn:
+        rows = conn.copy_out('SELECT generate_series(1, 100000000)')
+        assert next(rows) == (1,)
+        start = time.monotonic()
+        rows.close()
+        assert time.monotonic() - start < 5
+        assert conn.get_value('SELECT 1') == 1
+
+
+def test_async_timeout():
+    async def main():
+        async with AsyncConnection.from_env() as conn:
+            with pytest.raises(QueryTimeout):
+                await conn.execute('SELECT pg_sleep(10)', timeout=0.1)
+
+            # Cancelling the task cancels the statement
+            start = time.monotonic()
+            with pytest.raises(asyncio.TimeoutError):
+                await asyncio.wait_for(
+                    conn.execute('SELECT pg_sleep(10)'), timeout=0.1,
+                )
+            assert await conn.get_value('SELECT 1') == 1
+            return time.monotonic() - start
+
+    assert asyncio.get_event_loop().run_until_complete(main()) < 5
+
+
+def test_async_cancel_other_call():
+    async def main():
+        async with AsyncConnection.from_env() as conn:
+            sleeping = asyncio.ensure_future(
+                conn.get_value('SELECT 1 FROM pg_sleep(0.3)'),
+            )
+            await asyncio.sleep(0.1)
+            # Sent for a call which already returned, e.g. canceled as it
+            # completed: the statement of the next one isn't canceled
+            await asyncio.get_running_loop().run_in_executor(
+                None, conn._cancel, object(),
+            )
+            return await sleeping
+
+    assert asyncio.get_event_loop().run_until_complete(main()) == 1